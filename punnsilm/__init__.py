@@ -6,16 +6,21 @@ import inspect
 import logging
 import importlib
 import threading
-import multiprocessing
 
 import os.path
 
+from . import metrics
+from . import profiler
 from .core import PunnsilmNode, Output
+from .queueing import QueuedNode
+from .partition import PartitionedGraph
+from .aio import AsyncGraph
 
 DEFAULT_CONFIG_FILE = "conf.py"
 DEFAULT_MODULEDIR = "modules"
 
 DEFAULT_CONCURRENCY_METHOD = "threads"
+KNOWN_CONCURRENCY_METHODS = ("threads", "processes", "asyncio")
 
 # holds name to node class mapping, filled dynamically on startup
 typemap = {}
@@ -26,12 +31,119 @@ modulemap = {}
 class PunnsilmGraph(object):
     def __init__(self, nodemap):
         self.nodemap = nodemap
+        self.compiled = False
         self.connect()
 
     def connect(self):
         for node_name, node in self.nodemap.items():
             node.connect_outputs(self.nodemap)
 
+    def compile(self):
+        """optimize the message passing of the connected graph. Intermediate nodes
+        that don't lead to any outputs are removed and every node gets dispatch
+        functions bound to its outputs, so that linear chains of nodes turn into
+        direct calls from one append() to the next.
+        returns description of the resulting topology
+        """
+        if any(node.test_mode for node in self.nodemap.values()):
+            # test mode prints out the path of the messages through the broadcast() wrappers
+            logging.info("not compiling the graph in the test mode")
+            return self.describe()
+
+        self.removed = []
+        while 1:
+            dead = [node for node in self.nodemap.values()
+                if self._is_intermediate(node) and not node.outputs]
+            if not dead:
+                break
+            for node in dead:
+                logging.info("removing node %s that doesn't have any outputs" % (node.name,))
+                del self.nodemap[node.name]
+                self.removed.append(node.name)
+                for other in self.nodemap.values():
+                    if node in other.outputs:
+                        other.remove_output(node)
+
+        for node in self.nodemap.values():
+            node.compile_dispatch()
+        self.compiled = True
+
+        report = self.describe()
+        logging.info("compiled graph:\n%s" % (report,))
+        return report
+
+    def _is_intermediate(self, node):
+        if isinstance(node, QueuedNode):
+            node = node.node
+        return not isinstance(node, (core.Monitor, core.Output))
+
+    def describe(self):
+        """returns human readable description of the graph topology
+        """
+        inputs_count = dict((name, 0) for name in self.nodemap)
+        for node in self.nodemap.values():
+            for output in node.outputs:
+                inputs_count[output.name] = inputs_count.get(output.name, 0) + 1
+
+        retl = []
+        for name in sorted(self.nodemap):
+            node = self.nodemap[name]
+            output_names = ', '.join(sorted(o.name for o in node.outputs))
+            retl.append('%s (%s) -> [%s]' % (name, node.__class__.__name__, output_names))
+
+        # chains where every node has a single output that has no other inputs
+        # are passed through with one direct call per hop
+        for name in sorted(self.nodemap):
+            node = self.nodemap[name]
+            if len(node.outputs) != 1 or inputs_count[name] == 1 and self._single_link(name):
+                continue
+            chain = [name]
+            while len(node.outputs) == 1 and inputs_count[node.outputs[0].name] == 1:
+                node = node.outputs[0]
+                chain.append(node.name)
+            if len(chain) > 2:
+                retl.append('chain: %s' % (' -> '.join(chain),))
+
+        for name in getattr(self, 'removed', []):
+            retl.append('removed: %s' % (name,))
+
+        return '\n'.join(retl)
+
+    def _single_link(self, name):
+        """True if the only input of the node has no other outputs
+        """
+        for node in self.nodemap.values():
+            if any(o.name == name for o in node.outputs):
+                return len(node.outputs) == 1
+        return False
+
+    def enable_metrics(self):
+        """start keeping runtime counters of the nodes, see punnsilm.metrics.
+        Has to be called before start()
+        """
+        metrics.instrument(self.nodemap.values())
+        if self.compiled:
+            # bind the dispatch again, now to the wrapped methods
+            for node in self.nodemap.values():
+                node.compile_dispatch()
+        metrics.instrument_sources(self.nodemap.values())
+
+    def get_metrics(self):
+        """returns node name -> runtime counters
+        """
+        return metrics.collect(self.nodemap.values())
+
+    def enable_profiler(self):
+        """make the nodes profileable at runtime, see punnsilm.profiler.
+        Has to be called before start() and enable_metrics()
+        returns the GraphProfiler
+        """
+        self.profiler = profiler.GraphProfiler(self.nodemap.values())
+        if self.compiled:
+            for node in self.nodemap.values():
+                node.compile_dispatch()
+        return self.profiler
+
     def start(self):
         """start the activity of the graph.
         returns list of runnable objects
@@ -43,9 +155,27 @@ class PunnsilmGraph(object):
                 runnables.append(runnable)
         return runnables
 
+    def wait_idle(self):
+        """wait until the queued nodes and the nodes with worker processes have
+        processed everything that was sent to them
+        """
+        nodes = [node for node in self.nodemap.values() if not isinstance(node, core.Monitor)]
+        # these nodes might feed each other so keep going until all of them are idle at once
+        while not all([node.wait_idle(0) for node in nodes]):
+            for node in nodes:
+                node.wait_idle()
+
     def stop(self):
+        # inputs first so that nothing new arrives while the queues are drained
+        for node_name, node in self.nodemap.items():
+            if isinstance(node, core.Monitor):
+                node.stop()
+
+        self.wait_idle()
+
         for node_name, node in self.nodemap.items():
-            node.stop()
+            if not isinstance(node, core.Monitor):
+                node.stop()
 
 def create_node(node_conf):
     """node factory
@@ -138,10 +268,24 @@ def create_nodes(nodelist, node_whitelist=None, test_mode=False, keep_state=True
             logging.info("overriding continue_from_last_known_position flag")
             node.continue_from_last_known_position = False
 
-        if concurrency == 'threads':
+        if concurrency in ('threads', 'asyncio'):
+            # inputs that can't run on the event loop keep their threads
             node.concurrency_cls = threading.Thread
         elif concurrency == 'processes':
-            node.concurrency_cls = multiprocessing.Process
+            # PartitionedGraph takes care of the processes, inside of them
+            # the nodes run in threads as usual
+            node.concurrency_cls = threading.Thread
+            node.partition = node_conf.get('process', None)
+
+        if node_conf.get('queue', None):
+            if isinstance(node, core.Monitor):
+                logging.warn("ignoring queue configuration of input node %s" % (node.name,))
+            elif test_mode:
+                # test mode output would get interleaved
+                logging.info("not queueing %s because test mode is enabled" % (node.name,))
+            else:
+                logging.info("messages to %s will be queued" % (node.name,))
+                node = QueuedNode(node, node_conf['queue'])
 
         nodemap[node.name] = node
             
@@ -271,6 +415,11 @@ def read_config(filename=None):
 def init_graph(node_whitelist=None, test_mode=False, keep_state=True, config=None, concurrency=DEFAULT_CONCURRENCY_METHOD, extra_module_dirs=None, connect_test_input=None):
     """reads in configuration and initializes data structures
     """
+    if concurrency is None:
+        concurrency = DEFAULT_CONCURRENCY_METHOD
+    if concurrency not in KNOWN_CONCURRENCY_METHODS:
+        raise Exception('unknown concurrency method %s, known methods are %s' % (concurrency, KNOWN_CONCURRENCY_METHODS))
+
     load_modules(DEFAULT_MODULEDIR)
     if extra_module_dirs is not None:
         for module_dir in extra_module_dirs:
@@ -279,4 +428,8 @@ def init_graph(node_whitelist=None, test_mode=False, keep_state=True, config=Non
 
     nodelist = read_config(config)
     nodemap = create_nodes(nodelist, node_whitelist=node_whitelist, test_mode=test_mode, keep_state=keep_state, concurrency=concurrency, connect_test_input=connect_test_input)
+    if concurrency == 'processes':
+        return PartitionedGraph(nodemap)
+    elif concurrency == 'asyncio':
+        return AsyncGraph(nodemap)
     return PunnsilmGraph(nodemap)
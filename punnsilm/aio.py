@@ -0,0 +1,348 @@
+import logging
+import threading
+import collections
+import concurrent.futures
+
+import asyncio
+
+from . import core
+from . import metrics
+from . import profiler
+
+# Runtime for the "asyncio" concurrency method.
+#
+# All the nodes share a single event loop that runs in its own thread.
+# Every node other than an input gets an AsyncNodeProxy with a bounded queue
+# and a task that feeds the queued messages to the node. Nodes that have
+# coroutine aappend_batch() or aappend() are awaited on the loop, all the
+# others run in a thread of their own so that they wouldn't block the loop.
+# Inputs with coroutine arun() run as tasks on the loop, the rest run in
+# their threads as before.
+
+# how many messages can wait for a node before the senders have to wait
+QUEUE_SIZE = 10000
+# node gets at most this many messages at once
+MAX_BATCH = 1000
+# how long to wait for the loop to finish its work when stopping
+STOP_TIMEOUT_SEC = 10
+# threads that find the queue full check this often whether the loop is still there
+QUEUE_FULL_WAIT_SEC = 1
+
+async def abroadcast_batch(node, msgs):
+    """coroutine counterpart of PunnsilmNode.broadcast_batch(). Waits while the
+    outputs don't have room for the messages. Works outside of the asyncio
+    runtime too, in which case the outputs are called directly.
+    """
+    metrics = getattr(node, 'metrics', None)
+    if metrics is not None:
+        # outputs are proxies that the metrics wrappers don't see being called from here
+        metrics.messages_out += len(msgs) * len(node.outputs)
+    for output in node.outputs:
+        aappend_batch = getattr(output, 'aappend_batch', None)
+        if aappend_batch is not None:
+            await aappend_batch(msgs)
+        else:
+            output.append_batch(msgs)
+
+async def abroadcast(node, msg):
+    await abroadcast_batch(node, [msg])
+
+class AsyncNodeProxy(object):
+    """stands in for a node in the graph and feeds the messages sent to it
+    to the node from a task on the event loop
+    """
+    def __init__(self, node, loop, maxsize=QUEUE_SIZE):
+        self.node = node
+        self.name = node.name
+        self._loop = loop
+        self.maxsize = maxsize
+
+        if hasattr(node, 'aappend_batch'):
+            self._deliver = node.aappend_batch
+        elif hasattr(node, 'aappend'):
+            self._deliver = self._aappend_one_by_one
+        else:
+            # legacy node, gets a thread of its own so that the messages
+            # are still processed one list at a time and in order
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                thread_name_prefix='punnsilm: %s' % (self.name,))
+            self._deliver = self._append_in_executor
+
+        # lists of messages waiting for the node. Only touched from the loop
+        self._pending = collections.deque()
+        self._depth = 0
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+        # messages that have been sent but not yet processed. Senders that
+        # are not running on the loop wait on _idle while there are too many
+        self._unfinished = 0
+        self._idle = threading.Condition()
+
+        self._task = None
+
+    def __str__(self):
+        return "<%s - %s>" % (self.__class__.__name__, str(self.name))
+
+    def start(self):
+        """start feeding the node. Has to be called from the loop
+        """
+        self._task = self._loop.create_task(self._work())
+
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _count(self, msgs):
+        with self._idle:
+            self._unfinished += len(msgs)
+
+    def _put(self, msgs):
+        """add messages to the queue, has to be called from the loop after
+        they have been counted with _count()
+        """
+        self._pending.append(msgs)
+        self._depth += len(msgs)
+        if self._depth >= self.maxsize:
+            self._not_full.clear()
+        self._not_empty.set()
+
+    async def aappend_batch(self, msgs):
+        while not self._not_full.is_set():
+            await self._not_full.wait()
+        self._count(msgs)
+        self._put(msgs)
+
+    async def aappend(self, msg):
+        await self.aappend_batch([msg])
+
+    def append_batch(self, msgs):
+        if self._in_loop():
+            # can't wait here without blocking the loop itself, coroutines
+            # that want backpressure should use abroadcast_batch()
+            self._count(msgs)
+            self._put(msgs)
+            return
+
+        # senders in other threads only wait when the node is behind,
+        # otherwise the messages are just handed over to the loop
+        with self._idle:
+            while self._unfinished >= self.maxsize and self._loop.is_running():
+                self._idle.wait(QUEUE_FULL_WAIT_SEC)
+            self._unfinished += len(msgs)
+        self._loop.call_soon_threadsafe(self._put, msgs)
+
+    def append(self, msg):
+        self.append_batch([msg])
+
+    async def _aappend_one_by_one(self, msgs):
+        aappend = self.node.aappend
+        for msg in msgs:
+            await aappend(msg)
+
+    async def _append_in_executor(self, msgs):
+        await self._loop.run_in_executor(self._executor, self._append_sync, msgs)
+
+    def _append_sync(self, msgs):
+        if len(msgs) == 1:
+            self.node.append(msgs[0])
+        else:
+            self.node.append_batch(msgs)
+
+    async def _work(self):
+        pending = self._pending
+        while 1:
+            while not pending:
+                self._not_empty.clear()
+                await self._not_empty.wait()
+
+            msgs = pending.popleft()
+            if pending and len(msgs) + len(pending[0]) <= MAX_BATCH:
+                msgs = list(msgs)
+                while pending and len(msgs) + len(pending[0]) <= MAX_BATCH:
+                    msgs.extend(pending.popleft())
+            self._depth -= len(msgs)
+            if self._depth < self.maxsize:
+                self._not_full.set()
+
+            try:
+                await self._deliver(msgs)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception('%s failed to process messages' % (str(self),))
+            finally:
+                with self._idle:
+                    was_full = self._unfinished >= self.maxsize
+                    self._unfinished -= len(msgs)
+                    if not self._unfinished or (was_full and self._unfinished < self.maxsize):
+                        self._idle.notify_all()
+
+    def get_queue_counters(self):
+        return {'depth': self._depth}
+
+    def wait_idle(self, timeout=None):
+        """wait until everything sent to the node has been processed.
+        Must not be called from the loop.
+        """
+        with self._idle:
+            while self._unfinished:
+                if not self._idle.wait(timeout) and timeout is not None:
+                    break
+            if self._unfinished:
+                return False
+        return self.node.wait_idle(timeout)
+
+    async def acancel(self):
+        """stop feeding the node. Has to be called from the loop
+        """
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stop(self):
+        astop = getattr(self.node, 'astop', None)
+        if astop is not None:
+            asyncio.run_coroutine_threadsafe(astop(), self._loop).result(STOP_TIMEOUT_SEC)
+        else:
+            self.node.stop()
+
+        if self._deliver == self._append_in_executor:
+            self._executor.shutdown(wait=True)
+
+class _TaskRunnable(object):
+    """lets the caller join() coroutine running on the loop like a thread
+    """
+    def __init__(self, name, future):
+        self.name = name
+        self._future = future
+
+    def join(self, timeout=None):
+        try:
+            self._future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            pass
+        except Exception:
+            logging.exception('input %s failed' % (self.name,))
+
+    def is_alive(self):
+        return not self._future.done()
+
+class AsyncGraph(object):
+    """graph whose nodes share a single asyncio event loop
+    """
+    def __init__(self, nodemap):
+        self.nodemap = nodemap
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = None
+
+        # node name -> proxy. Inputs are not proxied, nothing is sent to them
+        self.proxies = {}
+        for node_name, node in nodemap.items():
+            if not isinstance(node, core.Monitor):
+                self.proxies[node_name] = AsyncNodeProxy(node, self.loop)
+
+        view = dict(nodemap)
+        view.update(self.proxies)
+        for node_name, node in nodemap.items():
+            node.connect_outputs(view)
+
+    def enable_metrics(self):
+        """start keeping runtime counters of the nodes, see punnsilm.metrics.
+        Has to be called before start()
+        """
+        metrics.instrument(self.nodemap.values())
+        for node_name, proxy in self.proxies.items():
+            node_metrics = self.nodemap[node_name].metrics
+            node_metrics.queue_counters = proxy.get_queue_counters
+            metrics.wrap_hops([proxy], node_metrics)
+            if proxy._deliver != proxy._append_in_executor:
+                # coroutines are measured as a whole, the wrappers of legacy
+                # nodes take care of themselves in the executor
+                proxy._deliver = metrics.wrap_coroutine(node_metrics, proxy._deliver)
+        metrics.instrument_sources(self.nodemap.values())
+
+    def get_metrics(self):
+        """returns node name -> runtime counters
+        """
+        return metrics.collect(self.nodemap.values())
+
+    def enable_profiler(self):
+        """make the nodes profileable at runtime, see punnsilm.profiler.
+        Has to be called before start() and enable_metrics().
+        returns the GraphProfiler
+        """
+        self.profiler = profiler.GraphProfiler(self.nodemap.values())
+        return self.profiler
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _call_in_loop(self, func, *args):
+        """run func in the loop and return what it returned
+        """
+        async def _call():
+            return func(*args)
+        return asyncio.run_coroutine_threadsafe(_call(), self.loop).result()
+
+    def start(self):
+        """start the loop and the inputs.
+        returns list of objects that can be join()ed to wait until the inputs are done
+        """
+        self._loop_thread = threading.Thread(target=self._run_loop, name='punnsilm: asyncio')
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+
+        for proxy in self.proxies.values():
+            self._call_in_loop(proxy.start)
+
+        runnables = []
+        for node_name, node in self.nodemap.items():
+            if not isinstance(node, core.Monitor):
+                node.run()
+            elif hasattr(node, 'arun'):
+                future = asyncio.run_coroutine_threadsafe(node.arun(), self.loop)
+                runnables.append(_TaskRunnable(node_name, future))
+            else:
+                runnable = node.run()
+                if runnable:
+                    runnables.append(runnable)
+        return runnables
+
+    def wait_idle(self):
+        proxies = list(self.proxies.values())
+        # nodes might feed each other so keep going until all of them are idle at once
+        while not all([proxy.wait_idle(0) for proxy in proxies]):
+            for proxy in proxies:
+                proxy.wait_idle()
+
+    def stop(self):
+        for node in self.nodemap.values():
+            if isinstance(node, core.Monitor):
+                astop = getattr(node, 'astop', None)
+                if astop is not None and self.loop.is_running():
+                    asyncio.run_coroutine_threadsafe(astop(), self.loop).result(STOP_TIMEOUT_SEC)
+                else:
+                    node.stop()
+
+        if self._loop_thread is None:
+            return
+
+        self.wait_idle()
+        for proxy in self.proxies.values():
+            asyncio.run_coroutine_threadsafe(proxy.acancel(), self.loop).result(STOP_TIMEOUT_SEC)
+            proxy.stop()
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._loop_thread.join(STOP_TIMEOUT_SEC)
+        if not self._loop_thread.is_alive():
+            self.loop.close()
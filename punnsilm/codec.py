@@ -0,0 +1,582 @@
+import struct
+import pickle
+import datetime
+import importlib
+
+from . import core
+
+# Compact binary encoding for lists of messages that travel between the
+# processes or are written to disk.
+#
+# A batch is encoded column by column: all the timestamps of the batch go
+# into one array of integers, all the hosts into another and so on. Columns
+# where the same value repeats a lot (host, group) are stored as a table of
+# distinct values plus indices into it, strings are joined into a single
+# UTF-8 blob that is decoded with one call and extradata maps share a table
+# of their keys. Whatever doesn't fit any of these is stored value by value
+# with a type tag, and as the last resort pickled.
+#
+# batch := MAGIC version:u8 count:u32 classes column...
+# Every field is little endian. Datetimes without timezone are stored as
+# microseconds since 1970-01-01 in the same "local" time that they had.
+
+MAGIC = b'PMSG'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sBI')
+# batches written to files are prefixed with their length
+_FRAME = struct.Struct('<I')
+_U8 = struct.Struct('<B')
+_U32 = struct.Struct('<I')
+_I64 = struct.Struct('<q')
+_F64 = struct.Struct('<d')
+_I32 = struct.Struct('<i')
+
+# column kinds
+_COL_NONE = b'N'
+_COL_JOINED = b'S'
+_COL_STRINGS = b'L'
+_COL_TABLE = b'D'
+_COL_TIMESTAMPS = b'T'
+_COL_AWARE_TIMESTAMPS = b'Z'
+_COL_MAPS = b'M'
+_COL_VALUES = b'V'
+
+# value tags of the _COL_VALUES columns
+_TAG_MISSING = b'X'
+_TAG_NONE = b'N'
+_TAG_TRUE = b't'
+_TAG_FALSE = b'f'
+_TAG_STR = b's'
+_TAG_BYTES = b'b'
+_TAG_INT = b'i'
+_TAG_BIGINT = b'I'
+_TAG_FLOAT = b'd'
+_TAG_DATETIME = b'T'
+_TAG_AWARE_DATETIME = b'Z'
+_TAG_DICT = b'm'
+_TAG_LIST = b'l'
+_TAG_TUPLE = b'u'
+_TAG_PICKLE = b'P'
+
+# joined string columns are split on this character
+_SEPARATOR = '\x00'
+# no map has this many keys, marks the messages without extradata
+_NO_MAP = 0xffffffff
+# columns shorter than this aren't worth a table of distinct values
+_MIN_TABLE_COLUMN = 8
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_ONE_US = datetime.timedelta(microseconds=1)
+_INDEX_FORMATS = ((0xff, 'B'), (0xffff, 'H'), (0xffffffff, 'I'))
+
+# fields of the messages that are never transported
+_SKIPPED_SLOTS = ('depth',)
+# stands in for a slot that hasn't been set
+_MISSING = object()
+
+class CodecError(Exception):
+    pass
+
+# message class -> names of the fields that are encoded
+_class_fields = {}
+# "module:qualname" -> message class
+_classes_by_name = {}
+
+def _class_name(msg_cls):
+    return '%s:%s' % (msg_cls.__module__, msg_cls.__qualname__)
+
+def _get_fields(msg_cls):
+    fields = _class_fields.get(msg_cls, None)
+    if fields is None:
+        fields = tuple(name for name in core.message_slots(msg_cls) if name not in _SKIPPED_SLOTS)
+        _class_fields[msg_cls] = fields
+    return fields
+
+def _resolve_class(name):
+    msg_cls = _classes_by_name.get(name, None)
+    if msg_cls is None:
+        module_name, qualname = name.split(':', 1)
+        obj = importlib.import_module(module_name)
+        for part in qualname.split('.'):
+            obj = getattr(obj, part)
+        if not isinstance(obj, type) or not issubclass(obj, core.Message):
+            raise CodecError('%s is not a message class' % (name,))
+        msg_cls = _classes_by_name[name] = obj
+    return msg_cls
+
+def _index_format(count):
+    for limit, fmt in _INDEX_FORMATS:
+        if count <= limit:
+            return fmt
+    raise CodecError('too many distinct values in a column')
+
+# encoding
+
+def _encode_value(value, out):
+    """appends tagged value to the list of byte strings"""
+    value_type = type(value)
+    if value is None:
+        out.append(_TAG_NONE)
+    elif value is _MISSING:
+        out.append(_TAG_MISSING)
+    elif value_type is str:
+        data = value.encode('utf-8', 'surrogatepass')
+        out.append(_TAG_STR + _U32.pack(len(data)))
+        out.append(data)
+    elif value_type is bool:
+        out.append(_TAG_TRUE if value else _TAG_FALSE)
+    elif value_type is int:
+        if -2**63 <= value < 2**63:
+            out.append(_TAG_INT + _I64.pack(value))
+        else:
+            data = str(value).encode('ascii')
+            out.append(_TAG_BIGINT + _U32.pack(len(data)))
+            out.append(data)
+    elif value_type is float:
+        out.append(_TAG_FLOAT + _F64.pack(value))
+    elif value_type is bytes:
+        out.append(_TAG_BYTES + _U32.pack(len(value)))
+        out.append(value)
+    elif value_type is datetime.datetime:
+        offset = value.utcoffset()
+        if offset is None and value.tzinfo is None:
+            out.append(_TAG_DATETIME + _I64.pack((value - _EPOCH) // _ONE_US))
+        elif offset is not None and type(value.tzinfo) is datetime.timezone:
+            local = value.replace(tzinfo=None)
+            out.append(_TAG_AWARE_DATETIME + _I64.pack((local - _EPOCH) // _ONE_US) +
+                _I64.pack(offset // _ONE_US))
+        else:
+            _encode_pickled(value, out)
+    elif value_type is dict:
+        out.append(_TAG_DICT + _U32.pack(len(value)))
+        for k, v in value.items():
+            _encode_value(k, out)
+            _encode_value(v, out)
+    elif value_type is list:
+        out.append(_TAG_LIST + _U32.pack(len(value)))
+        for v in value:
+            _encode_value(v, out)
+    elif value_type is tuple:
+        out.append(_TAG_TUPLE + _U32.pack(len(value)))
+        for v in value:
+            _encode_value(v, out)
+    else:
+        _encode_pickled(value, out)
+
+def _encode_pickled(value, out):
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    out.append(_TAG_PICKLE + _U32.pack(len(data)))
+    out.append(data)
+
+def _encode_strings(values, out):
+    joined = _SEPARATOR.join(values)
+    data = joined.encode('utf-8', 'surrogatepass')
+    if joined.count(_SEPARATOR) == len(values) - 1:
+        out.append(_COL_JOINED + _U32.pack(len(data)))
+        out.append(data)
+    else:
+        # some of the strings contain the separator themselves
+        encoded = [v.encode('utf-8', 'surrogatepass') for v in values]
+        out.append(_COL_STRINGS)
+        out.append(struct.pack('<%dI' % (len(encoded),), *map(len, encoded)))
+        out.append(b''.join(encoded))
+
+def _encode_timestamps(values, out):
+    cache = {}
+    retl = []
+    for value in values:
+        us = cache.get(value, None)
+        if us is None:
+            us = cache[value] = (value - _EPOCH) // _ONE_US
+        retl.append(us)
+    out.append(_COL_TIMESTAMPS)
+    out.append(struct.pack('<%dq' % (len(retl),), *retl))
+
+def _encode_aware_timestamps(values, out):
+    cache = {}
+    retl = []
+    for value in values:
+        # datetimes of the same moment in different timezones are equal
+        # so the timezone has to be a part of the key
+        key = (value, value.tzinfo)
+        pair = cache.get(key, None)
+        if pair is None:
+            local = value.replace(tzinfo=None)
+            pair = cache[key] = ((local - _EPOCH) // _ONE_US, value.utcoffset() // _ONE_US)
+        retl.extend(pair)
+    out.append(_COL_AWARE_TIMESTAMPS)
+    out.append(struct.pack('<%dq' % (len(retl),), *retl))
+
+def _table_key(value):
+    # datetimes of the same moment in different timezones are equal
+    # so the timezone has to be a part of the key
+    if type(value) is datetime.datetime:
+        return (datetime.datetime, value, value.tzinfo)
+    return value
+
+def _encode_table(values, out):
+    table = {}
+    distinct = []
+    indices = []
+    for value in values:
+        key = _table_key(value)
+        index = table.get(key, None)
+        if index is None:
+            index = table[key] = len(table)
+            distinct.append(value)
+        indices.append(index)
+
+    fmt = _index_format(len(table))
+    out.append(_COL_TABLE + _U32.pack(len(table)) + fmt.encode('ascii'))
+    _encode_column(distinct, out, allow_table=False)
+    out.append(struct.pack('<%d%s' % (len(indices), fmt), *indices))
+
+def _encode_maps(values, out):
+    counts = []
+    keys = []
+    map_values = []
+    for value in values:
+        if value is None:
+            counts.append(_NO_MAP)
+        else:
+            counts.append(len(value))
+            keys.extend(value.keys())
+            map_values.extend(value.values())
+
+    out.append(_COL_MAPS + _U32.pack(len(keys)))
+    out.append(struct.pack('<%dI' % (len(counts),), *counts))
+    if keys:
+        _encode_column(keys, out)
+        _encode_column(map_values, out)
+
+def _encode_column(values, out, allow_table=True):
+    """picks the most compact representation for the list of values"""
+    types = set(map(type, values))
+    if types == {type(None)}:
+        out.append(_COL_NONE)
+        return
+
+    if types == {datetime.datetime} and not any([v.tzinfo for v in values]):
+        _encode_timestamps(values, out)
+        return
+
+    if types == {datetime.datetime} and all([type(v.tzinfo) is datetime.timezone for v in values]):
+        _encode_aware_timestamps(values, out)
+        return
+
+    if types <= {dict, type(None)} and _MISSING not in values:
+        _encode_maps(values, out)
+        return
+
+    if allow_table and len(values) >= _MIN_TABLE_COLUMN and types <= {str, int, type(None), datetime.datetime, type(_MISSING)}:
+        if datetime.datetime in types:
+            distinct_count = len(set(map(_table_key, values)))
+        else:
+            distinct_count = len(set(values))
+        if distinct_count <= len(values) // 2:
+            _encode_table(values, out)
+            return
+
+    if types == {str}:
+        _encode_strings(values, out)
+        return
+
+    out.append(_COL_VALUES)
+    for value in values:
+        _encode_value(value, out)
+
+def encode_batch(msgs):
+    """returns list of messages encoded into a single bytes object
+    """
+    out = [_HEADER.pack(MAGIC, VERSION, len(msgs))]
+
+    # lazily parsed messages are sent as the ordinary ones
+    msgs = [msg.materialize() for msg in msgs]
+
+    classes = {}
+    class_indices = []
+    for msg in msgs:
+        msg_cls = type(msg)
+        index = classes.get(msg_cls, None)
+        if index is None:
+            index = classes[msg_cls] = len(classes)
+        class_indices.append(index)
+
+    out.append(_U32.pack(len(classes)))
+    _encode_column([_class_name(msg_cls) for msg_cls in classes], out, allow_table=False)
+    if len(classes) > 1:
+        fmt = _index_format(len(classes))
+        out.append(struct.pack('<%d%s' % (len(class_indices), fmt), *class_indices))
+
+    # one column for each field that any of the classes has
+    field_names = []
+    for msg_cls in classes:
+        for name in _get_fields(msg_cls):
+            if name not in field_names:
+                field_names.append(name)
+    has_dict = any([hasattr(msg, '__dict__') for msg in msgs])
+    if has_dict:
+        field_names.append('__dict__')
+
+    out.append(_U32.pack(len(field_names)))
+    _encode_column(field_names, out, allow_table=False)
+    for name in field_names:
+        _encode_column([getattr(msg, name, _MISSING) for msg in msgs], out)
+
+    return b''.join(out)
+
+def encode(msg):
+    return encode_batch([msg])
+
+# decoding
+
+class _Reader(object):
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def read(self, size):
+        if self.pos + size > len(self.data):
+            raise CodecError('batch is truncated')
+        retval = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return retval
+
+    def unpack(self, st):
+        if self.pos + st.size > len(self.data):
+            raise CodecError('batch is truncated')
+        retval = st.unpack_from(self.data, self.pos)
+        self.pos += st.size
+        return retval
+
+    def unpack_array(self, fmt, count):
+        st = struct.Struct('<%d%s' % (count, fmt))
+        if self.pos + st.size > len(self.data):
+            raise CodecError('batch is truncated')
+        retval = st.unpack_from(self.data, self.pos)
+        self.pos += st.size
+        return retval
+
+def _decode_value(reader):
+    tag = bytes(reader.read(1))
+    if tag == _TAG_STR:
+        size, = reader.unpack(_U32)
+        return str(reader.read(size), 'utf-8', 'surrogatepass')
+    elif tag == _TAG_NONE:
+        return None
+    elif tag == _TAG_MISSING:
+        return _MISSING
+    elif tag == _TAG_INT:
+        return reader.unpack(_I64)[0]
+    elif tag == _TAG_TRUE:
+        return True
+    elif tag == _TAG_FALSE:
+        return False
+    elif tag == _TAG_FLOAT:
+        return reader.unpack(_F64)[0]
+    elif tag == _TAG_BIGINT:
+        size, = reader.unpack(_U32)
+        return int(str(reader.read(size), 'ascii'))
+    elif tag == _TAG_BYTES:
+        size, = reader.unpack(_U32)
+        return bytes(reader.read(size))
+    elif tag == _TAG_DATETIME:
+        return _EPOCH + datetime.timedelta(microseconds=reader.unpack(_I64)[0])
+    elif tag == _TAG_AWARE_DATETIME:
+        local = _EPOCH + datetime.timedelta(microseconds=reader.unpack(_I64)[0])
+        offset = datetime.timedelta(microseconds=reader.unpack(_I64)[0])
+        return local.replace(tzinfo=datetime.timezone(offset))
+    elif tag == _TAG_DICT:
+        count, = reader.unpack(_U32)
+        retd = {}
+        for i in range(count):
+            k = _decode_value(reader)
+            retd[k] = _decode_value(reader)
+        return retd
+    elif tag == _TAG_LIST:
+        count, = reader.unpack(_U32)
+        return [_decode_value(reader) for i in range(count)]
+    elif tag == _TAG_TUPLE:
+        count, = reader.unpack(_U32)
+        return tuple([_decode_value(reader) for i in range(count)])
+    elif tag == _TAG_PICKLE:
+        size, = reader.unpack(_U32)
+        return pickle.loads(reader.read(size))
+    raise CodecError('unknown value tag %r' % (tag,))
+
+def _decode_column(reader, count):
+    kind = bytes(reader.read(1))
+    if kind == _COL_JOINED:
+        size, = reader.unpack(_U32)
+        data = reader.read(size)
+        if not count:
+            return []
+        return str(data, 'utf-8', 'surrogatepass').split(_SEPARATOR)
+    elif kind == _COL_TABLE:
+        table_size, = reader.unpack(_U32)
+        fmt = str(reader.read(1), 'ascii')
+        table = _decode_column(reader, table_size)
+        return [table[i] for i in reader.unpack_array(fmt, count)]
+    elif kind == _COL_TIMESTAMPS:
+        cache = {}
+        retl = []
+        for us in reader.unpack_array('q', count):
+            value = cache.get(us, None)
+            if value is None:
+                value = cache[us] = _EPOCH + datetime.timedelta(microseconds=us)
+            retl.append(value)
+        return retl
+    elif kind == _COL_AWARE_TIMESTAMPS:
+        cache = {}
+        timezones = {}
+        retl = []
+        pairs = reader.unpack_array('q', count * 2)
+        for i in range(0, count * 2, 2):
+            key = pairs[i:i + 2]
+            value = cache.get(key, None)
+            if value is None:
+                us, offset_us = key
+                tz = timezones.get(offset_us, None)
+                if tz is None:
+                    tz = timezones[offset_us] = datetime.timezone(datetime.timedelta(microseconds=offset_us))
+                value = cache[key] = (_EPOCH + datetime.timedelta(microseconds=us)).replace(tzinfo=tz)
+            retl.append(value)
+        return retl
+    elif kind == _COL_NONE:
+        return [None] * count
+    elif kind == _COL_MAPS:
+        keys_count, = reader.unpack(_U32)
+        counts = reader.unpack_array('I', count)
+        keys = values = ()
+        if keys_count:
+            keys = _decode_column(reader, keys_count)
+            values = _decode_column(reader, keys_count)
+        retl = []
+        pos = 0
+        for map_size in counts:
+            if map_size == _NO_MAP:
+                retl.append(None)
+            else:
+                retl.append(dict(zip(keys[pos:pos + map_size], values[pos:pos + map_size])))
+                pos += map_size
+        return retl
+    elif kind == _COL_STRINGS:
+        lengths = reader.unpack_array('I', count)
+        data = reader.read(sum(lengths))
+        retl = []
+        pos = 0
+        for size in lengths:
+            retl.append(str(data[pos:pos + size], 'utf-8', 'surrogatepass'))
+            pos += size
+        return retl
+    elif kind == _COL_VALUES:
+        return [_decode_value(reader) for i in range(count)]
+    raise CodecError('unknown column kind %r' % (kind,))
+
+# (message class, field names) -> function that builds messages from columns
+_builders = {}
+
+_BUILDER_TEMPLATE = """
+def build(columns):
+    new = msg_cls.__new__
+    retl = []
+    append = retl.append
+    for %(values)s in zip(*columns):
+        msg = new(msg_cls)
+%(assignments)s
+        append(msg)
+    return retl
+"""
+
+def _get_builder(msg_cls, field_names):
+    """returns function that turns columns into messages. Generated so that
+    the fields are set with plain attribute assignments instead of setattr()
+    """
+    builder = _builders.get((msg_cls, field_names), None)
+    if builder is None:
+        known_fields = _get_fields(msg_cls)
+        for name in field_names:
+            if name not in known_fields:
+                raise CodecError('%s does not have field %s' % (_class_name(msg_cls), name))
+        values = ['v%d' % (i,) for i in range(len(field_names))]
+        source = _BUILDER_TEMPLATE % {
+            'values': ', '.join(values) + ',',
+            'assignments': '\n'.join('        msg.%s = %s' % (name, value) for name, value in zip(field_names, values)),
+        }
+        namespace = {'msg_cls': msg_cls}
+        exec(source, namespace)
+        builder = _builders[(msg_cls, field_names)] = namespace['build']
+    return builder
+
+def decode_batch(data):
+    """returns list of messages from bytes, bytearray or memoryview
+    created by encode_batch()
+    """
+    reader = _Reader(data)
+    magic, version, count = reader.unpack(_HEADER)
+    if magic != MAGIC:
+        raise CodecError('not an encoded message batch')
+    if version != VERSION:
+        raise CodecError('unsupported message batch version %d' % (version,))
+
+    classes_count, = reader.unpack(_U32)
+    classes = [_resolve_class(name) for name in _decode_column(reader, classes_count)]
+    if classes_count > 1:
+        msg_classes = [classes[i] for i in reader.unpack_array(_index_format(classes_count), count)]
+    else:
+        msg_classes = classes * count
+
+    fields_count, = reader.unpack(_U32)
+    field_names = _decode_column(reader, fields_count)
+    columns = [_decode_column(reader, count) for name in field_names]
+
+    if classes_count == 1 and count and '__dict__' not in field_names and \
+            not any([_MISSING in column for column in columns]):
+        # the usual case, every message has all the fields of the same class
+        return _get_builder(classes[0], tuple(field_names))(columns)
+
+    msgs = [msg_cls.__new__(msg_cls) for msg_cls in msg_classes]
+    for name, column in zip(field_names, columns):
+        if name == '__dict__':
+            for msg, value in zip(msgs, column):
+                if value is not _MISSING:
+                    msg.__dict__.update(value)
+            continue
+
+        if _MISSING in column:
+            for msg, value in zip(msgs, column):
+                if value is not _MISSING:
+                    setattr(msg, name, value)
+        else:
+            for msg, value in zip(msgs, column):
+                setattr(msg, name, value)
+
+    return msgs
+
+def decode(data):
+    msgs = decode_batch(data)
+    if len(msgs) != 1:
+        raise CodecError('expected a single message, got %d' % (len(msgs),))
+    return msgs[0]
+
+def write_batch(fd, msgs):
+    """writes encoded batch of messages to a binary file"""
+    data = encode_batch(msgs)
+    fd.write(_FRAME.pack(len(data)))
+    fd.write(data)
+
+def read_batch(fd):
+    """reads the next batch written by write_batch() from a binary file.
+    returns None at the end of the file
+    """
+    header = fd.read(_FRAME.size)
+    if not header:
+        return None
+    if len(header) != _FRAME.size:
+        raise CodecError('batch is truncated')
+    size, = _FRAME.unpack(header)
+    data = fd.read(size)
+    if len(data) != size:
+        raise CodecError('batch is truncated')
+    return decode_batch(data)
@@ -1,19 +1,23 @@
 import os
 import sys
+import copy
+import glob
 import json
+import mmap
 import time
 import logging
 import datetime
+import importlib
 import threading
 import setproctitle
 import multiprocessing
 
 import os.path
 
+from . import inotify
+from . import queueing
 from . import state_manager
 
-import cProfile
-
 class ImplementMe(Exception):
     pass
 
@@ -38,6 +42,20 @@ def broadcast_test_decorator(broadcast_func):
     return _broadcast_test_decorator
 
 class Message(object):
+    """single log message that travels through the graph.
+
+    Fixed fields are kept in slots so that messages would stay small when
+    there are a lot of them in flight. extradata is None until something
+    actually has to store data there.
+    Subclasses can add protocol specific fields by declaring them in their
+    own __slots__ and listing the ones that should be filled from the
+    extra_params given to the constructor in EXTRA_FIELDS.
+    """
+    # depth is only used by the test mode to indent the message trace
+    __slots__ = ('timestamp', 'host', 'content', 'group', 'comment', 'extradata', 'depth')
+
+    EXTRA_FIELDS = ()
+
     def __init__(self, timestamp, host, content, extra_params=None):
         self.timestamp = timestamp
         self.host = host
@@ -45,11 +63,35 @@ class Message(object):
 
         self.extradata = None
         self.comment = None
+        self.group = None
 
         if extra_params is not None:
-            for k, v in extra_params.items():
-                if not hasattr(self, k):
-                    setattr(self, k, v)
+            if self.EXTRA_FIELDS:
+                for k in self.EXTRA_FIELDS:
+                    setattr(self, k, extra_params.get(k, None))
+            elif hasattr(self, '__dict__'):
+                # subclass without __slots__, keep the old behaviour of
+                # exposing all the extra parameters as attributes
+                for k, v in extra_params.items():
+                    if not hasattr(self, k):
+                        setattr(self, k, v)
+
+    def set_extradata(self, key, value):
+        if self.extradata is None:
+            self.extradata = {}
+        self.extradata[key] = value
+
+    def update_extradata(self, d):
+        if self.extradata is None:
+            self.extradata = dict(d)
+        else:
+            self.extradata.update(d)
+
+    def materialize(self):
+        """returns message that has all of its fields decoded.
+        Only lazily parsed messages have to do anything here.
+        """
+        return self
 
     def __str__(self):
         retstr = "h:%s ts:%s content:%s" % (str(self.host), str(self.timestamp), self.content)
@@ -71,6 +113,89 @@ class Message(object):
     def __json__(self):
         return json.dumps(self.dictify(), cls=MsgJSONEncoder)
 
+def message_slots(msg_cls):
+    """returns names of all the slots that instances of msg_cls have
+    """
+    slots = []
+    for cls in reversed(msg_cls.__mro__):
+        for name in cls.__dict__.get('__slots__', ()):
+            if name not in slots:
+                slots.append(name)
+    return slots
+
+def _rebuild_message(msg_cls, state):
+    msg = msg_cls.__new__(msg_cls)
+    for name, value in state.items():
+        setattr(msg, name, value)
+    return msg
+
+class LazyMessageMixin(object):
+    """turns Message class into one that decodes its fields only when
+    they are first accessed.
+
+    Concrete classes have to declare _fields and _time_parser slots and set
+    EAGER_CLS to the message class that they are a lazy version of.
+    _fields holds anything that can be indexed by the field name, usually
+    a regexp match object, and _time_parser is used to turn the raw timestamp
+    into datetime.
+    """
+    __slots__ = ()
+
+    EAGER_CLS = None
+
+    def __init__(self, fields, time_parser):
+        self._fields = fields
+        self._time_parser = time_parser
+
+        self.extradata = None
+        self.comment = None
+        self.group = None
+
+    def __getattr__(self, name):
+        # only called for the slots that haven't been set yet
+        if name == 'timestamp':
+            try:
+                value = self._time_parser(self._fields['timestamp'])
+            except AttributeError:
+                # AttributeError from here would look like a missing attribute
+                raise ValueError('failed to parse timestamp %s' % (self._fields['timestamp'],))
+        elif name in ('host', 'content') or name in self.EXTRA_FIELDS:
+            value = self._fields[name]
+        else:
+            raise AttributeError(name)
+
+        setattr(self, name, value)
+        return value
+
+    def materialize(self):
+        """returns non-lazy copy of this message
+        """
+        eager_cls = self.EAGER_CLS
+        msg = eager_cls.__new__(eager_cls)
+        for name in message_slots(eager_cls):
+            try:
+                setattr(msg, name, getattr(self, name))
+            except AttributeError:
+                continue
+        return msg
+
+    def __reduce__(self):
+        # match objects can't be pickled, so copies of the lazy
+        # message are turned into ordinary messages
+        msg = self.materialize()
+        state = {}
+        for name in message_slots(type(msg)):
+            if hasattr(msg, name):
+                state[name] = getattr(msg, name)
+        return (_rebuild_message, (type(msg), state))
+
+class LazyMessage(LazyMessageMixin, Message):
+    __slots__ = ('_fields', '_time_parser')
+    EAGER_CLS = Message
+
+def _discard(msg):
+    pass
+
 class PunnsilmNode(object):
     """baseclass for all the input, output and intermediate nodes
     """
@@ -89,6 +214,9 @@ class PunnsilmNode(object):
 
         self.name = name
 
+        # runtime counters, only kept when punnsilm.metrics.instrument() has been called
+        self.metrics = None
+
         if test_mode:
             self.broadcast = broadcast_test_decorator(self.broadcast)
 
@@ -112,6 +240,25 @@ class PunnsilmNode(object):
 
         return self._state
 
+    def replace_state(self, state):
+        """replace the whole state, used for the copies of the nodes
+        that run in another process
+        """
+        self._state = state
+
+    def get_stats(self):
+        """returns JSON serializable dictionary of statistics about the work
+        done by this node or None if the node doesn't keep any
+        """
+        return None
+
+    def wait_idle(self, timeout=None):
+        """wait until the messages that have been sent to this node have been processed.
+        Only nodes that process messages in the background have to wait for anything.
+        returns False if the timeout passed before that
+        """
+        return True
+
     def run(self):
         pass
 
@@ -134,20 +281,111 @@ class PunnsilmNode(object):
     def add_output(self, output):
         self.outputs.append(output)
 
+    def remove_output(self, output):
+        self.outputs.remove(output)
+
+    def compile_dispatch(self):
+        """replace broadcast() and broadcast_batch() with versions that are bound
+        to the current outputs. With a single output the messages are handed
+        straight to its append() without going through the loop.
+        Has to be called again if the outputs change.
+        """
+        outputs = tuple(self.outputs)
+        if not outputs:
+            self.broadcast = _discard
+            self.broadcast_batch = _discard
+        elif len(outputs) == 1:
+            self.broadcast = outputs[0].append
+            self.broadcast_batch = outputs[0].append_batch
+        else:
+            appends = tuple(o.append for o in outputs)
+            batch_appends = tuple(o.append_batch for o in outputs)
+
+            def broadcast(msg):
+                for append in appends:
+                    append(msg)
+
+            def broadcast_batch(msgs):
+                for append_batch in batch_appends:
+                    append_batch(msgs)
+
+            self.broadcast = broadcast
+            self.broadcast_batch = broadcast_batch
+
     def broadcast(self, msg):
         """broadcast msg to output nodes
         """
         for o in self.outputs:
             o.append(msg)
 
+    def append_batch(self, msgs):
+        """handle list of messages at once.
+        Nodes that are able to amortize their costs over several messages should
+        override it. The default just feeds messages to append() one by one.
+        """
+        append = self.append
+        for msg in msgs:
+            append(msg)
+
+    def broadcast_batch(self, msgs):
+        """broadcast list of messages to output nodes
+        """
+        for o in self.outputs:
+            o.append_batch(msgs)
+
+# by default monitors send out each message on its own
+DEFAULT_BATCH_SIZE = 1
+# when batching, don't hold back messages for longer than this
+DEFAULT_BATCH_MAX_DELAY_MS = 100
+# publish the read position after at least this many lines have been delivered
+COMMIT_EVERY_N_LINES = 1000
+# monitors that keep state but don't have any saved yet skip the lines
+# that are older than this many seconds before the startup
+STARTUP_CUTOFF_SEC = 60
+
+def _is_older(timestamp, other):
+    """compares timestamps even if only one of them has a timezone,
+    the naive one is taken to be in local time
+    """
+    try:
+        return timestamp < other
+    except TypeError:
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.astimezone()
+        else:
+            other = other.astimezone()
+        return timestamp < other
+
 class Monitor(PunnsilmNode):
     """baseclass for all the message monitors
     """
     def __init__(self, *args, **kwargs):
+        # send out messages in lists of up to batch_size messages or
+        # whatever was collected during batch_max_delay_ms
+        self._batch_size = int(kwargs.pop('batch_size', DEFAULT_BATCH_SIZE))
+        self._batch_max_delay = kwargs.pop('batch_max_delay_ms', DEFAULT_BATCH_MAX_DELAY_MS) / 1000.0
+        self._batch = None
+        # None or 0 disables skipping the old lines when there is no saved state
+        self.startup_cutoff_sec = kwargs.pop('startup_cutoff_sec', STARTUP_CUTOFF_SEC)
+
         PunnsilmNode.__init__(self, *args, **kwargs)
         self.msg_cls = None
         self.continue_from_last_known_position = True
 
+        # last message sent downstream. Its timestamp is copied to the
+        # state only when the position is committed so that lazily parsed
+        # messages wouldn't have to decode it
+        self._last_msg = None
+        # state as of the last time when everything read so far had been
+        # delivered downstream. This is what get_state() returns, the
+        # reading thread replaces it as a whole so it can be read from
+        # any thread
+        self._committed_state = copy.deepcopy(self._state)
+        # set by the monitors that were able to continue from the exact
+        # position where they left off. The others skip the messages that
+        # are older than the last one seen before the restart
+        self._position_restored = False
+
         # what concurrency method to use, might be
         # overriden externally
         self.concurrency_cls = threading.Thread
@@ -157,29 +395,98 @@ class Monitor(PunnsilmNode):
     def stop(self):
         self._want_exit = True
 
+    def get_state(self, key=None):
+        """returns the committed state, see _commit_position()
+        """
+        state = self._committed_state
+        if key is not None:
+            return state.get(key, None)
+
+        return state
+
+    def replace_state(self, state):
+        PunnsilmNode.replace_state(self, state)
+        self._committed_state = state
+
+    def _save_position(self):
+        """copy the current read position into the state
+        """
+        pass
+
+    def _commit_position(self):
+        """called from the reading thread when everything that has been read
+        so far has been delivered downstream
+        """
+        last_msg = self._last_msg
+        if last_msg is not None:
+            self._state['last_msg_ts'] = last_msg.timestamp
+        self._save_position()
+        self._committed_state = copy.deepcopy(self._state)
+
     def run(self):
         self._worker = self.concurrency_cls(target=self._run)
         self._worker.daemon = True
         self._worker.start()
         return self._worker
 
-    def _run(self):
-        # pr = cProfile.Profile()
-        # pr.enable()
+    def _flush_batch(self):
+        """send out messages that have been collected into the current batch
+        """
+        if self._batch:
+            batch = self._batch
+            self._batch = []
+            self.broadcast_batch(batch)
+
+    def _on_idle(self):
+        """called by the readers when there's no new input available
+        and they are going to wait for it
+        """
+        self._flush_batch()
+        self._commit_position()
 
+    def _run(self):
         if self.concurrency_cls != threading.Thread:
             setproctitle.setproctitle('punnsilm: '+self.name)
 
         initialize_mode = True
-
-        if self.continue_from_last_known_position != True:
+        last_seen_msg_ts = None
+        if self.continue_from_last_known_position == True:
+            last_seen_msg_ts = self._state.get('last_msg_ts', None)
+            if last_seen_msg_ts is None and self.startup_cutoff_sec and not self.test_mode:
+                # first run or the state was lost. Don't send the whole existing
+                # file downstream, alerts for the old lines would just be noise
+                last_seen_msg_ts = datetime.datetime.now() - datetime.timedelta(seconds=self.startup_cutoff_sec)
+        if last_seen_msg_ts is None:
+            # nothing to skip
             initialize_mode = False
 
         initialized_ignored_lines = 0
 
+        # test mode prints out the path of each message through the graph
+        # so batching would only get in the way there
+        batch = None
+        if self._batch_size > 1 and not self.test_mode:
+            batch = self._batch = []
+            batch_size, batch_max_delay = self._batch_size, self._batch_max_delay
+            batch_deadline = None
+
+        uncommitted_lines = 0
+
         while 1:
             try:
                 for l in self.read():
+                    # checked before the line is processed so that the
+                    # committed position would point right after the last
+                    # line that was delivered
+                    if self._want_exit:
+                        break
+
+                    # position of the reader points to the start of this line now
+                    uncommitted_lines += 1
+                    if uncommitted_lines >= COMMIT_EVERY_N_LINES and not self._batch:
+                        self._commit_position()
+                        uncommitted_lines = 0
+
                     msg = self.parse_message(l)
                     # if parse_message() returns None then this 
                     # message was filtered out
@@ -187,18 +494,13 @@ class Monitor(PunnsilmNode):
                         if initialize_mode is True:
                             # XXX: having the initialize conditional in the main
                             # loop isn't really optimal 
-                            #last_seen_msg_ts = self.get_state('last_msg_ts')
-
-                            # FIXME: temporary hack until we get saving state working again
-                            # when processes are used for concurrency
-                            last_seen_msg_ts = datetime.datetime.now() - datetime.timedelta(seconds=60)
 
                             # we only have a 1s precision so it's rather probable that there might be
                             # several loglines from the same second than our last_seen_msg_ts of which
                             # we haven't seen some. By using > instead of >= we ensure that we at least see
                             # all the messages once, but some might be seen more than once. 
                             # Adding some seen_line_checksum is one way around this if it ever becomes a problem
-                            if last_seen_msg_ts is not None and last_seen_msg_ts > msg.timestamp:
+                            if not self._position_restored and _is_older(msg.timestamp, last_seen_msg_ts):
                                 # initialize timestamp exists and we are currently seeing records
                                 # that are older than this
                                 initialized_ignored_lines += 1
@@ -206,17 +508,27 @@ class Monitor(PunnsilmNode):
                             initialize_mode = False
                             logging.info("%s: initialize finished. Ignored %d lines" % (str(self), initialized_ignored_lines,))
 
-                        self.broadcast(msg)
-                        self.set_state('last_msg_ts', msg.timestamp)
-                    if self._want_exit:
-                        break
+                        if batch is None:
+                            self.broadcast(msg)
+                        else:
+                            batch = self._batch
+                            if not batch:
+                                batch_deadline = time.monotonic() + batch_max_delay
+                            batch.append(msg)
+                            if len(batch) >= batch_size or time.monotonic() >= batch_deadline:
+                                self._flush_batch()
+                        self._last_msg = msg
             except StopMonitor:
                 logging.info('stop monitor exception seen in %s' % (str(self),))
+                self._flush_batch()
+                self._commit_position()
                 break
             except:
                 logging.exception('unexpected failure in %s' % (str(self),))
-        # pr.disable()
-        # pr.dump_stats('rx.profile')
+            if self._want_exit:
+                self._flush_batch()
+                self._commit_position()
+                break
 
     def parse_message(self, l):
         if self.msg_cls != None:
@@ -224,10 +536,134 @@ class Monitor(PunnsilmNode):
 
         raise ImplementMe
 
+# default size of the blocks that the FileMonitor reads from the file at once
+DEFAULT_READ_BLOCK_SIZE = 1024*1024
+# how long to wait for new data before checking the file again. With inotify
+# we are woken up as soon as something happens so this only matters for the cases
+# where we aren't told about the changes (NFS, filename template changes etc.)
+FILE_POLL_INTERVAL_SEC = 2
+# if there's at least this much unread data in the file when we open it
+# then the backlog is processed through mmap() instead of read() calls
+DEFAULT_CATCH_UP_THRESHOLD = 64*1024*1024
+
+# leading magic bytes of the compressed files that we can read -> module that decompresses them
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'lzma'),
+)
+
+def open_log_file(filename):
+    """opens file for reading in binary mode. Compressed files are recognized
+    by their magic bytes and decompressed on the fly.
+    returns tuple (file object, name of the compression module or None)
+    """
+    fd = open(filename, 'rb')
+    magic = fd.peek(6)[:6]
+    for prefix, module_name in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            fd.close()
+            module = importlib.import_module(module_name)
+            return module.open(filename, 'rb'), module_name
+    return fd, None
+
+class BlockLineReader(object):
+    """reads file like object in large blocks into a reusable buffer
+    and splits the blocks into lines in bulk.
+
+    Incomplete trailing line is carried over to the next read. Byte offset of
+    the lines that have been handed out is kept in the offset attribute by
+    counting so there's no need to call tell() on the underlying file.
+    """
+    def __init__(self, fd, block_size=DEFAULT_READ_BLOCK_SIZE, offset=0, buf=None):
+        self._fd = fd
+        if buf is None:
+            buf = bytearray(block_size)
+        self._buf = buf
+        self._view = memoryview(buf)
+        # readinto1() does at most one read() on the raw stream so we won't
+        # block waiting for the whole buffer to fill up when reading from a pipe
+        self._readinto = getattr(fd, 'readinto1', None) or fd.readinto
+        self._pending = b''
+        self.offset = offset
+
+    def readlines(self):
+        """yields all the complete lines that are currently available
+        returns when EOF is reached
+        """
+        buf, view = self._buf, self._view
+
+        while 1:
+            nbytes = self._readinto(buf)
+            if not nbytes:
+                return
+
+            end = buf.rfind(b'\n', 0, nbytes) + 1
+            if end == 0:
+                # no line end in the whole block, just keep collecting
+                self._pending += view[:nbytes]
+                continue
+
+            if self._pending:
+                data = self._pending + view[:end]
+            else:
+                data = view[:end]
+            self._pending = bytes(view[end:nbytes])
+
+            for l in self._split(data):
+                yield l
+
+    def flush(self):
+        """yields the incomplete trailing line if there is one
+        """
+        if not self._pending:
+            return
+
+        data, self._pending = self._pending, b''
+        try:
+            l = data.decode('utf-8')
+        except UnicodeDecodeError:
+            self.offset += len(data)
+            return
+        yield l
+        self.offset += len(data)
+
+    def _split(self, data):
+        """split block of complete lines into separate lines
+        offset is only advanced once the consumer asks for the next line
+        """
+        try:
+            text = str(data, 'utf-8')
+        except UnicodeDecodeError:
+            # there's some garbage in this block, fall back to decoding
+            # lines one by one so that we would lose only the broken ones
+            for raw_line in bytes(data).split(b'\n')[:-1]:
+                try:
+                    l = raw_line.decode('utf-8')
+                except UnicodeDecodeError:
+                    self.offset += len(raw_line) + 1
+                    continue
+                yield l + '\n'
+                self.offset += len(raw_line) + 1
+            return
+
+        lines = text.split('\n')
+        lines.pop()
+
+        if len(text) == len(data):
+            # pure ASCII, so character count equals byte count
+            for l in lines:
+                yield l + '\n'
+                self.offset += len(l) + 1
+        else:
+            for l in lines:
+                yield l + '\n'
+                self.offset += len(l.encode('utf-8')) + 1
+
 class FileMonitor(Monitor):
     """monitors single logfile for changes"""
 
-    def __init__(self, filename=None, stop_on_EOF=False, msg_cls=None, **kwargs):
+    def __init__(self, filename=None, stop_on_EOF=False, msg_cls=None, read_block_size=DEFAULT_READ_BLOCK_SIZE, use_inotify=True, catch_up_threshold=DEFAULT_CATCH_UP_THRESHOLD, include_rotated=False, **kwargs):
         Monitor.__init__(self, **kwargs)
 
         if filename is None:
@@ -235,10 +671,38 @@ class FileMonitor(Monitor):
 
         self.filename = filename
         self._stop_on_EOF = stop_on_EOF
+        # with stop_on_EOF read the rotated generations of the file before the file itself
+        self._include_rotated = include_rotated
+        # 0 or None falls back to reading the file line by line
+        self._read_block_size = read_block_size
 
         self._fd = None
+        # name of the compression module if the file is compressed
+        self._compression = None
+        self._reader = None
+        # position of the next line when reading line by line without the BlockLineReader
+        self._line_offset = 0
+        # (file, reader) of the previous generation of the file after a
+        # rotation, read until the end before it's closed
+        self._rotated = None
+        # buffer for the BlockLineReader, might be shared with other
+        # monitors that take turns reading from the same thread
+        self._read_buffer = None
         self._last_file_size = None
 
+        # 0 or None disables the mmap() based catch-up
+        self._catch_up_threshold = catch_up_threshold
+        # file size at the time we decided to do the catch-up
+        self._catch_up_end = None
+
+        self._use_inotify = use_inotify
+        # created lazily from the thread/process that does the reading
+        self._inotify = None
+        # path -> watch descriptor
+        self._watches = {}
+        # set when the watches have to be renewed
+        self._watches_stale = True
+
         if msg_cls != None:
             self.msg_cls = msg_cls
 
@@ -252,7 +716,12 @@ class FileMonitor(Monitor):
         """
         if self.filename == '-':
             # currently I don't know of any cases where reopening stdin would be needed
-            self._fd = sys.stdin
+            if self._read_block_size:
+                self._fd = sys.stdin.buffer
+                if self._reader is None:
+                    self._reader = BlockLineReader(self._fd, self._read_block_size)
+            else:
+                self._fd = sys.stdin
             return 
 
         # this might actualy change the filename if there are format strings inside it
@@ -282,69 +751,536 @@ class FileMonitor(Monitor):
 
         # probably file was rotated
         logging.info('reopening file %s' % (filename,))
-        if self._fd:
-            self._fd.close()
 
         try:
-            self._fd = open(filename, "rb")
+            fd, compression = open_log_file(filename)
         except (OSError, IOError) as e:
             # throttle a bit
             time.sleep(1)
             raise
 
-        stat_struct = os.fstat(self._fd.fileno())
+        stat_struct = os.fstat(fd.fileno())
         inode_nr = stat_struct.st_ino
-        last_inode_nr = self.get_state('inode_nr')
+        last_inode_nr = self._state.get('inode_nr', None)
         file_size = stat_struct.st_size
-        last_saved_pos = self.get_state('file_pos')
-        if last_inode_nr == inode_nr and last_saved_pos < file_size:
-            self._fd.seek(last_saved_pos)
+        last_saved_pos = self._state.get('file_pos', None)
+
+        old_fd, old_reader = self._fd, self._reader
+        if old_fd is not None:
+            if last_inode_nr == inode_nr:
+                # same file, continue from the last line that was handed out
+                old_fd.close()
+                last_saved_pos = old_reader.offset if old_reader is not None else self._line_offset
+            else:
+                if self._rotated is not None:
+                    self._rotated[0].close()
+                # writers might still add something to the old file, read() drains it
+                self._rotated = (old_fd, old_reader)
+        self._fd, self._compression = fd, compression
+
+        # on startup the saved position is used only when we are told to continue from it
+        if (last_inode_nr == inode_nr and last_saved_pos is not None
+                and (old_fd is not None or self.continue_from_last_known_position)):
+            if self._compression is not None:
+                # position is in the decompressed stream so we can't compare
+                # it to the file size. Seeking past the end just gets us to EOF.
+                fd.seek(last_saved_pos)
+                self._position_restored = True
+            elif last_saved_pos <= file_size:
+                fd.seek(last_saved_pos)
+                self._position_restored = True
         self.set_state('inode_nr', inode_nr)
+        self._line_offset = fd.tell()
+        self._watches_stale = True
+
+        if self._read_block_size:
+            self._reader = BlockLineReader(self._fd, self._read_block_size, offset=self._fd.tell(), buf=self._read_buffer)
+            if (self._catch_up_threshold and self._compression is None
+                    and (file_size - self._reader.offset) >= self._catch_up_threshold):
+                logging.info('%s: %d bytes of backlog in %s, catching up' % (
+                    str(self), file_size - self._reader.offset, filename))
+                self._catch_up_end = file_size
         self._save_file_state()
 
         return True
 
     def _save_file_state(self):
-        fpos = self._fd.tell()
+        if self._reader is not None:
+            fpos = self._reader.offset
+        else:
+            fpos = self._line_offset
         self.set_state('file_pos', fpos)
 
-    def read(self):
-        self._maybe_reopen()
-
-        WRITE_POSITION_EVERY_N_LINES = 100
+    def _save_position(self):
+        if self._fd is not None and self.filename != '-':
+            self._save_file_state()
 
-        state_lines = 0
+    def _read_lines(self):
+        """yields lines that are currently available in the file
+        returns on EOF
+        """
+        if self._reader is not None:
+            if self._catch_up_end is not None:
+                for l in self._catch_up():
+                    yield l
+            for l in self._reader.readlines():
+                yield l
+            return
+
+        fd = self._fd
         while 1:
             try:
-                l = self._fd.readline()
+                l = fd.readline()
             except IOError:
                 logging.exception('closing file %s' % (str(self.filename),))
-                self._fd.close()
+                fd.close()
+                # force reopen on the next try
+                self._last_file_size = None
+                return
 
             if not l:
-                if self._stop_on_EOF:
-                    logging.info('monitor %s stopped' % (self.name,))
-                    raise StopMonitor("EOF seen on input")
-
-                if not self._maybe_reopen():
-                    # there was no need to reopen the file so there's nothing to do
-                    # just sleep a bit to pass the time
-                    logging.debug("no new data in %s last_size=%s" % (str(self), str(self._last_file_size)))
-                    time.sleep(2)
-                continue
-
-            state_lines += 1
-            if state_lines >= WRITE_POSITION_EVERY_N_LINES:
-                self._save_file_state()
-                state_lines = 0
+                return
 
             if not isinstance(l, str):
                 try:
                     l = l.decode('utf-8')
                 except:
+                    self._line_offset = fd.tell()
                     continue
 
             yield l
+            # like with the BlockLineReader the position moves past
+            # the line once the consumer is done with it
+            if fd is not sys.stdin:
+                self._line_offset = fd.tell()
+
+    def _drain_rotated(self):
+        """yields whatever was written to the previous generation of the file
+        after we last read it and closes it
+        """
+        if self._rotated is None:
+            return
+
+        fd, reader = self._rotated
+        self._rotated = None
+        try:
+            if reader is not None:
+                for l in reader.readlines():
+                    yield l
+                # incomplete line isn't going to be completed anymore
+                for l in reader.flush():
+                    yield l
+            else:
+                for l in fd:
+                    try:
+                        yield l.decode('utf-8')
+                    except UnicodeDecodeError:
+                        continue
+        except (OSError, IOError, ValueError) as e:
+            logging.warn('%s: failed to read the rotated file: %s' % (str(self), str(e)))
+        finally:
+            fd.close()
+
+    def _catch_up(self):
+        """process the backlog between the current position and the file size we saw on open
+        by mapping it into memory and splitting it into lines straight from the mapping.
+        Normal reading continues from the end of the last complete line afterwards.
+        """
+        reader = self._reader
+        start, end = reader.offset, self._catch_up_end
+        self._catch_up_end = None
+
+        # mapping has to start at the multiple of the allocation granularity
+        map_start = start - (start % mmap.ALLOCATIONGRANULARITY)
+        try:
+            mm = mmap.mmap(self._fd.fileno(), end - map_start, access=mmap.ACCESS_READ, offset=map_start)
+        except (OSError, ValueError) as e:
+            logging.warn('%s: unable to mmap() %s, reading it normally: %s' % (str(self), self.filename, str(e)))
+            return
+
+        view = memoryview(mm)
+        try:
+            pos, size = start - map_start, end - map_start
+            while pos < size:
+                chunk_end = mm.rfind(b'\n', pos, min(pos + self._read_block_size, size)) + 1
+                if chunk_end == 0:
+                    # line longer than the block size
+                    chunk_end = mm.find(b'\n', pos, size) + 1
+                    if chunk_end == 0:
+                        # incomplete line at the end, leave it for the normal reader
+                        break
+
+                chunk = view[pos:chunk_end]
+                try:
+                    for l in reader._split(chunk):
+                        yield l
+                finally:
+                    chunk.release()
+                pos = chunk_end
+        finally:
+            # continue from the last line that was handed out even if
+            # we were interrupted half way
+            self._fd.seek(reader.offset)
+            view.release()
+            try:
+                mm.close()
+            except BufferError:
+                # somebody still holds a view into the mapping, let the GC deal with it
+                pass
+
+        logging.info('%s: catch-up finished at %d' % (str(self), reader.offset))
+
+    def _list_rotated(self):
+        """returns rotated generations of the file (file.1, file.2.gz, file-20140411 etc.)
+        sorted from the oldest to the newest by their modification time
+        """
+        filename = time.strftime(self.filename)
+        paths = set(glob.glob(glob.escape(filename) + '.*') + glob.glob(glob.escape(filename) + '-*'))
+        paths = [p for p in paths if os.path.isfile(p)]
+        return sorted(paths, key=lambda p: os.path.getmtime(p))
+
+    def _read_rotated(self):
+        """yields all the lines from the rotated generations of the file
+        """
+        for path in self._list_rotated():
+            logging.info('%s: reading rotated file %s' % (str(self), path))
+            fd, compression = open_log_file(path)
+            try:
+                reader = BlockLineReader(fd, self._read_block_size or DEFAULT_READ_BLOCK_SIZE, buf=self._read_buffer)
+                for l in reader.readlines():
+                    yield l
+                for l in reader.flush():
+                    yield l
+            finally:
+                fd.close()
+
+    def read(self):
+        if self._stop_on_EOF and self._include_rotated and self.filename != '-':
+            for l in self._read_rotated():
+                yield l
+            # don't repeat it if we are restarted after some failure
+            self._include_rotated = False
+
+        if self._maybe_reopen():
+            for l in self._drain_rotated():
+                yield l
+
+        while 1:
+            for l in self._read_lines():
+                yield l
+
+            if self._stop_on_EOF:
+                if self._reader is not None:
+                    # last line of the file might not be terminated
+                    for l in self._reader.flush():
+                        yield l
+                self._on_idle()
+                logging.info('monitor %s stopped' % (self.name,))
+                raise StopMonitor("EOF seen on input")
+
+            if self._maybe_reopen():
+                # file was rotated
+                for l in self._drain_rotated():
+                    yield l
+            else:
+                # there was no need to reopen the file so there's nothing to do
+                # just wait until something changes
+                logging.debug("no new data in %s last_size=%s" % (str(self), str(self._last_file_size)))
+                self._on_idle()
+                self._wait_for_changes(FILE_POLL_INTERVAL_SEC)
+                if self._want_exit:
+                    return
+
+    def _init_inotify(self):
+        try:
+            self._inotify = inotify.Inotify()
+        except inotify.InotifyUnavailable as e:
+            logging.info('%s: inotify not available (%s), falling back to polling' % (str(self), str(e)))
+            self._use_inotify = False
+            return False
+        return True
+
+    def _update_watches(self):
+        """ensure that we are watching the currently monitored file and its directory.
+        Watches on the file are tied to the inode so they have to be renewed after
+        rotation and the filename itself might change if it's a strftime() template.
+        """
+        filename = time.strftime(self.filename)
+        if not self._watches_stale and filename in self._watches:
+            return True
+        dirname = os.path.dirname(filename) or '.'
+
+        wanted = {
+            filename: inotify.FILE_EVENTS,
+            dirname: inotify.DIRECTORY_EVENTS,
+        }
+
+        for path, wd in list(self._watches.items()):
+            if path not in wanted:
+                self._inotify.rm_watch(wd)
+                del self._watches[path]
+
+        for path, mask in wanted.items():
+            try:
+                wd = self._inotify.add_watch(path, mask)
+            except OSError as e:
+                # file might not exist at the moment. Directory watch will
+                # tell us when it appears.
+                logging.debug('%s: unable to watch %s: %s' % (str(self), path, str(e)))
+                self._watches.pop(path, None)
+                continue
+
+            old_wd = self._watches.get(path, None)
+            if old_wd is not None and old_wd != wd:
+                # path points to a new inode now, stop listening to the old one
+                self._inotify.rm_watch(old_wd)
+            self._watches[path] = wd
+
+        self._watches_stale = False
+        return len(self._watches) > 0
+
+    def _wait_for_changes(self, timeout):
+        """block until the monitored file might have changed or timeout seconds pass
+        """
+        if self.filename == '-' or not self._use_inotify:
+            time.sleep(timeout)
+            return
+
+        if self._inotify is None and not self._init_inotify():
+            time.sleep(timeout)
+            return
+
+        if not self._update_watches():
+            time.sleep(timeout)
+            return
+
+        self._inotify.wait(timeout)
 
 class Output(PunnsilmNode):
     pass
+
+# how long stop() waits for the workers of PooledOutput to write out what is left
+POOL_STOP_TIMEOUT_SEC = 30
+# upper limit for the delay between the retries
+POOL_MAX_RETRY_BACKOFF_SEC = 60
+
+class PooledOutput(Output):
+    """baseclass for the outputs that do blocking I/O.
+    Messages are put into a bounded queue and written out by a pool of worker
+    threads, so that a slow sink wouldn't hold up the nodes that feed it.
+    With more than one worker the messages might be written out of order.
+
+    Subclasses implement write(resource, msg) or write_batch(resource, msgs)
+    and optionally setup_worker() that returns whatever the worker needs for
+    writing (connection, session) and teardown_worker(resource) that releases it.
+    Failed writes are retried with exponential backoff, every retry gets a new
+    resource. A batch that fails halfway is written again as a whole.
+
+    Following configuration options are understood, defaults come from the
+    class attributes:
+
+     - workers: number of worker threads
+     - queue_size: how many messages can wait in the queue
+     - queue_policy: what to do when the queue is full, see punnsilm.queueing
+     - max_batch: worker writes at most this many messages at once
+     - batch_interval_sec: worker waits this long after each batch so that
+       more messages would accumulate
+     - batch_delay_sec: worker waits this long after the first message of a
+       batch arrives before writing it, so that the ones right behind it
+       would go into the same batch
+     - retries: how many times to retry a failed write before giving up on the messages
+     - retry_backoff_sec: delay before the first retry, doubled for every next one
+    """
+    DEFAULT_WORKERS = 1
+    DEFAULT_QUEUE_SIZE = queueing.DEFAULT_QUEUE_SIZE
+    DEFAULT_QUEUE_POLICY = queueing.POLICY_BLOCK
+    DEFAULT_MAX_BATCH = 100
+    DEFAULT_BATCH_INTERVAL_SEC = 0
+    DEFAULT_BATCH_DELAY_SEC = 0
+    DEFAULT_RETRIES = 3
+    DEFAULT_RETRY_BACKOFF_SEC = 1.0
+
+    def __init__(self, **kwargs):
+        Output.__init__(self, name=kwargs.get('name', None), outputs=kwargs.get('outputs', None),
+            test_mode=kwargs.get('test_mode', False))
+
+        self._workers_count = int(kwargs.get('workers', self.DEFAULT_WORKERS))
+        if self._workers_count < 1:
+            raise Exception('%s needs at least one worker' % (self.name,))
+        self._queue_args = {
+            'maxsize': int(kwargs.get('queue_size', self.DEFAULT_QUEUE_SIZE)),
+            'policy': kwargs.get('queue_policy', self.DEFAULT_QUEUE_POLICY),
+        }
+        if self._queue_args['policy'] == queueing.POLICY_SPILL:
+            raise Exception('spill policy is not supported by %s, use the queue option of the node instead' % (self.name,))
+        self._max_batch = int(kwargs.get('max_batch', self.DEFAULT_MAX_BATCH))
+        self._batch_interval = float(kwargs.get('batch_interval_sec', self.DEFAULT_BATCH_INTERVAL_SEC))
+        self._batch_delay = float(kwargs.get('batch_delay_sec', self.DEFAULT_BATCH_DELAY_SEC))
+        self._retries = int(kwargs.get('retries', self.DEFAULT_RETRIES))
+        self._retry_backoff = float(kwargs.get('retry_backoff_sec', self.DEFAULT_RETRY_BACKOFF_SEC))
+
+        self._pool_queue = None
+        self._pool_workers = []
+        # worker threads don't survive fork() so we have to know
+        # in which process the current ones were started
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+        self._stopping = threading.Event()
+        # set while we are dropping messages so that we wouldn't flood the log
+        self._dropping = False
+        self.pool_counters = {
+            'written': 0,
+            'retried': 0,
+            'failed': 0,
+        }
+
+    def setup_worker(self):
+        """returns resource that the worker passes to write_batch()
+        """
+        return None
+
+    def teardown_worker(self, resource):
+        """release resource created by setup_worker()
+        """
+        pass
+
+    def write(self, resource, msg):
+        raise ImplementMe
+
+    def write_batch(self, resource, msgs):
+        """write out list of messages. Outputs that are able to do it more
+        efficiently than one by one should override it
+        """
+        for msg in msgs:
+            self.write(resource, msg)
+
+    def describe_batch(self, msgs):
+        """returns what to log about the messages that are given up on
+        """
+        return '%d messages' % (len(msgs),)
+
+    def _start_workers(self):
+        with self._pool_lock:
+            if self._pool_pid == os.getpid():
+                return
+            self._stopping.clear()
+            self._pool_queue = queueing.OverflowQueue(**self._queue_args)
+            self._pool_workers = []
+            for i in range(self._workers_count):
+                worker = threading.Thread(target=self._work, name='punnsilm: %s worker %d' % (self.name, i))
+                worker.daemon = True
+                worker.start()
+                self._pool_workers.append(worker)
+            self._pool_pid = os.getpid()
+
+    def append(self, msg):
+        self.append_batch([msg])
+
+    def append_batch(self, msgs):
+        if self._pool_pid != os.getpid():
+            self._start_workers()
+
+        if self._pool_queue.put(msgs):
+            if not self._dropping:
+                logging.warn('%s: queue is full, dropping messages' % (str(self),))
+                self._dropping = True
+        elif self._dropping:
+            logging.warn('%s: queue has room again. %d messages dropped so far' % (
+                str(self), self._pool_queue.counters['dropped']))
+            self._dropping = False
+
+    def _work(self):
+        queue = self._pool_queue
+        resource = None
+        while 1:
+            msgs = queue.get(self._max_batch)
+            if msgs is None:
+                # closed and empty
+                break
+            if self._batch_delay and len(msgs) < self._max_batch:
+                # returns right away once we have been asked to stop
+                self._stopping.wait(self._batch_delay)
+                more = queue.get(self._max_batch - len(msgs), timeout=0)
+                if more is not None:
+                    msgs = msgs + more
+            try:
+                resource = self._write_with_retries(resource, msgs)
+            finally:
+                queue.task_done(len(msgs))
+            if self._batch_interval:
+                self._stopping.wait(self._batch_interval)
+
+        self._teardown(resource)
+
+    def _teardown(self, resource):
+        if resource is None:
+            return
+        try:
+            self.teardown_worker(resource)
+        except Exception:
+            logging.exception('%s: failed to release worker resources' % (str(self),))
+
+    def _write_with_retries(self, resource, msgs):
+        """returns resource that can be used for the next batch
+        """
+        attempt = 0
+        while 1:
+            try:
+                if resource is None:
+                    resource = self.setup_worker()
+                self.write_batch(resource, msgs)
+                self.pool_counters['written'] += len(msgs)
+                return resource
+            except Exception as e:
+                # start over with a fresh connection or whatever it was
+                self._teardown(resource)
+                resource = None
+
+                if attempt >= self._retries:
+                    try:
+                        description = self.describe_batch(msgs)
+                    except Exception:
+                        description = '%d messages' % (len(msgs),)
+                    logging.exception('%s: giving up on %s' % (str(self), description))
+                    self.pool_counters['failed'] += len(msgs)
+                    return None
+
+                delay = min(self._retry_backoff * 2 ** attempt, POOL_MAX_RETRY_BACKOFF_SEC)
+                attempt += 1
+                self.pool_counters['retried'] += 1
+                logging.warn('%s: writing %d messages failed (%s), retry %d in %.1f seconds' % (
+                    str(self), len(msgs), e, attempt, delay))
+                # no point in waiting for long once we have been asked to stop
+                self._stopping.wait(delay)
+
+    def get_queue_counters(self):
+        if self._pool_queue is None:
+            return {}
+        return self._pool_queue.get_counters()
+
+    def get_stats(self):
+        stats = dict(self.pool_counters)
+        stats['queue'] = self.get_queue_counters()
+        return stats
+
+    def wait_idle(self, timeout=None):
+        if self._pool_pid != os.getpid():
+            return True
+        return self._pool_queue.join(timeout)
+
+    def stop(self):
+        """write out whatever is left in the queue and stop the workers
+        """
+        if self._pool_pid != os.getpid():
+            return
+        self._stopping.set()
+        self._pool_queue.close()
+        deadline = time.time() + POOL_STOP_TIMEOUT_SEC
+        for worker in self._pool_workers:
+            worker.join(max(deadline - time.time(), 0))
+            if worker.is_alive():
+                logging.warn('%s: %s did not finish in time, %d messages left unwritten' % (
+                    str(self), worker.name, len(self._pool_queue)))
+                break
+        # anything sent after this starts new workers
+        self._pool_pid = None
@@ -0,0 +1,147 @@
+import os
+import errno
+import struct
+import ctypes
+import select
+import ctypes.util
+
+# minimal ctypes binding to the Linux inotify API. Just enough for
+# FileMonitor to be woken up when the file it tails changes instead of
+# polling it every couple of seconds.
+
+# see inotify(7) for the meaning of these
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+FILE_EVENTS = IN_MODIFY | IN_MOVE_SELF | IN_DELETE_SELF
+DIRECTORY_EVENTS = IN_CREATE | IN_MOVED_TO
+
+READ_SIZE = 64*1024
+
+# struct inotify_event without the trailing name
+_EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+class InotifyUnavailable(Exception):
+    pass
+
+def _get_libc():
+    global _libc
+
+    if _libc is None:
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise InotifyUnavailable('libc not found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise InotifyUnavailable('inotify is not supported by the libc')
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+
+    return _libc
+
+class Inotify(object):
+    """wraps single inotify instance
+    """
+    def __init__(self):
+        self._libc = _get_libc()
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise InotifyUnavailable('inotify_init1 failed: %s' % (os.strerror(err),))
+        self._fd = fd
+
+    def fileno(self):
+        return self._fd
+
+    def add_watch(self, path, mask):
+        """returns watch descriptor, raises OSError on failure
+        """
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        # fails with EINVAL if the kernel already dropped the watch
+        # because the watched file was deleted. We don't care about that.
+        self._libc.inotify_rm_watch(self._fd, wd)
+
+    def drain(self):
+        """read and throw away all the pending events
+        We don't need to know what happened, only that something did.
+        """
+        while 1:
+            try:
+                if not os.read(self._fd, READ_SIZE):
+                    return
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+    def read_wds(self):
+        """read all the pending events and return set of watch descriptors
+        that they were for. Queue overflow shows up as watch descriptor -1.
+        """
+        wds = set()
+        header_size = _EVENT_HEADER.size
+        while 1:
+            try:
+                data = os.read(self._fd, READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return wds
+                raise
+
+            if not data:
+                return wds
+
+            pos = 0
+            while pos + header_size <= len(data):
+                wd, mask, cookie, name_len = _EVENT_HEADER.unpack_from(data, pos)
+                wds.add(wd)
+                pos += header_size + name_len
+
+    def wait_wds(self, timeout):
+        """like wait() but returns set of watch descriptors that had events,
+        empty if the timeout passed
+        """
+        try:
+            readable, _, _ = select.select([self._fd], [], [], timeout)
+        except InterruptedError:
+            return set()
+
+        if not readable:
+            return set()
+
+        return self.read_wds()
+
+    def wait(self, timeout):
+        """block until some event arrives or timeout seconds pass.
+        returns True if there were events
+        """
+        try:
+            readable, _, _ = select.select([self._fd], [], [], timeout)
+        except InterruptedError:
+            return False
+
+        if not readable:
+            return False
+
+        self.drain()
+        return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
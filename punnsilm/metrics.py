@@ -0,0 +1,343 @@
+import sys
+import json
+import time
+import bisect
+import logging
+import threading
+
+import http.server
+
+from . import core
+
+# Runtime counters of the nodes.
+#
+# instrument() replaces append() and append_batch() of the nodes with
+# wrappers that count the messages and measure the time spent in the node.
+# Time is exclusive: whatever the node's outputs spend on the messages in the
+# same thread is subtracted, so a node only pays for its own work. For that
+# the wrappers keep a stack of the nodes that are currently running in each
+# thread and messages handed to an output are counted as sent out by the node
+# on top of the stack. Objects that only pass messages on (queues, asyncio
+# proxies, other partitions) are wrapped as hops which count the messages
+# for the sender but don't measure anything themselves.
+#
+# Counters are updated without locking, with several threads feeding the
+# same node an occasional increment might get lost.
+
+# upper bounds of the processing time histogram buckets in seconds,
+# observed once per append() or append_batch() call
+HISTOGRAM_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+
+DEFAULT_METRICS_HOST = '127.0.0.1'
+
+_COUNTERS = ('messages_in', 'messages_out', 'calls', 'errors')
+
+_local = threading.local()
+_clock = time.perf_counter
+
+class NodeMetrics(object):
+    """counters of a single node
+    """
+    def __init__(self, name, node_type):
+        self.name = name
+        self.node_type = node_type
+        self.messages_in = 0
+        self.messages_out = 0
+        self.calls = 0
+        self.errors = 0
+        self.time_total = 0.0
+        # last one is for everything above the largest bucket
+        self.histogram = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        # returns counters of the queue in front of the node, if it has one
+        self.queue_counters = None
+
+    def observe(self, count, elapsed):
+        self.messages_in += count
+        self.calls += 1
+        self.time_total += elapsed
+        self.histogram[bisect.bisect_left(HISTOGRAM_BUCKETS, elapsed)] += 1
+
+    def snapshot(self):
+        """returns JSON serializable copy of the counters
+        """
+        retd = {
+            'type': self.node_type,
+            'time_total': self.time_total,
+            'histogram': list(self.histogram),
+        }
+        for key in _COUNTERS:
+            retd[key] = getattr(self, key)
+        if self.queue_counters is not None:
+            counters = self.queue_counters()
+            retd['queue_depth'] = counters.get('depth', 0) + counters.get('spilled_depth', 0)
+            retd['dropped'] = counters.get('dropped', 0)
+        return retd
+
+def _frames():
+    try:
+        return _local.frames
+    except AttributeError:
+        _local.frames = []
+        return _local.frames
+
+def _count_error(metrics):
+    """count the exception that is being handled, but only in the node that raised it
+    """
+    exc = sys.exc_info()[1]
+    if getattr(_local, 'failed', None) is not exc:
+        _local.failed = exc
+        metrics.errors += 1
+
+def _wrap(metrics, func, batch):
+    """returns version of append() or append_batch() that updates metrics
+    """
+    def measured(arg):
+        frames = _frames()
+        if frames:
+            caller = frames[-1]
+            if caller[0] is metrics:
+                # node feeding itself, for example append_batch() calling append()
+                return func(arg)
+            caller[0].messages_out += len(arg) if batch else 1
+
+        frame = [metrics, 0.0]
+        frames.append(frame)
+        start = _clock()
+        try:
+            return func(arg)
+        except Exception:
+            _count_error(metrics)
+            raise
+        finally:
+            elapsed = _clock() - start
+            frames.pop()
+            if frames:
+                frames[-1][1] += elapsed
+            metrics.observe(len(arg) if batch else 1, elapsed - frame[1])
+    return measured
+
+def _wrap_hop(metrics, func, batch):
+    """returns version of append() or append_batch() of an object that only passes
+    the messages on. The time spent there is left to the sender
+    """
+    def hop(arg):
+        frames = _frames()
+        if frames:
+            caller = frames[-1]
+            if caller[0] is metrics:
+                return func(arg)
+            caller[0].messages_out += len(arg) if batch else 1
+
+        frames.append([metrics, 0.0])
+        try:
+            return func(arg)
+        finally:
+            frames.pop()
+    return hop
+
+def _wrap_source(metrics, func, batch):
+    """returns version of broadcast() or broadcast_batch() of an input node
+    """
+    def source(arg):
+        frames = _frames()
+        if frames and frames[-1][0] is metrics:
+            return func(arg)
+
+        metrics.messages_in += len(arg) if batch else 1
+        frames.append([metrics, 0.0])
+        try:
+            return func(arg)
+        finally:
+            frames.pop()
+    return source
+
+def wrap_coroutine(metrics, func):
+    """returns version of coroutine function that takes a list of messages and
+    updates metrics. The time includes whatever the coroutine was waiting for
+    """
+    async def measured(msgs):
+        start = _clock()
+        try:
+            return await func(msgs)
+        except Exception:
+            metrics.errors += 1
+            raise
+        finally:
+            metrics.observe(len(msgs), _clock() - start)
+    return measured
+
+def instrument(nodes):
+    """give every node its metrics and wrap append() and append_batch().
+    Has to be done before the graph is started. Nodes whose dispatch has
+    been compiled have to run compile_dispatch() again afterwards so that
+    they would call the wrappers.
+    """
+    for node in nodes:
+        inner = getattr(node, 'node', None)
+        if inner is None or not isinstance(inner, core.PunnsilmNode):
+            inner = node
+        metrics = NodeMetrics(node.name, inner.__class__.__name__)
+        inner.metrics = metrics
+
+        if isinstance(inner, core.Monitor):
+            continue
+
+        if inner is not node:
+            # queue in front of the node, the node itself runs in the worker thread
+            metrics.queue_counters = getattr(node, 'get_queue_counters', None)
+            wrap_hops([node], metrics)
+        elif hasattr(inner, 'get_queue_counters'):
+            # node with a queue of its own
+            metrics.queue_counters = inner.get_queue_counters
+
+        if hasattr(inner, 'append'):
+            # asyncio only nodes might not have it
+            inner.append = _wrap(metrics, inner.append, False)
+        inner.append_batch = _wrap(metrics, inner.append_batch, True)
+
+def instrument_sources(nodes):
+    """wrap broadcast() and broadcast_batch() of the input nodes.
+    Has to be called after the dispatch of the inputs has been compiled
+    """
+    for node in nodes:
+        metrics = getattr(node, 'metrics', None)
+        if metrics is None or not isinstance(node, core.Monitor):
+            continue
+        node.broadcast = _wrap_source(metrics, node.broadcast, False)
+        node.broadcast_batch = _wrap_source(metrics, node.broadcast_batch, True)
+
+def wrap_hops(objs, metrics=None):
+    """wrap append() and append_batch() of objects that pass messages on to somewhere else.
+    Gives the object metrics of its own if none are given, those are not reported anywhere
+    """
+    for obj in objs:
+        hop_metrics = metrics
+        if hop_metrics is None:
+            hop_metrics = NodeMetrics(obj.name, obj.__class__.__name__)
+        obj.append = _wrap_hop(hop_metrics, obj.append, False)
+        obj.append_batch = _wrap_hop(hop_metrics, obj.append_batch, True)
+
+def collect(nodes):
+    """returns node name -> snapshot of the metrics for the nodes that have them
+    """
+    retd = {}
+    for node in nodes:
+        metrics = getattr(node, 'metrics', None)
+        if metrics is not None:
+            retd[node.name] = metrics.snapshot()
+    return retd
+
+def merge(snapshots):
+    """merge list of node name -> snapshot dictionaries into one.
+    Counters of the nodes that appear more than once are summed up
+    """
+    retd = {}
+    for node_snapshots in snapshots:
+        for name, snapshot in node_snapshots.items():
+            if name not in retd:
+                retd[name] = dict(snapshot, histogram=list(snapshot['histogram']))
+                continue
+            merged = retd[name]
+            for key in _COUNTERS + ('time_total', 'queue_depth', 'dropped'):
+                if key in snapshot:
+                    merged[key] = merged.get(key, 0) + snapshot[key]
+            merged['histogram'] = [a + b for a, b in zip(merged['histogram'], snapshot['histogram'])]
+    return retd
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_prometheus(snapshots):
+    """returns metrics in the Prometheus text exposition format
+    """
+    retl = []
+
+    def add_metric(metric, metric_type, help_text, key):
+        retl.append('# HELP punnsilm_node_%s %s' % (metric, help_text))
+        retl.append('# TYPE punnsilm_node_%s %s' % (metric, metric_type))
+        for name in sorted(snapshots):
+            snapshot = snapshots[name]
+            if key in snapshot:
+                retl.append('punnsilm_node_%s{node="%s"} %s' % (metric, _escape_label(name), snapshot[key]))
+
+    add_metric('messages_in_total', 'counter', 'Messages received by the node.', 'messages_in')
+    add_metric('messages_out_total', 'counter', 'Messages handed to the outputs of the node, once per output.', 'messages_out')
+    add_metric('errors_total', 'counter', 'Exceptions raised by the node.', 'errors')
+    add_metric('dropped_total', 'counter', 'Messages dropped by the queue of the node.', 'dropped')
+    add_metric('queue_depth', 'gauge', 'Messages waiting in the queue of the node.', 'queue_depth')
+
+    metric = 'punnsilm_node_processing_seconds'
+    retl.append('# HELP %s Time spent in the node itself per call, excluding its outputs.' % (metric,))
+    retl.append('# TYPE %s histogram' % (metric,))
+    for name in sorted(snapshots):
+        snapshot = snapshots[name]
+        label = _escape_label(name)
+        cumulative = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS + ('+Inf',), snapshot['histogram']):
+            cumulative += count
+            retl.append('%s_bucket{node="%s",le="%s"} %d' % (metric, label, bound, cumulative))
+        retl.append('%s_sum{node="%s"} %r' % (metric, label, snapshot['time_total']))
+        retl.append('%s_count{node="%s"} %d' % (metric, label, snapshot['calls']))
+
+    return '\n'.join(retl) + '\n'
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            body = format_prometheus(self.server.get_metrics())
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/metrics.json':
+            body = json.dumps(self.server.get_metrics(), sort_keys=True, indent=4)
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug('metrics request: %s' % (format % args,))
+
+class MetricsServer(object):
+    """serves the metrics over HTTP. /metrics gives them in the Prometheus text
+    format and /metrics.json as JSON.
+    get_metrics is called on every request and should return node name -> snapshot
+    """
+    def __init__(self, get_metrics, address=None):
+        host, port = parse_address(address)
+        self._server = http.server.ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        self._server.daemon_threads = True
+        self._server.get_metrics = get_metrics
+        self.address = self._server.server_address
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='punnsilm: metrics')
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info('serving metrics on http://%s:%d/metrics' % self.address[:2])
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+def parse_address(address):
+    """parses [host:]port, host defaults to the loopback address
+    """
+    if not address:
+        return DEFAULT_METRICS_HOST, 0
+    address = str(address)
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+    else:
+        host, port = DEFAULT_METRICS_HOST, address
+    try:
+        return host or DEFAULT_METRICS_HOST, int(port)
+    except ValueError:
+        raise Exception('invalid metrics address %s, expected [host:]port' % (address,))
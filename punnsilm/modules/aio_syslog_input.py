@@ -0,0 +1,136 @@
+import copy
+import asyncio
+import logging
+
+from punnsilm import aio
+from punnsilm.core import Monitor, Message
+from punnsilm.modules.syslog_input import SyslogMonitor
+
+class SyslogDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, monitor):
+        self.monitor = monitor
+
+    def datagram_received(self, data, addr):
+        try:
+            msg = self.monitor._parse(data.strip())
+        except Exception:
+            logging.exception('failed to handle message!')
+            return
+        if msg is not None:
+            # UDP senders can't be slowed down anyway
+            self.monitor.broadcast(msg)
+
+class AsyncSyslogMonitor(Monitor):
+    """syslog server that runs on the asyncio event loop. Many connections
+    share the loop instead of each of them getting a thread of its own.
+    """
+    _PARSERMAP = SyslogMonitor._PARSERMAP
+    _MY_ARGS = SyslogMonitor._MY_ARGS
+
+    name = 'aio_syslog_input'
+
+    def __init__(self, *args, **kwargs):
+        """
+        known parameters:
+          network_protocol: (tcp|udp)
+          syslog_protocol: rfc3164
+          address: (hostname|ip, port)
+        """
+        argd = copy.copy(kwargs)
+        for arg in self._MY_ARGS:
+            if arg in argd:
+                del argd[arg]
+
+        Monitor.__init__(self, *args, **argd)
+
+        self._address = kwargs['address']
+        syslog_protocol = kwargs['syslog_protocol']
+        parser = self._PARSERMAP.get(syslog_protocol, None)
+        if parser == None:
+            raise Exception("syslog_protocol %s is unknown. Use one of %s" % (
+                syslog_protocol, self._PARSERMAP.keys()))
+
+        self._parser = parser
+        self._network_protocol = kwargs['network_protocol'].lower()
+
+        if self._network_protocol not in ('tcp', 'udp'):
+            raise Exception("unknown network protocol requested %s" % (
+                self._network_protocol,))
+
+        self._loop = None
+        self._stopped = None
+        # address that we are actually listening on, useful if port 0 was requested
+        self.bound_address = None
+
+    def _parse(self, data):
+        message = data.decode('utf-8')
+        msg_dict = self._parser.parse(message)
+        if msg_dict is None:
+            logging.debug('failed to parse:'+str(message))
+            return None
+
+        msg = Message(msg_dict['timestamp'], msg_dict['hostname'], msg_dict['content'])
+        self._last_msg = msg
+        return msg
+
+    async def arun(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        if self._want_exit:
+            return
+
+        host, port = self._address
+        if self._network_protocol == 'tcp':
+            server = await asyncio.start_server(self._handle_connection, host, port)
+            self.bound_address = server.sockets[0].getsockname()[:2]
+            close = server.close
+        else:
+            transport, _ = await self._loop.create_datagram_endpoint(
+                lambda: SyslogDatagramProtocol(self), local_addr=(host, port))
+            self.bound_address = transport.get_extra_info('sockname')[:2]
+            close = transport.close
+        logging.info('%s: listening on %s' % (str(self), str(self.bound_address)))
+
+        try:
+            await self._stopped.wait()
+        finally:
+            close()
+        logging.info('monitor %s stopped' % (self.name,))
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while not self._want_exit:
+                line = await reader.readline()
+                if not line:
+                    return
+
+                line = line.strip()
+                if not line:
+                    continue
+
+                try:
+                    msg = self._parse(line)
+                except Exception:
+                    logging.exception('failed to handle message!')
+                    continue
+                if msg is not None:
+                    await aio.abroadcast(self, msg)
+        finally:
+            writer.close()
+
+    async def astop(self):
+        self._want_exit = True
+        if self._stopped is not None:
+            self._stopped.set()
+
+    def stop(self):
+        self._want_exit = True
+        if self._loop is not None and self._stopped is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    def run(self):
+        # outside of the asyncio runtime the node runs a loop of its own
+        self._worker = self.concurrency_cls(target=asyncio.run, args=(self.arun(),))
+        self._worker.daemon = True
+        self._worker.start()
+        return self._worker
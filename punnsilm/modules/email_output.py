@@ -1,14 +1,13 @@
 from __future__ import unicode_literals
 
-import time
 import logging
-import threading
 
 import smtplib
 
 from email.mime.text import MIMEText
 
 from punnsilm import core
+from punnsilm import queueing
 
 try:
     unicode
@@ -24,87 +23,52 @@ DEFAULT_SMTP_PORT = 25
 DEFAULT_SEND_INTERVAL = 60
 
 DEFAULT_MAX_QUEUE_SIZE = MAX_MESSAGES_TO_SEND
+# how long to gather messages before sending out the first mail of a batch
 SENDOUT_WORKER_INTERVAL_SEC = 30
 
-class EmailOutput(core.Output):
-    """class that sends out all the incoming messages by e-mail
+class EmailOutput(core.PooledOutput):
+    """class that sends out all the incoming messages by e-mail.
+    Messages that arrive within send_interval are collected into a single mail,
+    the ones that don't fit into it are dropped. Mail isn't sent out right after
+    the first message either, the ones that arrive within the following
+    SENDOUT_WORKER_INTERVAL_SEC go into the same mail.
     """
     name = 'smtp_output'
 
+    DEFAULT_QUEUE_SIZE = DEFAULT_MAX_QUEUE_SIZE
+    DEFAULT_QUEUE_POLICY = queueing.POLICY_DROP_NEWEST
+    DEFAULT_MAX_BATCH = MAX_MESSAGES_TO_SEND
+    DEFAULT_BATCH_DELAY_SEC = SENDOUT_WORKER_INTERVAL_SEC
+    # the server might have accepted the mail before the failure,
+    # retrying could send out duplicate alerts
+    DEFAULT_RETRIES = 0
+
     def __init__(self, **kwargs):
-        core.Output.__init__(self, name=kwargs['name'])
         for parameter in ('from_address', 'addresses'):
             if parameter not in kwargs:
                 logging.error('missing mandatory parameter %s' % (parameter,))
                 raise Exception
 
-        self._send_thr = None
+        self._send_interval = kwargs.pop('send_interval', DEFAULT_SEND_INTERVAL)
+        kwargs.setdefault('batch_interval_sec', self._send_interval)
+        core.PooledOutput.__init__(self, **kwargs)
 
         self._from_address = kwargs.get('from_address', None)
         self._addresses = kwargs['addresses']
-        self._send_interval = kwargs.get('send_interval', DEFAULT_SEND_INTERVAL)
         self._smtp_server = kwargs.get('smtp_server', DEFAULT_SMTP_SERVER)
         self._smtp_port = kwargs.get('smtp_port', DEFAULT_SMTP_PORT)
 
         if len(self._addresses) < 1:
             logging.warn('no recipients defined in smtp_output %s' % (self.name,))
 
-        self._last_send_time_uts = None
-
-        self._reset_mqueue()
-
-    def run(self):
-        core.Output.run(self)
-        self._start_worker()
-
-    def _start_worker(self):
-        self._send_thr = threading.Thread(target=self._sendout_worker)
-        self._send_thr.daemon = True
-        self._send_thr.start()
-
-    def _allowed_to_send_next_mail(self):
-        if self._last_send_time_uts is None:
-            return True
-
-        if (self._last_send_time_uts + self._send_interval) < time.time():
-            return True
-
-        logging.info("[%s] sending e-mail isn't allowed yet" % (self.name,))
-
-        return False
-
-    def _sendout_worker(self):
-        logging.info("mail worker thread for %s started!" % (self.name,))
-
-        while 1:
-            logging.info("[%s] email sender tick. queue len=%d interval=%d" % ( 
-                self.name, len(self._mqueue), self._send_interval)
-            )
-
-            if len(self._mqueue) > 0 and self._allowed_to_send_next_mail():
-                try:
-                    self._send_mail()
-                except:
-                    logging.exception('%s failed to send mail' % (self.name,))
-
-            time.sleep(SENDOUT_WORKER_INTERVAL_SEC)
-
-    def _reset_mqueue(self):
-        self._mqueue = []
-
-    def _send_mail(self):
-        self._last_send_time_uts = time.time()
-
+    def write_batch(self, resource, msgs):
         if len(self._addresses) < 1:
             # configuring e-mail output without actual recipients does not make much sense
             # in general but it is often convenient to just comment out the recipients
             # if you do not want to get e-mail temporarily
             return
 
-        body = self._create_message_body()
-        # FIXME: if we dropped messages because there were to many then we should log it
-        # or the e-mail should say so at the very first line
-        self._reset_mqueue()
+        body = self._create_message_body(msgs)
         toaddrs = self._addresses
 
         # Create a text/plain message
@@ -112,33 +76,22 @@ class EmailOutput(core.Output):
 
         me = self._from_address
         you = ','.join(toaddrs)
-        
+
         msg['Subject'] = '[punnsilm:%s] alert' % (self.name,)
         msg['From'] = me
         msg['To'] = you
-        
+
         s = smtplib.SMTP(self._smtp_server, self._smtp_port)
         s.sendmail(me, toaddrs, msg.as_string())
         s.quit()
 
         logging.info("mail sent from %s to %s" % (self.name, you))
 
-    def _create_message_body(self):
-        msg = 'Following interesting log entries were seen (limit:%d qsize:%d):\n' % (
-            MAX_MESSAGES_TO_SEND, len(self._mqueue)
+    def _create_message_body(self, msgs):
+        msg = 'Following interesting log entries were seen (limit:%d count:%d):\n' % (
+            MAX_MESSAGES_TO_SEND, len(msgs)
         )
-        return msg + '\n'.join(unicode(x) for x in self._mqueue[:MAX_MESSAGES_TO_SEND])
-
-    def append(self, msg):
-        if len(self._mqueue) > DEFAULT_MAX_QUEUE_SIZE:
-            # XXX: in some cases it might be a good idea to log queue overflows
-            # but we certainly shouldn't do that for every incoming message.
-            return None
-
-        if self._send_thr is None:
-            # FIXME: temporary workaround for the case when graph is started with concurrency_method=processes
-            # in that case there will be multiple copies of the same graph node (one for each input)
-            # but the worker is started only in the first instance.
-            self.run()
-
-        self._mqueue.append(msg)
+        dropped = self.get_queue_counters().get('dropped', 0)
+        if dropped:
+            msg += '%d entries have been dropped since the start because there were too many\n' % (dropped,)
+        return msg + '\n'.join(unicode(x) for x in msgs)
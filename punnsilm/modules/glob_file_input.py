@@ -0,0 +1,274 @@
+import os
+import glob
+import time
+import logging
+
+from punnsilm import inotify
+from punnsilm.core import FileMonitor, StopMonitor, FILE_POLL_INTERVAL_SEC
+from punnsilm.modules.syslog_file_input import SyslogFileMonitor
+
+# look for new and removed files at least this often even if inotify
+# didn't tell us about any changes in the directories
+DEFAULT_RESCAN_INTERVAL_SEC = 10
+
+class GlobChildMonitor(FileMonitor):
+    """follows single file on behalf of the GlobFileMonitor.
+    Doesn't run on its own, parent calls poll() from its loop. State of
+    the child is stored inside the state of the parent.
+    """
+    def __init__(self, path, files_state, **kwargs):
+        self.path = path
+        self._files_state = files_state
+        # set once the file has disappeared
+        self.gone = False
+        # FileMonitor runs the filename through strftime()
+        FileMonitor.__init__(self, filename=path.replace('%', '%%'), use_inotify=False, **kwargs)
+
+    def _read_state(self):
+        self._state = self._files_state.setdefault(self.path, {})
+
+    def poll(self):
+        """yields lines that have been added to the file since the last call
+        """
+        if self._fd is not None:
+            for l in self._read_lines():
+                yield l
+
+        if not os.path.exists(self.path):
+            # deleted or rotated away, parent drains whatever is left
+            self.gone = True
+            return
+
+        if self._maybe_reopen():
+            for l in self._drain_rotated():
+                yield l
+            for l in self._read_lines():
+                yield l
+
+    def drain(self):
+        """yields everything that is left in the file including the
+        unterminated last line and closes it
+        """
+        if self._fd is None:
+            return
+
+        for l in self._drain_rotated():
+            yield l
+        for l in self._read_lines():
+            yield l
+        if self._reader is not None:
+            for l in self._reader.flush():
+                yield l
+
+        self._save_file_state()
+        self.close()
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+        if self._rotated is not None:
+            self._rotated[0].close()
+            self._rotated = None
+
+class GlobFileMonitor(SyslogFileMonitor):
+    """follows all the files matching a glob pattern from a single loop
+    """
+    name = 'glob_file_monitor'
+
+    def __init__(self, **kwargs):
+        self._rescan_interval = kwargs.pop('rescan_interval', DEFAULT_RESCAN_INTERVAL_SEC)
+        SyslogFileMonitor.__init__(self, **kwargs)
+
+        # path -> GlobChildMonitor
+        self._children = {}
+        # watch descriptor -> path
+        self._watched_paths = {}
+        self._next_rescan = 0
+        self._rescan_wanted = True
+        # positions are kept for every file, the files that we haven't seen before are read from the start
+        self._position_restored = True
+
+        # children read in turns so they can all use the same buffer
+        if self._read_block_size:
+            self._read_buffer = bytearray(self._read_block_size)
+
+    def _save_position(self):
+        SyslogFileMonitor._save_position(self)
+        for child in self._children.values():
+            if child._fd is not None:
+                child._save_file_state()
+
+    def _add_child(self, path):
+        child = GlobChildMonitor(path, self._state.setdefault('files', {}),
+            name='%s[%s]' % (self.name, path),
+            read_block_size=self._read_block_size,
+            catch_up_threshold=self._catch_up_threshold)
+        child.continue_from_last_known_position = self.continue_from_last_known_position
+        child._read_buffer = self._read_buffer
+        self._children[path] = child
+        logging.info('%s: following %s' % (str(self), path))
+
+    def _remove_child(self, child):
+        for l in child.drain():
+            yield l
+
+        del self._children[child.path]
+        self._state['files'].pop(child.path, None)
+        wd = self._watches.pop(child.path, None)
+        if wd is not None:
+            self._inotify.rm_watch(wd)
+            self._watched_paths.pop(wd, None)
+        logging.info('%s: %s is gone' % (str(self), child.path))
+
+    def _rescan(self):
+        """start following new files that match the pattern and drop the ones
+        that have disappeared. Yields the last lines of the removed files.
+        """
+        self._rescan_wanted = False
+        self._next_rescan = time.time() + self._rescan_interval
+
+        paths = set(p for p in glob.glob(self.filename) if os.path.isfile(p))
+
+        for path in paths:
+            if path not in self._children:
+                self._add_child(path)
+
+        for path, child in list(self._children.items()):
+            if path not in paths:
+                for l in self._remove_child(child):
+                    yield l
+
+        # forget the state of the files that were removed while we weren't running
+        files_state = self._state.setdefault('files', {})
+        for path in list(files_state.keys()):
+            if path not in self._children:
+                del files_state[path]
+
+        self._update_watches()
+
+    def read(self):
+        if self.filename == '-':
+            for l in SyslogFileMonitor.read(self):
+                yield l
+            return
+
+        # None means that we don't know what changed and have to check everything
+        changed = None
+
+        while 1:
+            if self._rescan_wanted or time.time() >= self._next_rescan:
+                for l in self._rescan():
+                    yield l
+                changed = None
+
+            if changed is None:
+                children = list(self._children.values())
+            else:
+                children = [self._children[p] for p in changed if p in self._children]
+
+            for child in children:
+                try:
+                    for l in child.poll():
+                        yield l
+                except (OSError, IOError) as e:
+                    logging.warn('%s: failed to read %s: %s' % (str(self), child.path, str(e)))
+                    child.gone = True
+
+                if child.gone:
+                    for l in self._remove_child(child):
+                        yield l
+
+            if self._stop_on_EOF:
+                for child in list(self._children.values()):
+                    for l in child.drain():
+                        yield l
+                self._on_idle()
+                logging.info('monitor %s stopped' % (self.name,))
+                raise StopMonitor("EOF seen on input")
+
+            self._on_idle()
+            changed = self._wait_for_changes(FILE_POLL_INTERVAL_SEC)
+            if self._want_exit:
+                return
+
+    def _list_directories(self):
+        """returns directories where new matching files or directories leading
+        to them might appear. For /var/log/remote/*/syslog these are
+        /var/log/remote and all of its subdirectories.
+        """
+        dirs = set()
+        pattern = os.path.dirname(self.filename) or '.'
+        while 1:
+            for dirname in glob.glob(pattern):
+                if os.path.isdir(dirname):
+                    dirs.add(dirname)
+
+            parent = os.path.dirname(pattern) or '.'
+            if not glob.has_magic(pattern) or parent == pattern:
+                break
+            pattern = parent
+
+        return dirs
+
+    def _update_watches(self):
+        """watch all the followed files and the directories where new ones might appear
+        """
+        if not self._use_inotify:
+            return False
+        if self._inotify is None and not self._init_inotify():
+            return False
+
+        wanted = {}
+        for dirname in self._list_directories():
+            wanted[dirname] = inotify.DIRECTORY_EVENTS
+        for path in self._children:
+            wanted[path] = inotify.FILE_EVENTS
+
+        for path, wd in list(self._watches.items()):
+            if path not in wanted:
+                self._inotify.rm_watch(wd)
+                del self._watches[path]
+
+        for path, mask in wanted.items():
+            try:
+                wd = self._inotify.add_watch(path, mask)
+            except OSError as e:
+                logging.debug('%s: unable to watch %s: %s' % (str(self), path, str(e)))
+                self._watches.pop(path, None)
+                continue
+
+            old_wd = self._watches.get(path, None)
+            if old_wd is not None and old_wd != wd:
+                # path points to a new inode now
+                self._inotify.rm_watch(old_wd)
+            self._watches[path] = wd
+
+        self._watched_paths = dict((wd, path) for path, wd in self._watches.items())
+        return len(self._watches) > 0
+
+    def _wait_for_changes(self, timeout):
+        """block until some of the files might have changed or timeout seconds pass.
+        returns set of the paths that have changed or None if we don't know
+        """
+        if not self._use_inotify or not self._watches:
+            time.sleep(timeout)
+            return None
+
+        wds = self._inotify.wait_wds(timeout)
+        if not wds or -1 in wds:
+            # timeout or event queue overflow
+            return None
+
+        changed = set()
+        for wd in wds:
+            path = self._watched_paths.get(wd, None)
+            if path is None:
+                continue
+            if path in self._children:
+                changed.add(path)
+            elif os.path.isdir(path):
+                # something was created in one of the directories
+                self._rescan_wanted = True
+
+        return changed
@@ -4,25 +4,24 @@ import requests
 
 from punnsilm import core
 
-METHODMAP = {
-    'GET': requests.get,
-    'POST': requests.post,
-}
+KNOWN_METHODS = ('GET', 'POST')
 
-class HTTPOutput(core.Output):
-    """sends message out over HTTP
+class HTTPOutput(core.PooledOutput):
+    """sends message out over HTTP.
+    Every worker keeps its own session so that the connections are reused.
+    Requests that fail with a server error are retried.
     """
     name = 'http_output'
 
     def __init__(self, **kwargs):
-        core.Output.__init__(self, name=kwargs['name'])
+        core.PooledOutput.__init__(self, **kwargs)
 
         if 'uri' not in kwargs:
             raise Exception("mandatory option uri not specified for node %s" % (self.name,))
         self._uri = kwargs['uri']
 
         self._method = kwargs.get('method', 'POST')
-        if self._method not in METHODMAP:
+        if self._method not in KNOWN_METHODS:
             raise Exception("unknown method %s configured for node %s" % (
                     str(self._method), self.name))
 
@@ -32,12 +31,20 @@ class HTTPOutput(core.Output):
         if self._format not in ('formencode', 'json'):
             raise Exception("unknown format %s configured for node %s" % (
                     str(self._format), self.name))
-        
-    def append(self, msg):
+
+    def setup_worker(self):
+        return requests.Session()
+
+    def teardown_worker(self, session):
+        session.close()
+
+    def write(self, session, msg):
         if self._format == 'formencode':
             data = msg.dictify()
         elif self._format == 'json':
             data = msg.__json__()
 
-        response = METHODMAP[self._method](self._uri, data=data, auth=self._basicauth)
+        response = session.request(self._method, self._uri, data=data, auth=self._basicauth)
         logging.debug(response.text)
+        if response.status_code >= 500:
+            response.raise_for_status()
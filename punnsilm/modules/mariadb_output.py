@@ -9,44 +9,47 @@ from punnsilm import core
 # if more than this many seconds have passed from the last query
 TRY_PING_AFTER_INACTIVITY_SECONDS = 60
 
-class MariadbOutput(core.Output):
+class MariadbOutput(core.PooledOutput):
     """Allows you to execute MySQL/MariaDB queries with parameters from the log message.
-    Useful for example for writing authentication events to SQL
+    Useful for example for writing authentication events to SQL.
+    Every worker has a connection of its own, failed queries are retried over a new connection.
     """
     name = 'mariadb_output'
 
     def __init__(self, **kwargs):
-        core.Output.__init__(self, name=kwargs['name'])
+        core.PooledOutput.__init__(self, **kwargs)
 
         self._query = kwargs['query']
         self._arguments = kwargs['arguments']
         self._connection_params = kwargs['connection_parameters']
 
-        self._sql_connection = None
-        self._last_query_time = None
-
         # try to connect on startup so problems with config would be apparent sooner
-        self._get_connection()
-
-    def _get_connection(self):
-        if self._sql_connection:
-            if TRY_PING_AFTER_INACTIVITY_SECONDS and \
-                (self._last_query_time + TRY_PING_AFTER_INACTIVITY_SECONDS) < time.time():
-                self._sql_connection.ping()
-            self._last_query_time = time.time()
-            return self._sql_connection
+        self.teardown_worker(self.setup_worker())
 
+    def setup_worker(self):
         logging.info("creating new connection to the MariaDB")
-        self._sql_connection = pymysql.connect(**self._connection_params)
-        self._sql_connection.autocommit(True)
-        self._last_query_time = time.time()
-
-        return self._sql_connection
-    
-    def _execute_query(self, msg):
-        con = self._get_connection()
-        cur = con.cursor()
+        connection = pymysql.connect(**self._connection_params)
+        connection.autocommit(True)
+        # connection and the time of its last query
+        return [connection, time.time()]
 
+    def teardown_worker(self, resource):
+        connection = resource[0]
+        try:
+            connection.close()
+        except Exception:
+            # connection is probably broken already, that's why we are here
+            pass
+
+    def _get_connection(self, resource):
+        connection, last_query_time = resource
+        if TRY_PING_AFTER_INACTIVITY_SECONDS and \
+            (last_query_time + TRY_PING_AFTER_INACTIVITY_SECONDS) < time.time():
+            connection.ping()
+        resource[1] = time.time()
+        return connection
+
+    def _get_parameters(self, msg):
         parameters = []
         for arg in self._arguments:
             # XXX: there aren't any sanity checks here on purpose
@@ -58,17 +61,31 @@ class MariadbOutput(core.Output):
 
             parameters.append(value)
 
+        return parameters
+
+    def write(self, resource, msg):
+        cur = self._get_connection(resource).cursor()
+
+        parameters = self._get_parameters(msg)
+
         logging.debug("%s %s" % (self._query, str(parameters)))
 
-        try:
-            cur.execute(self._query, parameters)
-        except:
-            # reset the connection just in case. It will be automatically
-            # reconnected. We actually should only do it when the connection
-            # is problematic but I don't know which exception types cover that
-            # besides BrokenPipeError
-            self._sql_connection = None
-            logging.exception('query failed: %s %s' % (self._query, str(parameters)))
-
-    def append(self, msg):
-        self._execute_query(msg)
+        cur.execute(self._query, parameters)
+
+    def write_batch(self, resource, msgs):
+        if len(msgs) == 1:
+            return self.write(resource, msgs[0])
+
+        cur = self._get_connection(resource).cursor()
+
+        parameter_list = [self._get_parameters(msg) for msg in msgs]
+
+        logging.debug("%s %d rows" % (self._query, len(parameter_list)))
+
+        # pymysql turns INSERT ... VALUES queries into a single multirow INSERT
+        cur.executemany(self._query, parameter_list)
+
+    def describe_batch(self, msgs):
+        # failed queries are logged once, after the retries have been used up
+        parameter_list = [self._get_parameters(msg) for msg in msgs]
+        return 'query: %s %s' % (self._query, str(parameter_list))
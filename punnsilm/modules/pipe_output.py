@@ -67,13 +67,14 @@ class Pipeline:
     def write(self, val):
         self._pipe.write(bytes(val, 'utf-8'))
 
-class PipeOutput(core.Output):
-    """writes messages to the Unix pipe
+class PipeOutput(core.PooledOutput):
+    """writes messages to the Unix pipe.
+    All the workers share the same pipe so there's rarely a reason to have more than one.
     """
     name = 'pipe_output'
 
     def __init__(self, **kwargs):
-        core.Output.__init__(self, name=kwargs['name'])
+        core.PooledOutput.__init__(self, **kwargs)
         self._path = kwargs.get('path', None)
         self._cmd = kwargs.get('command', None)
         if self._path is None and self._cmd is None:
@@ -90,8 +91,7 @@ class PipeOutput(core.Output):
         else:
             self._pipe = Pipeline(self._cmd, self._bufsize)
 
-    def append(self, msg):
-        val = unicode(msg)
-        if self._append_newline:
-            val += "\n"
+    def write_batch(self, resource, msgs):
+        separator = "\n" if self._append_newline else ""
+        val = separator.join(unicode(msg) for msg in msgs) + separator
         self._pipe.write(val)
@@ -55,7 +55,7 @@ class Rewriter(core.PunnsilmNode):
 
         return retl
             
-    def append(self, msg):
+    def _rewrite(self, msg):
         for rule in self._rules:
             key, pattern, replacement, options, func = rule
             if key.startswith("."):
@@ -65,4 +65,11 @@ class Rewriter(core.PunnsilmNode):
             elif hasattr(msg, key):
                 setattr(msg, key, func(pattern, replacement, getattr(msg, key)))
 
+    def append(self, msg):
+        self._rewrite(msg)
         self.broadcast(msg)
+
+    def append_batch(self, msgs):
+        for msg in msgs:
+            self._rewrite(msg)
+        self.broadcast_batch(msgs)
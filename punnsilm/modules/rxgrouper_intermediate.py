@@ -3,6 +3,12 @@ import copy
 import json
 import time
 import logging
+import operator
+import threading
+import collections
+import multiprocessing
+
+import setproctitle
 
 try:
     import regex as re
@@ -11,7 +17,20 @@ except ImportError:
     import re
 #import re
 
+# literals of the patterns are found with the parser of the re module
+import re as stdlib_re
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 from punnsilm import core
+from punnsilm import codec
 
 STATS_ROOT = "/tmp/"
 STATS_WRITE_EVERY_X_MSGS = 50000
@@ -26,6 +45,49 @@ KNOWN_MATCH_TYPES = {
 }
 DEFAULT_MATCH_TYPE = 'all'
 MEASURE_RX_PERF = False
+# with adaptive ordering the patterns and groups are sorted by their
+# matches per second spent on them after every this many messages
+ADAPTIVE_ORDER_EVERY_X_MSGS = 10000
+# consecutive patterns of a group that match the same field are compiled
+# into a single alternation so that a message is matched against all of
+# them with a single call
+COMBINE_RX_LISTS = True
+# patterns are skipped if the message doesn't contain the longest literal
+# string that every match of the pattern has to contain
+USE_LITERAL_PREFILTER = True
+# shorter literals are too common to filter anything out
+MIN_LITERAL_LENGTH = 3
+# if the prefilter leaves at most this many patterns out of a combined
+# chunk then these are matched one by one instead of the whole chunk
+PREFILTER_MAX_SEPARATE_MATCHES = 3
+# groups whose patterns all start with a literal prefix of at least this
+# length are only matched against messages that start with one of these
+USE_PREFIX_INDEX = True
+MIN_PREFIX_LENGTH = 3
+
+# how many results of matching messages with the same field values are kept
+# for replaying, 0 disables the cache
+DEFAULT_MATCH_CACHE_SIZE = 0
+# results older than this are matched again
+DEFAULT_MATCH_CACHE_TTL_SEC = 300
+# hit rate of the cache is checked after this many lookups ...
+MATCH_CACHE_WINDOW = 1000
+# ... and if it's lower than this the cache is bypassed ...
+MATCH_CACHE_MIN_HIT_RATE = 0.1
+# ... for this many messages before trying it again
+MATCH_CACHE_BYPASS_MSGS = 20000
+# key of the cache counters in the statistics
+MATCH_CACHE_STATS_KEY = '_match_cache'
+
+# by default messages are matched in the thread that sends them to us
+DEFAULT_WORKERS = 0
+# with worker processes messages with the same value of this field always go
+# to the same worker, so their order is preserved
+DEFAULT_SHARD_KEY = 'host'
+# how many message lists can wait for each worker before the senders block
+WORKER_QUEUE_SIZE = 100
+# how long to wait for the workers to finish when stopping
+WORKER_STOP_TIMEOUT_SEC = 10
 
 if hasattr(time, "perf_counter"):
     pcounter = time.perf_counter
@@ -35,6 +97,18 @@ else:
 # regexp string id (memptr.) -> compiled rx. mappings
 rx_cachemap = {}
 
+# flags of a pattern that doesn't set any global flags inline
+DEFAULT_RX_FLAGS = re.compile('', re.UNICODE).flags
+# numbered backreferences and conditionals, the numbers would be off inside the combined pattern
+NUMBERED_GROUP_REFERENCE_RX = re.compile(r'\\[1-9]|\\g<\d|\(\?\(\d')
+# syntax of the regex module that the parser of the re module would take for literals:
+# fuzzy matching constraints and POSIX character classes
+REGEX_ONLY_SYNTAX_RX = re.compile(r'(?<!\\)\{[^\d,}]|\[\[|\[:')
+
+_REPEAT_OPS = tuple(op for op in (getattr(sre_parse, name, None)
+    for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')) if op is not None)
+_ATOMIC_GROUP = getattr(sre_parse, 'ATOMIC_GROUP', None)
+
 # XXX: functions usable in the configuration
 def match_field(msg, fieldname, rx):
     rx_c = rx_cachemap.get(rx)
@@ -50,8 +124,7 @@ def match_field(msg, fieldname, rx):
     match_obj = rx_c.match(msg.extradata.get(fieldname, ''))
     if match_obj is None:
         return False
-    for k,v in match_obj.groupdict().items():
-        msg.extradata[k] = v
+    msg.update_extradata(match_obj.groupdict())
     return True
 
 def AND(_, *args):
@@ -82,23 +155,497 @@ class Group(object):
     def __str__(self):
         return '<%s: %s>' % (self.__class__.__name__, self.name)
 
+class CombinedMatch(object):
+    """match of a single pattern out of the combined alternation,
+    looks like the match object of that pattern. Numbered groups of the
+    pattern are shifted by offset in the combined one, the group at the
+    offset itself wraps the whole pattern.
+    """
+    __slots__ = ('match_obj', 're', '_offset', '_names')
+
+    # these depend on the numbering of the combined pattern
+    UNSUPPORTED = frozenset(('lastindex', 'lastgroup', 'regs', 'expand'))
+
+    def __init__(self, match_obj, offset, rx_c, names):
+        self.match_obj = match_obj
+        self.re = rx_c
+        self._offset = offset
+        self._names = names
+
+    def _index(self, group):
+        """returns index of the group in the combined pattern
+        """
+        if isinstance(group, int):
+            if group < 0 or group > self.re.groups:
+                raise IndexError('no such group')
+            return self._offset + group
+        if group not in self.re.groupindex:
+            # might still be a group of some other pattern in the combined one
+            raise IndexError('no such group')
+        return group
+
+    def group(self, *args):
+        if not args:
+            return self.match_obj.group(self._offset)
+        if len(args) == 1:
+            return self.match_obj.group(self._index(args[0]))
+        return tuple(self.match_obj.group(self._index(arg)) for arg in args)
+
+    def __getitem__(self, group):
+        return self.group(group)
+
+    def groups(self, default=None):
+        group = self.match_obj.group
+        retl = []
+        for i in range(self._offset + 1, self._offset + self.re.groups + 1):
+            value = group(i)
+            retl.append(default if value is None else value)
+        return tuple(retl)
+
+    def groupdict(self, default=None):
+        group = self.match_obj.group
+        retd = {}
+        for name in self._names:
+            value = group(name)
+            retd[name] = default if value is None else value
+        return retd
+
+    def start(self, group=0):
+        return self.match_obj.start(self._index(group))
+
+    def end(self, group=0):
+        return self.match_obj.end(self._index(group))
+
+    def span(self, group=0):
+        return self.match_obj.span(self._index(group))
+
+    @property
+    def string(self):
+        return self.match_obj.string
+
+    @property
+    def pos(self):
+        return self.match_obj.pos
+
+    @property
+    def endpos(self):
+        return self.match_obj.endpos
+
+    def __getattr__(self, name):
+        if name in self.UNSUPPORTED:
+            raise AttributeError('%s is not available for patterns that rx_grouper matches as a part of a combined pattern, use named groups instead' % (name,))
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return '<%s span=%r match=%r>' % (self.__class__.__name__, self.span(), self.group())
+
+def combine_rx_list(entries):
+    """splits list of (fieldname, rx, rx_c) entries into chunks that can be matched with a single call.
+    returns list of (fieldname, rx_c, branches, chunk entries) where branches is None for the patterns
+    that are matched on their own. Otherwise it maps group index of the branch in the
+    combined pattern to (position in the chunk, rx, rx_c, group names of the rx) and the
+    position of the branch that matched can be found from the lastindex of the match.
+    """
+    chunks = []
+    # entries of the chunk that is currently being collected
+    pending = []
+
+    def close_pending():
+        if not pending:
+            return
+        if len(pending) == 1:
+            fieldname, rx, rx_c = pending[0]
+            chunks.append((fieldname, rx_c, None, list(pending)))
+            del pending[:]
+            return
+
+        parts, branches = [], {}
+        group_index = 1
+        for position, (fieldname, rx, rx_c) in enumerate(pending):
+            parts.append('(%s)' % (rx,))
+            branches[group_index] = (position, rx, rx_c, tuple(rx_c.groupindex.keys()))
+            group_index += 1 + rx_c.groups
+        try:
+            combined_rx_c = re.compile('|'.join(parts), re.UNICODE)
+        except Exception as e:
+            logging.warn('unable to combine %d patterns, matching them one by one: %s' % (len(pending), str(e)))
+            chunks.extend((entry[0], entry[2], None, [entry]) for entry in pending)
+        else:
+            chunks.append((pending[0][0], combined_rx_c, branches, list(pending)))
+        del pending[:]
+
+    names = set()
+    for entry in entries:
+        fieldname, rx, rx_c = entry
+        if rx_c.flags != DEFAULT_RX_FLAGS or NUMBERED_GROUP_REFERENCE_RX.search(rx):
+            # global inline flags and numbered references don't survive being combined
+            close_pending()
+            chunks.append((fieldname, rx_c, None, [entry]))
+            continue
+
+        rx_names = set(rx_c.groupindex.keys())
+        if pending and (pending[0][0] != fieldname or rx_names & names):
+            close_pending()
+        if not pending:
+            names = set()
+        pending.append(entry)
+        names.update(rx_names)
+    close_pending()
+
+    return chunks
+
+def _close_literal(literals, run):
+    if len(run) >= MIN_LITERAL_LENGTH:
+        literals.append(''.join(run))
+    del run[:]
+
+def _collect_literals(items, literals, run):
+    """walks parsed pattern and collects the literals that every match has to contain.
+    Consecutive characters are collected into run, anything that isn't certain
+    to be matched exactly once ends it.
+    """
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+        elif op is sre_parse.AT:
+            # zero width, characters around it are still next to each other
+            continue
+        elif op is sre_parse.SUBPATTERN:
+            group, add_flags, del_flags, p = av
+            if add_flags & sre_parse.SRE_FLAG_IGNORECASE:
+                _close_literal(literals, run)
+                continue
+            _collect_literals(p, literals, run)
+        elif op is _ATOMIC_GROUP:
+            _collect_literals(av, literals, run)
+        elif op in _REPEAT_OPS and av[0] >= 1:
+            _close_literal(literals, run)
+            repeated_run = []
+            _collect_literals(av[2], literals, repeated_run)
+            _close_literal(literals, repeated_run)
+        else:
+            _close_literal(literals, run)
+
+def required_literals(rx, rx_c):
+    """returns literal strings that every string matched by the pattern has to contain.
+    Patterns that set flags or use syntax that is specific to the regex module have none.
+    """
+    if rx_c.flags != DEFAULT_RX_FLAGS or REGEX_ONLY_SYNTAX_RX.search(rx):
+        return []
+    try:
+        parsed = sre_parse.parse(rx)
+    except Exception:
+        return []
+
+    literals, run = [], []
+    _collect_literals(parsed, literals, run)
+    _close_literal(literals, run)
+    return literals
+
+def _collect_prefix(items, prefix):
+    """adds the literal characters from the start of the parsed pattern to prefix.
+    returns True if the whole pattern was literal
+    """
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            prefix.append(chr(av))
+        elif op is sre_parse.AT and av in (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING) and not prefix:
+            # patterns are matched from the start anyway
+            continue
+        elif op is sre_parse.SUBPATTERN and not av[1] & sre_parse.SRE_FLAG_IGNORECASE:
+            if not _collect_prefix(av[3], prefix):
+                return False
+        else:
+            return False
+    return True
+
+def literal_prefix(rx, rx_c):
+    """returns the literal string that every string matched by the pattern starts with.
+    The same patterns as in required_literals() have none.
+    """
+    if rx_c.flags != DEFAULT_RX_FLAGS or REGEX_ONLY_SYNTAX_RX.search(rx):
+        return ''
+    try:
+        parsed = sre_parse.parse(rx)
+    except Exception:
+        return ''
+
+    prefix = []
+    _collect_prefix(parsed, prefix)
+    return ''.join(prefix)
+
+class LiteralPrefilter(object):
+    """finds out which of the literals required by the patterns occur in a field
+    of the message. All the literals of a field are looked for with a single pass
+    of an Aho-Corasick automaton if the pyahocorasick module is available, otherwise
+    with an alternation of the literals that is searched again after every hit.
+    """
+    def __init__(self):
+        # fieldname -> literal -> literal id
+        self._literals = {}
+        # fieldname -> automaton
+        self._automata = {}
+        # fieldname -> (alternation of the literals, literal -> ids of its prefixes)
+        self._searchers = {}
+        # fieldname -> (field value, ids of the literals in it) of the last scan.
+        # Groups of the grouper match the same message one after another so
+        # this way the field is scanned only once
+        self._last_scan = {}
+
+    def add_literal(self, fieldname, literal):
+        """returns id of the literal
+        """
+        literals = self._literals.setdefault(fieldname, {})
+        literal_id = literals.get(literal, None)
+        if literal_id is None:
+            literal_id = literals[literal] = len(literals)
+        return literal_id
+
+    def build(self):
+        """has to be called once all the literals have been added
+        """
+        self._last_scan = {}
+        for fieldname, literals in self._literals.items():
+            if ahocorasick is None:
+                self._searchers[fieldname] = self._build_searcher(literals)
+                continue
+
+            automaton = ahocorasick.Automaton()
+            for literal, literal_id in literals.items():
+                automaton.add_word(literal, literal_id)
+            automaton.make_automaton()
+            self._automata[fieldname] = automaton
+
+    def _build_searcher(self, literals):
+        # longest first, so the longest literal that starts at the position
+        # matches and the ones that are its prefixes are known to be there as well
+        ordered = sorted(literals, key=len, reverse=True)
+        rx_c = stdlib_re.compile('|'.join(stdlib_re.escape(literal) for literal in ordered))
+        prefix_ids = dict((literal, [literals[other] for other in ordered if literal.startswith(other)])
+            for literal in ordered)
+        return rx_c, prefix_ids
+
+    def scan(self, fieldname, fieldval):
+        """returns ids of the literals that occur in the field value
+        """
+        last = self._last_scan.get(fieldname, None)
+        # same object as the last time, the value can't have changed
+        if last is not None and last[0] is fieldval:
+            return last[1]
+
+        automaton = self._automata.get(fieldname, None)
+        if automaton is not None:
+            seen = set(literal_id for end_index, literal_id in automaton.iter(fieldval))
+        else:
+            rx_c, prefix_ids = self._searchers[fieldname]
+            seen = set()
+            match_obj = rx_c.search(fieldval)
+            while match_obj is not None:
+                seen.update(prefix_ids[match_obj.group()])
+                # literals that overlap with this one start later
+                match_obj = rx_c.search(fieldval, match_obj.start() + 1)
+        self._last_scan[fieldname] = (fieldval, seen)
+        return seen
+
+class PrefixIndex(object):
+    """maps the first key_length characters of a field to the groups that
+    can match a message with that value. Groups that have some pattern
+    without a long enough literal prefix on the field can match any message.
+    """
+    def __init__(self, fieldname, key_length, groups, group_prefixes):
+        """group_prefixes maps the indexed groups to their prefixes,
+        groups is the list of all the groups in the order they are matched
+        """
+        self.fieldname = fieldname
+        self.key_length = key_length
+
+        keys = {}
+        for group, prefixes in group_prefixes.items():
+            for prefix in prefixes:
+                keys.setdefault(prefix[:key_length], set()).add(group)
+
+        self._all = self._candidates(groups, groups)
+        unindexed = [group for group in groups if group not in group_prefixes]
+        self._unindexed = self._candidates(groups, unindexed)
+        # key -> (groups in the order they are matched, set of the same groups)
+        self._index = {}
+        for key, key_groups in keys.items():
+            self._index[key] = self._candidates(groups, key_groups.union(unindexed))
+
+    def _candidates(self, groups, selected):
+        selected = set(selected)
+        return tuple(group for group in groups if group in selected), frozenset(selected)
+
+    def lookup(self, fieldval):
+        """returns (groups in the order they are matched, set of the same groups)
+        for the groups that can match a message that has fieldval in the field
+        """
+        try:
+            return self._index.get(fieldval[:self.key_length], self._unindexed)
+        except TypeError:
+            # field isn't set
+            return self._all
+
+    @classmethod
+    def build(cls, groups):
+        """returns index for the field that the most groups can be indexed on
+        or None if there is no such field
+        """
+        # fieldname -> group -> prefixes
+        candidates = {}
+        for group in groups:
+            if group.match != group.match_rx_list:
+                continue
+            prefixes = {}
+            for fieldname, rx, rx_c in group._rx_list:
+                prefix = None
+                if fieldname[0] != '.' and fieldname != 'group':
+                    # these are modified by the groups while matching
+                    prefix = literal_prefix(rx, rx_c)
+                if not prefix or len(prefix) < MIN_PREFIX_LENGTH:
+                    prefixes = None
+                    break
+                prefixes.setdefault(fieldname, []).append(prefix)
+            if prefixes is None or len(prefixes) != 1:
+                continue
+            for fieldname, field_prefixes in prefixes.items():
+                candidates.setdefault(fieldname, {})[group] = field_prefixes
+
+        if not candidates:
+            return None
+        fieldname, group_prefixes = max(candidates.items(), key=lambda item: len(item[1]))
+        key_length = min(len(prefix) for prefixes in group_prefixes.values() for prefix in prefixes)
+        return cls(fieldname, key_length, groups, group_prefixes)
+
+class MatchCache(object):
+    """bounded LRU cache of the groups that matched messages with the given field values.
+    The cache is bypassed for a while if the hit rate is too low to pay for the lookups,
+    that happens for fields like content that rarely repeat.
+    """
+    def __init__(self, fieldnames, size, ttl):
+        self.fieldnames = fieldnames
+        self.size = size
+        self.ttl = ttl
+        # key -> (expiry time, [(group_name, groupdict), ...])
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if any(fieldname[0] == '.' for fieldname in fieldnames):
+            getters = [self._field_getter(fieldname) for fieldname in fieldnames]
+            self._get_key = lambda msg: tuple(get_field(msg) for get_field in getters)
+        else:
+            self._get_key = operator.attrgetter(*fieldnames)
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.bypassed = 0
+        # hit rate is checked once there have been this many lookups
+        self._window_end = MATCH_CACHE_WINDOW
+        self._window_start_hits = 0
+        self._bypass_left = 0
+
+    def _field_getter(self, fieldname):
+        if fieldname[0] == '.':
+            # references extradata
+            name = fieldname[1:]
+            return lambda msg: (msg.extradata or {}).get(name, None)
+        return operator.attrgetter(fieldname)
+
+    def bypass(self, count):
+        """returns True if the cache shouldn't be used for the next count messages
+        """
+        if not self._bypass_left:
+            return False
+        self._bypass_left = max(0, self._bypass_left - count)
+        self.bypassed += count
+        return True
+
+    def lookup(self, msg):
+        """returns (key, matches). matches is None if the message has to be matched,
+        key is None if the result can't be stored afterwards
+        """
+        key = self._get_key(msg)
+        with self._lock:
+            try:
+                entry = self._entries.get(key, None)
+            except TypeError:
+                # unhashable extradata value
+                return None, None
+
+            matched = None
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(key)
+                    matched = entry[1]
+                else:
+                    del self._entries[key]
+                    self.expired += 1
+
+            if matched is None:
+                self.misses += 1
+                if self.hits + self.misses >= self._window_end:
+                    self._check_hit_rate()
+            else:
+                self.hits += 1
+        return key, matched
+
+    def _check_hit_rate(self):
+        window_hits = self.hits - self._window_start_hits
+        if window_hits < MATCH_CACHE_WINDOW * MATCH_CACHE_MIN_HIT_RATE:
+            logging.info('match cache on %s: %d hits out of %d lookups, bypassing it for %d messages' % (
+                ','.join(self.fieldnames), window_hits, MATCH_CACHE_WINDOW, MATCH_CACHE_BYPASS_MSGS))
+            self._bypass_left = MATCH_CACHE_BYPASS_MSGS
+        self._window_end = self.hits + self.misses + MATCH_CACHE_WINDOW
+        self._window_start_hits = self.hits
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def store(self, key, matched):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, matched)
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'bypassed': self.bypassed,
+            'entries': len(self._entries),
+        }
+
 class RXGroup(Group):
     """handles single regexp group
     """
     # default field to match regexps against
     DEFAULT_FIELD = 'content'
 
-    def __init__(self, name, outputs, rx_list=None, match_rule=None, disables_fallthrough=False, name_transform=None, test_mode=False):
+    def __init__(self, name, outputs, rx_list=None, match_rule=None, disables_fallthrough=False, name_transform=None, test_mode=False, priority=0):
         """
         @arg disables_fallthrough: if True then matching this group doesn't disable matching of the fallthrough
             group. This is useful when you just want to send some of the log lines to stats engine but this doesn't
             necessarily mean these arent anomalous. An example might be matching all the HTTP status codes in
             different groups while still wanting to see anomalous lines in the fallthrough group.
+        @arg priority: with adaptive ordering groups of higher priority are always matched before the
+            ones with lower priority
         """
         Group.__init__(self, name, outputs)
         self.disables_fallthrough = disables_fallthrough
         self.name_transform = name_transform
+        self.priority = priority
+        # performance counters are kept if this is True
+        self.measure_perf = MEASURE_RX_PERF
         self._perfd = {}
+        # rx -> priority of the pattern for the adaptive ordering
+        self._rx_priority = {}
+        # (fieldname, rx_c, branches, chunk prefilter), see combine_rx_list() and use_prefilter()
+        self._rx_chunks = []
+        # entries of the patterns of each chunk
+        self._rx_chunk_entries = []
+        self._prefilter = None
 
         if rx_list:
             self._init_rx_list(rx_list)
@@ -149,17 +696,92 @@ class RXGroup(Group):
             return True
 
         # rx elements are either regexp strings, in which case we match it against the content field,
-        # or tuple where the first element is fieldname and the second one holds regexp
+        # or tuple where the first element is fieldname and the second one holds regexp.
+        # Optional third element of the tuple is the priority for the adaptive ordering
         for rx in rx_list:
+            priority = 0
             if isinstance(rx, type('')):
                 entry = (self.DEFAULT_FIELD, rx, re.compile(rx, re.UNICODE))
             else:
-                fieldname, rx = rx
+                if len(rx) > 2:
+                    priority = rx[2]
+                fieldname, rx = rx[:2]
                 entry = (fieldname, rx, re.compile(rx, re.UNICODE))
 
             self._rx_list.append(entry)
+            self._rx_priority[rx] = priority
             self._perfd[rx] = {'evaluations': 0, 'matches': 0, 'total_time': 0}
 
+        self._init_rx_chunks()
+
+    def _init_rx_chunks(self):
+        if COMBINE_RX_LISTS:
+            chunks = combine_rx_list(self._rx_list)
+        else:
+            chunks = [(entry[0], entry[2], None, [entry]) for entry in self._rx_list]
+        self._rx_chunks = [(fieldname, rx_c, branches, None) for fieldname, rx_c, branches, entries in chunks]
+        self._rx_chunk_entries = [entries for fieldname, rx_c, branches, entries in chunks]
+        # pattern of the uncombined chunks for the performance counters
+        self._chunk_rx = dict((id(rx_c), rx) for fieldname, rx, rx_c in self._rx_list)
+
+    def get_score(self, rx_list=None):
+        """returns matches per second spent on matching the patterns, all of them by default
+        """
+        if rx_list is None:
+            rx_list = [rx for fieldname, rx, rx_c in self._rx_list]
+        matches, total_time = 0, 0
+        for rx in rx_list:
+            perf_rec = self._perfd[rx]
+            matches += perf_rec['matches']
+            total_time += perf_rec['total_time']
+        if not total_time:
+            return 0
+        return matches / total_time
+
+    def reorder(self):
+        """sort the patterns by priority and then by their score.
+        returns True if the order changed
+        """
+        order = sorted(enumerate(self._rx_list),
+            key=lambda item: (-self._rx_priority[item[1][1]], -self.get_score([item[1][1]]), item[0]))
+        rx_list = [entry for position, entry in order]
+        if rx_list == self._rx_list:
+            return False
+
+        self._rx_list = rx_list
+        self._init_rx_chunks()
+        if self._prefilter is not None:
+            # literals are the same as before, the prefilter doesn't have to be built again
+            self.use_prefilter(self._prefilter)
+        return True
+
+    def use_prefilter(self, prefilter):
+        """skip the patterns whose required literals don't occur in the message.
+        Every pattern is represented by its longest required literal, patterns
+        without one are always matched. Literals are added to the prefilter,
+        which has to be built afterwards.
+        """
+        self._prefilter = prefilter
+        rx_chunks = []
+        for (fieldname, rx_c, branches, chunk_filter), entries in zip(self._rx_chunks, self._rx_chunk_entries):
+            # literal id -> bitmask of the positions of the patterns that require it
+            literal_masks = {}
+            always_mask = 0
+            for position, (entry_fieldname, rx, entry_rx_c) in enumerate(entries):
+                literals = required_literals(rx, entry_rx_c)
+                if not literals:
+                    always_mask |= 1 << position
+                    continue
+                literal_id = prefilter.add_literal(fieldname, max(literals, key=len))
+                literal_masks[literal_id] = literal_masks.get(literal_id, 0) | (1 << position)
+
+            full_mask = (1 << len(entries)) - 1
+            chunk_filter = None
+            if always_mask != full_mask:
+                chunk_filter = (literal_masks, always_mask, full_mask, [entry[2] for entry in entries])
+            rx_chunks.append((fieldname, rx_c, branches, chunk_filter))
+        self._rx_chunks = rx_chunks
+
     def match_rule(self, msg):
         def _rec_match_rule(msg, rule):
             if type(rule) != tuple:
@@ -172,7 +794,7 @@ class RXGroup(Group):
         """returns re match object if msg matches this group
         None otherwise
         """
-        for fieldname, rx, rx_c in self._rx_list:
+        for fieldname, rx_c, branches, chunk_filter in self._rx_chunks:
             if fieldname[0] == '.':
                 # references extradata
                 try:
@@ -189,34 +811,85 @@ class RXGroup(Group):
             else:
                 fieldval = getattr(msg, fieldname)
 
-            if MEASURE_RX_PERF is True:
+            if chunk_filter is not None:
+                literal_masks, candidates, full_mask, singles = chunk_filter
+                for literal_id in self._prefilter.scan(fieldname, fieldval):
+                    candidates |= literal_masks.get(literal_id, 0)
+                if not candidates:
+                    continue
+                if candidates != full_mask and bin(candidates).count('1') <= PREFILTER_MAX_SEPARATE_MATCHES:
+                    match_obj = self._match_candidates(candidates, singles, fieldname, fieldval)
+                    if match_obj:
+                        self.matches += 1
+                        return match_obj
+                    continue
+
+            if self.measure_perf:
                 start_time = pcounter()
             match_obj = rx_c.match(fieldval)
-            if MEASURE_RX_PERF is True:
-                time_spent = pcounter() - start_time
-                if time_spent > 1.0:
-                    logging.warn('pathologically slow rx. %s in %s field:%s against %s took %.4fs' % (rx, self.name, str(fieldname), fieldval, time_spent))
-                perf_rec = self._perfd[rx]
-                perf_rec['evaluations'] += 1
-                perf_rec['total_time'] += time_spent
+            if self.measure_perf:
+                self._count_performance(rx_c, branches, match_obj, fieldname, fieldval, pcounter() - start_time)
             if match_obj:
-                if MEASURE_RX_PERF is True:
-                    perf_rec['matches'] += 1
-                #if __debug__:
-                #    logging.debug('%s matched rx %s with %s' % (
-                #        str(self), str(rx), fieldval)
-                #    )
                 self.matches += 1
-                return match_obj
-            else:
-                #if __debug__:
-                #    logging.debug('%s no match: rx %s msg: %s' % (
-                #        str(self), str(rx), fieldval)
-                #    )
-                pass
+                if branches is None:
+                    return match_obj
+                offset = match_obj.lastindex
+                position, rx, branch_rx_c, names = branches[offset]
+                return CombinedMatch(match_obj, offset, branch_rx_c, names)
 
         return False
 
+    def _match_candidates(self, candidates, singles, fieldname, fieldval):
+        """match the patterns at the positions of the bits set in candidates one by one
+        returns match object of the first one that matches or None
+        """
+        while candidates:
+            lowest = candidates & -candidates
+            rx_c = singles[lowest.bit_length() - 1]
+            if self.measure_perf:
+                start_time = pcounter()
+            match_obj = rx_c.match(fieldval)
+            if self.measure_perf:
+                self._count_performance(rx_c, None, match_obj, fieldname, fieldval, pcounter() - start_time)
+            if match_obj:
+                return match_obj
+            candidates ^= lowest
+        return None
+
+    def _count_performance(self, rx_c, branches, match_obj, fieldname, fieldval, time_spent):
+        """update the counters of the patterns that took part in the match.
+        Time of the combined pattern is divided evenly between the patterns
+        that were tried before one of them matched.
+        """
+        if branches is None:
+            rx = self._chunk_rx[id(rx_c)]
+            if time_spent > 1.0:
+                logging.warn('pathologically slow rx. %s in %s field:%s against %s took %.4fs' % (rx, self.name, str(fieldname), fieldval, time_spent))
+            perf_rec = self._perfd[rx]
+            perf_rec['evaluations'] += 1
+            perf_rec['total_time'] += time_spent
+            if match_obj:
+                perf_rec['matches'] += 1
+            return
+
+        ordered = sorted(branches.values())
+        if match_obj:
+            position, matched_rx, branch_rx_c, names = branches[match_obj.lastindex]
+            tried = ordered[:position + 1]
+        else:
+            tried = ordered
+        if time_spent > 1.0:
+            logging.warn('pathologically slow rx. one of %s in %s field:%s against %s took %.4fs' % (
+                ', '.join(rx for position, rx, branch_rx_c, names in tried), self.name, str(fieldname), fieldval, time_spent))
+
+        time_share = time_spent / len(tried)
+        for position, rx, branch_rx_c, names in tried:
+            perf_rec = self._perfd[rx]
+            perf_rec['evaluations'] += 1
+            perf_rec['total_time'] += time_share
+        if match_obj:
+            self._perfd[matched_rx]['matches'] += 1
+
 class RXGrouper(core.PunnsilmNode):
     name = 'rx_grouper'
 
@@ -234,12 +907,21 @@ class RXGrouper(core.PunnsilmNode):
         if 'match' in kwargs:
             del kwargs['match']
 
+        # match in this many worker processes instead of the calling thread
+        self._workers_count = int(kwargs.pop('workers', DEFAULT_WORKERS))
+        self._shard_key = kwargs.pop('shard_key', DEFAULT_SHARD_KEY)
+        match_cache_size = int(kwargs.pop('match_cache_size', DEFAULT_MATCH_CACHE_SIZE))
+        match_cache_ttl = float(kwargs.pop('match_cache_ttl_sec', DEFAULT_MATCH_CACHE_TTL_SEC))
+        # sort the patterns and groups by how often they match
+        self._adaptive_order = bool(kwargs.pop('adaptive_order', False))
+
         # is it OK to modify messages that go through us or should
         # make a copy that we modify and send downstream.
         # This might be useful in the cases when one wants to ensure
         # that upstream/parallel nodes that also get this message
         # won't see our modifications
         want_copy = kwargs.get('want_copy', False)
+        self._want_copy = want_copy
 
         # add list of all the unique outputs used by our subgroups so the
         # parent class would be able to initialize all the outputs correctly
@@ -251,7 +933,17 @@ class RXGrouper(core.PunnsilmNode):
         self._rx_list = []
         self._subgroups = {}
         self._matchable_subgroups = []
+        # match_field() rules modify extradata while matching
+        self._have_match_rules = False
         self._init_subgroups(groups)
+        self._init_prefilter()
+        self._prefix_index = None
+        if USE_PREFIX_INDEX and not self.test_mode:
+            # test mode prints out how every group is matched
+            self._prefix_index = PrefixIndex.build(self._matchable_subgroups)
+        self._match_cache = None
+        if match_cache_size > 0:
+            self._init_match_cache(match_cache_size, match_cache_ttl)
 
         # We want to show warning about missing output only once
         # and use this set to keep track of known misses.
@@ -266,9 +958,32 @@ class RXGrouper(core.PunnsilmNode):
             self._copier = lambda x: x
 
         self._stats_write_counter = 0
+        self._reorder_counter = 0
+        if self.test_mode:
+            # test mode prints out the groups in the configured order
+            self._adaptive_order = False
+        if self._adaptive_order:
+            for group in self._matchable_subgroups:
+                group.measure_perf = True
 
         if self.test_mode:
             self._subgroup_broadcast = subgroup_broadcast_test_decorator(self._subgroup_broadcast)
+            # test mode prints out what is matched, keep it in the calling thread
+            self._workers_count = 0
+
+        # worker processes don't survive fork() so we have to know in
+        # which process the current ones were started
+        self._workers_pid = None
+        self._worker_inboxes = []
+        self._worker_procs = []
+        # for each worker, message lists that have been sent to it but
+        # whose results haven't arrived yet
+        self._in_flight = []
+        self._in_flight_count = 0
+        self._send_lock = threading.Lock()
+        self._idle = threading.Condition()
+        # latest performance counters reported by each worker
+        self._worker_stats = []
 
     def _gather_output_list_from_subgroups(self, groups):
         """create a list of unique output node names that are used in subgroups of this grouper
@@ -288,6 +1003,85 @@ class RXGrouper(core.PunnsilmNode):
             group = self._init_subgroup(group_name, group_config)
             if group.match is not None:
                 self._matchable_subgroups.append(group)
+            if group_config.get('match_rule', None):
+                self._have_match_rules = True
+
+    def _init_prefilter(self):
+        """one prefilter is shared by all the groups so every field
+        of the message is scanned for the literals only once
+        """
+        self._prefilter = None
+        if not USE_LITERAL_PREFILTER:
+            return
+
+        self._prefilter = LiteralPrefilter()
+        for group in self._subgroups.values():
+            group.use_prefilter(self._prefilter)
+        self._prefilter.build()
+
+    def _init_match_cache(self, size, ttl):
+        if self.test_mode:
+            # test mode prints out how every group is matched
+            return
+        if self._have_match_rules:
+            logging.warn('%s: match cache is disabled, results of match rules can\'t be cached' % (str(self),))
+            return
+
+        # results depend on all the fields that the patterns look at
+        fieldnames = set()
+        for group in self._matchable_subgroups:
+            fieldnames.update(fieldname for fieldname, rx, rx_c in group._rx_list)
+        if not fieldnames:
+            return
+        self._match_cache = MatchCache(sorted(fieldnames), size, ttl)
+        # groups that match extradata see what the groups before them added to it
+        self._match_cache_reads_extradata = any(fieldname[0] == '.' for fieldname in fieldnames)
+
+    def _ordered_groups(self):
+        """returns matchable groups sorted by priority and then by their score.
+        Groups are only moved among the neighbouring rx_list groups that have
+        the same outputs, any other group keeps its place.
+        """
+        ordered = []
+        run = []
+
+        def close_run():
+            run.sort(key=lambda item: (-item[1].priority, -item[1].get_score(), item[0]))
+            ordered.extend(group for position, group in run)
+            del run[:]
+
+        for position, group in enumerate(self._matchable_subgroups):
+            if group.match != group.match_rx_list:
+                close_run()
+                ordered.append(group)
+                continue
+            if run and sorted(run[0][1].outputs) != sorted(group.outputs):
+                close_run()
+            run.append((position, group))
+        close_run()
+        return ordered
+
+    def reorder(self):
+        """sort the patterns of the groups and with the first match strategy
+        also the groups by how often they match per second spent on them
+        """
+        changed = [group.name for group in self._matchable_subgroups
+            if group.match == group.match_rx_list and group.reorder()]
+
+        if self.match_strategy == MATCH_FIRST:
+            # with all the groups matched the order doesn't matter
+            ordered = self._ordered_groups()
+            if ordered != self._matchable_subgroups:
+                self._matchable_subgroups = ordered
+                changed.append('groups')
+                if self._prefix_index is not None:
+                    self._prefix_index = PrefixIndex.build(ordered)
+
+        if changed:
+            if self._match_cache is not None:
+                # results of the old order
+                self._match_cache.clear()
+            logging.info('%s: changed the order of %s' % (str(self), ', '.join(changed)))
 
     def _init_subgroup(self, group_name, group_config):
         # FIXME: maybe all the RX stuff should be implemented inside
@@ -309,21 +1103,84 @@ class RXGrouper(core.PunnsilmNode):
         if output.name in self._missing_outputs:
             self._missing_outputs.discard(output.name)
 
-    def write_stats(self):
-        stats = {}
-        stats_file = os.path.join(STATS_ROOT, "punnsilm_stats_%s.json" % (self.name,))
+    def remove_output(self, output):
+        core.PunnsilmNode.remove_output(self, output)
+        del self.output_map[output.name]
+        for group in self._subgroups.values():
+            if output.name in group.outputs:
+                group.outputs = [name for name in group.outputs if name != output.name]
+
+    def compile_dispatch(self):
+        core.PunnsilmNode.compile_dispatch(self)
+        if self.test_mode:
+            return
+
+        # output names of the groups resolved once instead of for every message
+        for group in self._subgroups.values():
+            for group_output in group.outputs:
+                if group_output not in self.output_map:
+                    logging.warn('unknown output %s specified for group %s' % (group_output, group.name))
+            group.appends = tuple(self.output_map[name].append
+                for name in group.outputs if name in self.output_map)
+        self._subgroup_broadcast = self._compiled_subgroup_broadcast
+
+    def _compiled_subgroup_broadcast(self, group, msg):
+        for append in group.appends:
+            append(msg)
 
+    def _get_group_stats(self):
+        stats = {}
         for name, group in self._subgroups.items():
             perf_counters = group.get_performance_counters()
             stats[name] = perf_counters
+        if self._match_cache is not None:
+            stats[MATCH_CACHE_STATS_KEY] = {
+                ','.join(self._match_cache.fieldnames): self._match_cache.get_stats(),
+            }
+        return stats
+
+    def get_stats(self):
+        if self._workers_pid != os.getpid():
+            return self._get_group_stats()
+
+        # sum up the counters of the workers
+        stats = {}
+        for group_stats in [self._get_group_stats()] + [s for s in self._worker_stats if s]:
+            for name, perfd in group_stats.items():
+                merged_perfd = stats.setdefault(name, {})
+                for rx, perf_rec in perfd.items():
+                    merged_rec = merged_perfd.setdefault(rx, {})
+                    for counter, value in perf_rec.items():
+                        merged_rec[counter] = merged_rec.get(counter, 0) + value
+        return stats
+
+    def write_stats(self):
+        stats_file = os.path.join(STATS_ROOT, "punnsilm_stats_%s.json" % (self.name,))
 
         with open(stats_file, "w+") as fd:
-            fd.write(json.dumps(stats, sort_keys=True, indent=4))
+            fd.write(json.dumps(self.get_stats(), sort_keys=True, indent=4))
 
     def append(self, msg):
+        if self._workers_count:
+            self._send_to_workers([msg])
+            return
+        if self._match_cache is not None and not self._match_cache.bypass(1):
+            self._deliver_results([msg], [(None, self._cached_match(msg))], count_matches=False)
+            self._count_for_stats(1)
+            self._count_for_reorder(1)
+            return
+
         have_match = False
 
+        candidates = None
+        prefix_index = self._prefix_index
+        if prefix_index is not None:
+            fieldval = getattr(msg, prefix_index.fieldname)
+            candidates = prefix_index.lookup(fieldval)[1]
+
         for group in self._matchable_subgroups:
+            if candidates is not None and group not in candidates:
+                continue
             match_group = group.match(msg)
             if match_group is not False:
                 # Multiple groups might match the message and if we add some
@@ -337,11 +1194,13 @@ class RXGrouper(core.PunnsilmNode):
                 if match_group is not True:
                     groupdict = match_group.groupdict()
                     if groupdict:
-                        if msg_copy.extradata is None:
-                            msg_copy.extradata = {}
-                        msg_copy.extradata.update(groupdict)
+                        msg_copy.update_extradata(groupdict)
                 self._subgroup_broadcast(group, msg_copy)
-                        
+                if candidates is not None and getattr(msg, prefix_index.fieldname) is not fieldval:
+                    # downstream nodes changed the field, following groups have to see the new value
+                    fieldval = getattr(msg, prefix_index.fieldname)
+                    candidates = prefix_index.lookup(fieldval)[1]
+
                 have_match = True
                 if self.match_strategy == MATCH_FIRST:
                     break
@@ -355,11 +1214,326 @@ class RXGrouper(core.PunnsilmNode):
                 msg.group = fallthrough.name
                 self._subgroup_broadcast(fallthrough, msg)
 
-        self._stats_write_counter += 1
+        self._count_for_stats(1)
+        self._count_for_reorder(1)
+
+    def append_batch(self, msgs):
+        if self._workers_count:
+            self._send_to_workers(msgs)
+            return
+        if self._match_cache is not None and not self._match_cache.bypass(len(msgs)):
+            self._deliver_results(msgs, [(None, self._cached_match(msg)) for msg in msgs], count_matches=False)
+            self._count_for_stats(len(msgs))
+            self._count_for_reorder(len(msgs))
+            return
+
+        # output node -> messages that have to be sent to it
+        pending = {}
+        prefix_index = self._prefix_index
+        candidates = None
+
+        for msg in msgs:
+            have_match = False
+            if prefix_index is not None:
+                fieldval = getattr(msg, prefix_index.fieldname)
+                candidates = prefix_index.lookup(fieldval)[1]
+
+            for group in self._matchable_subgroups:
+                if candidates is not None and group not in candidates:
+                    continue
+                match_group = group.match(msg)
+                if match_group is not False:
+                    if have_match and pending:
+                        # we are about to modify a message that downstream nodes haven't seen yet.
+                        # Deliver everything collected so far so that they would see exactly the
+                        # same thing as they would if the messages were sent one by one.
+                        self._flush_pending(pending)
+                        pending = {}
+                        if candidates is not None and getattr(msg, prefix_index.fieldname) is not fieldval:
+                            # downstream nodes changed the field, following groups have to see the new value
+                            fieldval = getattr(msg, prefix_index.fieldname)
+                            candidates = prefix_index.lookup(fieldval)[1]
+
+                    msg_copy = self._copier(msg)
+                    msg_copy.group = group.get_formated_name(group)
+                    if match_group is not True:
+                        groupdict = match_group.groupdict()
+                        if groupdict:
+                            msg_copy.update_extradata(groupdict)
+                    self._subgroup_collect(group, msg_copy, pending)
+
+                    have_match = True
+                    if self.match_strategy == MATCH_FIRST:
+                        break
+
+            if not have_match:
+                fallthrough = self._subgroups.get('_fallthrough', None)
+                if fallthrough:
+                    msg.group = fallthrough.name
+                    self._subgroup_collect(fallthrough, msg, pending)
+
+        self._flush_pending(pending)
+
+        self._count_for_stats(len(msgs))
+        self._count_for_reorder(len(msgs))
+
+    def _count_for_stats(self, count):
+        """write out the statistics every STATS_WRITE_EVERY_X_MSGS messages
+        """
+        self._stats_write_counter += count
         if self._stats_write_counter > STATS_WRITE_EVERY_X_MSGS:
             self.write_stats()
             self._stats_write_counter = 0
 
+    def _count_for_reorder(self, count):
+        """adaptive ordering is done every ADAPTIVE_ORDER_EVERY_X_MSGS messages
+        """
+        if not self._adaptive_order:
+            return
+        self._reorder_counter += count
+        if self._reorder_counter >= ADAPTIVE_ORDER_EVERY_X_MSGS:
+            self._reorder_counter = 0
+            self.reorder()
+
+    def _start_workers(self):
+        ctx = multiprocessing.get_context('fork')
+        self._results = ctx.Queue()
+        self._worker_inboxes = []
+        self._worker_procs = []
+        self._in_flight = []
+        self._in_flight_count = 0
+        self._worker_stats = [None] * self._workers_count
+
+        for worker_id in range(self._workers_count):
+            inbox = ctx.Queue(WORKER_QUEUE_SIZE)
+            proc = ctx.Process(target=self._worker_main, args=(worker_id, inbox, self._results),
+                name='punnsilm: %s[%d]' % (self.name, worker_id))
+            proc.daemon = True
+            proc.start()
+            self._worker_inboxes.append(inbox)
+            self._worker_procs.append(proc)
+            self._in_flight.append(collections.deque())
+
+        self._workers_pid = os.getpid()
+        self._collector = threading.Thread(target=self._collect_results, name='punnsilm results: %s' % (self.name,))
+        self._collector.daemon = True
+        self._collector.start()
+        logging.info('%s: started %d worker processes' % (str(self), self._workers_count))
+
+    def _shard_value(self, msg):
+        if self._shard_key[0] == '.':
+            # references extradata
+            return (msg.extradata or {}).get(self._shard_key[1:], None)
+        return getattr(msg, self._shard_key, None)
+
+    def _send_to_workers(self, msgs):
+        if self._workers_pid != os.getpid():
+            self._start_workers()
+
+        workers_count = self._workers_count
+        if workers_count == 1:
+            shards = {0: msgs}
+        else:
+            shards = {}
+            shard_value = self._shard_value
+            for msg in msgs:
+                shard = hash(shard_value(msg)) % workers_count
+                shard_msgs = shards.get(shard, None)
+                if shard_msgs is None:
+                    shard_msgs = shards[shard] = []
+                shard_msgs.append(msg)
+
+        for shard, shard_msgs in shards.items():
+            # encoded right away so that whatever happens to the messages
+            # after we return won't be seen by the worker
+            data = codec.encode_batch(shard_msgs)
+            with self._idle:
+                self._in_flight_count += len(shard_msgs)
+            # results come back in the same order as the lists were sent
+            with self._send_lock:
+                self._in_flight[shard].append(shard_msgs)
+                self._worker_inboxes[shard].put(data)
+
+    def _worker_main(self, worker_id, inbox, results):
+        setproctitle.setproctitle('punnsilm: %s[%d]' % (self.name, worker_id))
+        stats_counter = 0
+        while 1:
+            data = inbox.get()
+            if data is None:
+                results.put((worker_id, None, self._get_group_stats()))
+                return
+
+            msgs = codec.decode_batch(data)
+            retl = [self._match_for_worker(msg) for msg in msgs]
+            self._count_for_reorder(len(msgs))
+
+            stats = None
+            stats_counter += len(msgs)
+            if stats_counter > STATS_WRITE_EVERY_X_MSGS:
+                stats = self._get_group_stats()
+                stats_counter = 0
+            results.put((worker_id, retl, stats))
+
+    def _match_for_worker(self, msg):
+        """returns (extradata, [(group_name, groupdict), ...]) for a message.
+        Extradata is returned only if match rules might have modified it.
+        """
+        if self._match_cache is not None and not self._match_cache.bypass(1):
+            # match rules disable the cache
+            return None, self._cached_match(msg)
+
+        matched = self._match_groups(msg)
+        if self._have_match_rules:
+            return msg.extradata, matched
+        return None, matched
+
+    def _cached_match(self, msg):
+        """same as _match_groups() but the result for the field values
+        that have been seen before is taken from the cache
+        """
+        key, matched = self._match_cache.lookup(msg)
+        if matched is not None:
+            for group_name, groupdict in matched:
+                self._subgroups[group_name].matches += 1
+            return matched
+
+        update_extradata = False
+        if self._match_cache_reads_extradata and not self._want_copy:
+            # groups add their extradata to the message for the following ones.
+            # Keep it away from the message that is delivered afterwards, like in the workers
+            msg = copy.copy(msg)
+            if msg.extradata is not None:
+                msg.extradata = dict(msg.extradata)
+            update_extradata = True
+        matched = self._match_groups(msg, update_extradata)
+        if key is not None:
+            self._match_cache.store(key, matched)
+        return matched
+
+    def _match_groups(self, msg, update_extradata=True):
+        """returns [(group_name, groupdict), ...] for the groups that match the message.
+        Groupdicts are added to the extradata of the message unless update_extradata is False
+        or the messages are copied for every group.
+        """
+        matched = []
+        groups = self._matchable_subgroups
+        if self._prefix_index is not None:
+            # nothing downstream sees the message before all the groups have been matched
+            groups = self._prefix_index.lookup(getattr(msg, self._prefix_index.fieldname))[0]
+        for group in groups:
+            match_group = group.match(msg)
+            if match_group is not False:
+                groupdict = None
+                if match_group is not True:
+                    groupdict = match_group.groupdict() or None
+                    if groupdict and update_extradata and not self._want_copy:
+                        # following groups would see it when matching in a single process
+                        msg.update_extradata(groupdict)
+                matched.append((group.name, groupdict))
+                if self.match_strategy == MATCH_FIRST:
+                    break
+        return matched
+
+    def _collect_results(self):
+        """apply results of the workers to the original messages and send them downstream
+        """
+        workers_running = self._workers_count
+        while workers_running:
+            worker_id, retl, stats = self._results.get()
+            if stats is not None:
+                self._worker_stats[worker_id] = stats
+            if retl is None:
+                workers_running -= 1
+                continue
+
+            msgs = self._in_flight[worker_id].popleft()
+            try:
+                self._deliver_results(msgs, retl)
+            except Exception:
+                logging.exception('%s: failed to deliver messages' % (str(self),))
+
+            with self._idle:
+                self._in_flight_count -= len(msgs)
+                if not self._in_flight_count:
+                    self._idle.notify_all()
+
+            self._count_for_stats(len(msgs))
+
+    def _deliver_results(self, msgs, retl, count_matches=True):
+        """counterpart of append_batch() for the messages matched by the workers
+        or taken from the match cache. Groups that matched in this process
+        have counted the matches already.
+        """
+        pending = {}
+        fallthrough = self._subgroups.get('_fallthrough', None)
+
+        for msg, (extradata, matched) in zip(msgs, retl):
+            if extradata is not None:
+                msg.extradata = extradata
+
+            have_match = False
+            for group_name, groupdict in matched:
+                group = self._subgroups[group_name]
+                if count_matches:
+                    group.matches += 1
+                if have_match and pending:
+                    self._flush_pending(pending)
+                    pending = {}
+
+                msg_copy = self._copier(msg)
+                msg_copy.group = group.get_formated_name(group)
+                if groupdict:
+                    msg_copy.update_extradata(groupdict)
+                self._subgroup_collect(group, msg_copy, pending)
+                have_match = True
+
+            if not have_match and fallthrough:
+                msg.group = fallthrough.name
+                self._subgroup_collect(fallthrough, msg, pending)
+
+        self._flush_pending(pending)
+
+    def wait_idle(self, timeout=None):
+        if self._workers_pid != os.getpid():
+            return True
+
+        with self._idle:
+            while self._in_flight_count:
+                if not self._idle.wait(timeout) and timeout is not None:
+                    break
+            return not self._in_flight_count
+
+    def stop(self):
+        if self._workers_pid != os.getpid():
+            return
+
+        for inbox in self._worker_inboxes:
+            inbox.put(None)
+        self._collector.join(WORKER_STOP_TIMEOUT_SEC)
+        for proc in self._worker_procs:
+            proc.join(WORKER_STOP_TIMEOUT_SEC)
+        self.write_stats()
+
+    def _flush_pending(self, pending):
+        for output_node, out_msgs in pending.items():
+            output_node.append_batch(out_msgs)
+
+    def _subgroup_collect(self, group, msg, pending):
+        """batch mode counterpart of _subgroup_broadcast()
+        """
+        for group_output in group.outputs:
+            output_node = self.output_map.get(group_output, None)
+            if output_node is None:
+                if group_output not in self._missing_outputs:
+                    logging.warn('unknown output %s specified for group %s' % (group_output, group.name))
+                    self._missing_outputs.add(group_output)
+                continue
+
+            out_msgs = pending.get(output_node, None)
+            if out_msgs is None:
+                out_msgs = pending[output_node] = []
+            out_msgs.append(msg)
+
     def _subgroup_broadcast(self, group, msg):
         for group_output in group.outputs:
             output_node = self.output_map.get(group_output, None)
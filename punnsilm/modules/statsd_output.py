@@ -1,11 +1,15 @@
 import logging
 import datetime
+import threading
 
 from punnsilm import core
 
 import socket
 
 DEFAULT_STATSD_PORT = 8125
+# metrics sent out in batch mode are packed into datagrams of up to this size.
+# The value is what statsd docs recommend for the fast ethernet.
+MAX_PACKET_SIZE = 1432
 
 class SimpleStatsdSender():
     def __init__(self, host, port=DEFAULT_STATSD_PORT):
@@ -15,14 +19,46 @@ class SimpleStatsdSender():
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._sock.connect((host, port))
 
-    def _send(self, key, value):
-        send_val = ('%s:%s' % (key, value)).encode("utf-8")
-        #print(send_val)
+        # holds the list of metrics collected by the current batch of the thread
+        self._local = threading.local()
+
+    def begin_batch(self):
+        """start collecting metrics instead of sending each of them out immediately
+        """
+        self._local.batch = []
+
+    def end_batch(self):
+        """send out the metrics collected since begin_batch() packed into as few datagrams as possible
+        """
+        batch = self._local.batch
+        self._local.batch = None
+
+        packet, packet_size = [], 0
+        for send_val in batch:
+            if packet and packet_size + len(send_val) > MAX_PACKET_SIZE:
+                self._send_packet(b'\n'.join(packet))
+                packet, packet_size = [], 0
+            packet.append(send_val)
+            packet_size += len(send_val) + 1
+
+        if packet:
+            self._send_packet(b'\n'.join(packet))
+
+    def _send_packet(self, packet):
         try:
-            self._sock.send(send_val)
+            self._sock.send(packet)
         except:
             pass
 
+    def _send(self, key, value):
+        send_val = ('%s:%s' % (key, value)).encode("utf-8")
+        #print(send_val)
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            batch.append(send_val)
+            return
+        self._send_packet(send_val)
+
     def send_counter(self, key, delta):
         self._send(key, '%d|c' % delta)
 
@@ -71,6 +107,14 @@ class StatsdOutput(core.Output):
     def append(self, msg):
         self.send_to_statsd(msg)
 
+    def append_batch(self, msgs):
+        self._statsd.begin_batch()
+        try:
+            for msg in msgs:
+                self.send_to_statsd(msg)
+        finally:
+            self._statsd.end_batch()
+
     def msg_too_old(self, msg):
         """check if the message is fresh enough to make sense for statsd
         Since we don't have timestamp in the statsd message then sending messages
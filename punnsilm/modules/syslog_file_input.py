@@ -1,6 +1,4 @@
-import time
 import logging
-import datetime
 
 import iso8601
 
@@ -10,29 +8,11 @@ except ImportError:
     logging.warn("regex module not available. Performance will suffer.")
     import re
 
-from punnsilm.core import Monitor, FileMonitor, Message
-
-_MONTHMAP = {
-    'Jan': 1,
-    'Feb': 2,
-    'Mar': 3,
-    'Apr': 4,
-    'May': 5,
-    'Jun': 6,
-    'Jul': 7,
-    'Aug': 8,
-    'Sep': 9,
-    'Oct': 10,
-    'Nov': 11,
-    'Dec': 12,
-}
+from punnsilm.core import Monitor, FileMonitor, Message, LazyMessage, LazyMessageMixin
+from punnsilm.timestamp_parser import MONTHMAP, parse_rfc3164
 
-def timestamp_parser_rfc3164(raw_ts):
-    # XXX: strptime() is too slow
-    month_abbrev, date, ts_part = raw_ts.split()
-    hour, minute, second = ts_part.split(":")
-    year = time.localtime().tm_year
-    return datetime.datetime(year, _MONTHMAP[month_abbrev], int(date), int(hour), int(minute), int(second))
+# shared memoizing parser, see punnsilm/timestamp_parser.py
+timestamp_parser_rfc3164 = parse_rfc3164
 
 def timestamp_parser_iso8601(raw_ts):
     return iso8601.parse_date(raw_ts)
@@ -52,15 +32,137 @@ def parse_priority(priority):
     severity = priority - (facility * 8)
     return facility, severity
 
+# Fast path for the formats that start with RFC3164 timestamp.
+# Splits the line with fixed offsets and str.find() instead of running
+# the format regexp over the whole line. Returns the same fields as the
+# regexp would or None if the line doesn't look like what we expect,
+# in which case the caller has to fall back to the regexp.
+
+# characters allowed in the hostname by the format regexps
+_HOST_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_.')
+
+# the same timestamps and hostnames repeat on line after line so the ones
+# that have passed the checks are remembered. Cleared once they grow too big.
+_SEEN_CACHE_SIZE = 4096
+_seen_timestamps = set()
+_seen_hosts = set()
+
+def _valid_rfc3164_timestamp(ts):
+    if ts in _seen_timestamps:
+        return True
+
+    if (len(ts) == 15 and ts.isascii() and ts[:3] in MONTHMAP
+            and ts[3] == ' ' and ts[6] == ' ' and ts[9] == ':' and ts[12] == ':'
+            and ts[5].isdigit() and (ts[4] == ' ' or ts[4].isdigit())
+            and ts[7:9].isdigit() and ts[10:12].isdigit() and ts[13:15].isdigit()):
+        if len(_seen_timestamps) >= _SEEN_CACHE_SIZE:
+            _seen_timestamps.clear()
+        _seen_timestamps.add(ts)
+        return True
+
+    return False
+
+def _valid_host(host):
+    if host in _seen_hosts:
+        return True
+
+    if host and _HOST_CHARS.issuperset(host):
+        if len(_seen_hosts) >= _SEEN_CACHE_SIZE:
+            _seen_hosts.clear()
+        _seen_hosts.add(host)
+        return True
+
+    return False
+
+def split_traditional(line):
+    if line[15:16] != ' ':
+        return None
+    ts = line[:15]
+    if not _valid_rfc3164_timestamp(ts):
+        return None
+
+    end = line.find(' ', 16)
+    if end == -1:
+        return None
+    host = line[16:end]
+    if not _valid_host(host) or host[0].isdigit():
+        # hostname starting with a digit might be the optional IP address
+        return None
+
+    content = line[end+1:]
+    if content[-1:] == '\n':
+        content = content[:-1]
+    if '\n' in content:
+        return None
+
+    return {'timestamp': ts, 'host': host, 'content': content}
+
+def split_freebsd(line):
+    if line[15:17] != ' <':
+        return None
+    ts = line[:15]
+    if not _valid_rfc3164_timestamp(ts):
+        return None
+
+    end = line.find('>', 17)
+    if end == -1 or line[end+1:end+2] != ' ':
+        return None
+    facility, sep, level = line[17:end].partition('.')
+    if not (sep and facility.isascii() and facility.isalnum()
+            and level.isascii() and level.isalnum()):
+        return None
+
+    pos = end + 2
+    end = line.find(' ', pos)
+    if end == -1:
+        return None
+    host = line[pos:end]
+    if not _valid_host(host):
+        return None
+
+    content = line[end+1:]
+    if content[-1:] == '\n':
+        content = content[:-1]
+    if '\n' in content:
+        return None
+
+    return {'timestamp': ts, 'facility': facility, 'level': level, 'host': host, 'content': content}
+
 class RsyslogParser:
     MSG_CLS = Message
+    # message class used by parse_lazy(), None if the format doesn't support it
+    LAZY_MSG_CLS = LazyMessage
+    # regexp free splitter that is tried before rx_syslog_message
+    fast_split = None
 
     @classmethod
-    def parse(cls, raw_msg):
-        syslog_msg = cls.rx_syslog_message.match(raw_msg)
+    def parse_lazy(cls, raw_msg):
+        """only checks that the message is in the expected format and
+        leaves decoding of the fields to the first access
+        """
+        if cls.LAZY_MSG_CLS is None:
+            return cls.parse(raw_msg)
+
+        syslog_msg = None
+        if cls.fast_split is not None:
+            syslog_msg = cls.fast_split(raw_msg)
+        if syslog_msg is None:
+            syslog_msg = cls.rx_syslog_message.match(raw_msg)
 
         if syslog_msg:
-            md = syslog_msg.groupdict()
+            return cls.LAZY_MSG_CLS(syslog_msg, cls.time_parser)
+
+    @classmethod
+    def parse(cls, raw_msg):
+        md = None
+        if cls.fast_split is not None:
+            md = cls.fast_split(raw_msg)
+        if md is None:
+            syslog_msg = cls.rx_syslog_message.match(raw_msg)
+            if syslog_msg:
+                md = syslog_msg.groupdict()
+
+        if md is not None:
             try:
                 ts = cls.time_parser(md['timestamp'])
             except AttributeError:
@@ -73,11 +175,25 @@ class RsyslogTraditionalFileFormatParser(RsyslogParser):
     RE_SYSLOG_MESSAGE = """^(?P<timestamp>[A-Z][a-z]{2}\s+[0-9]+\s[0-9]{2}:[0-9]{2}:[0-9]{2})\s([0-9]+\.[0-9]+\.[0-9]+\.[0-9]+\s)?(?P<host>[a-zA-Z0-9\-\_\.]+)\s(?P<content>.*)$"""
     rx_syslog_message = re.compile(RE_SYSLOG_MESSAGE)
     time_parser = timestamp_parser_rfc3164
+    fast_split = staticmethod(split_traditional)
+
+class FreeBSDSyslogMessage(Message):
+    """FreeBSD syslogd can be configured to log facility and level of the message
+    """
+    __slots__ = ('facility', 'level')
+    EXTRA_FIELDS = __slots__
+
+class LazyFreeBSDSyslogMessage(LazyMessageMixin, FreeBSDSyslogMessage):
+    __slots__ = ('_fields', '_time_parser')
+    EAGER_CLS = FreeBSDSyslogMessage
 
 class FreeBSDSyslogFileFormatParser(RsyslogParser):
+    MSG_CLS = FreeBSDSyslogMessage
+    LAZY_MSG_CLS = LazyFreeBSDSyslogMessage
     RE_SYSLOG_MESSAGE = """^(?P<timestamp>[A-Z][a-z]{2}\s+[0-9]+\s[0-9]{2}:[0-9]{2}:[0-9]{2})\s<(?P<facility>\w+).(?P<level>\w+)> (?P<host>[a-zA-Z0-9\-\_\.]+)\s(?P<content>.*)$"""
     rx_syslog_message = re.compile(RE_SYSLOG_MESSAGE)
     time_parser = timestamp_parser_rfc3164
+    fast_split = staticmethod(split_freebsd)
 
 class RsyslogFileFormatParser(RsyslogParser):
     RE_SYSLOG_MESSAGE = """^(?P<timestamp>[^\s]+)\s(?P<host>[a-zA-Z0-9\-\_\.]+)\s(?P<content>.*)$"""
@@ -87,6 +203,9 @@ class RsyslogFileFormatParser(RsyslogParser):
 class RFC5424Message(Message):
     """adds some rfc5424 specific structure to the message
     """
+    __slots__ = ('priority', 'appname', 'procid', 'msgid', 'SD', 'facility', 'severity')
+    EXTRA_FIELDS = ('priority', 'appname', 'procid', 'msgid', 'SD')
+
     def __init__(self, *kwargs):
         Message.__init__(self, *kwargs)
         self.parse_priority(self.priority)
@@ -101,6 +220,8 @@ class RFC5424Message(Message):
 
 class RsyslogProtocol23FormatParser(RsyslogParser):
     MSG_CLS = RFC5424Message
+    # facility and severity are derived from the priority on construction
+    LAZY_MSG_CLS = None
     # XXX: SD-ELEMENT parser isn't rfc5424 conformant
     RE_SYSLOG_MESSAGE = """^\<(?P<priority>\d{1,3})\>1 (?P<timestamp>[^\s]+)\s(?P<host>[^\s]+)\s(?P<appname>[^\s]+)\s(?P<procid>[^\s]+)\s(?P<msgid>[^\s]+)\s(?P<SD>\[[a-zA-Z0-9@]+( [a-zA-Z0-9]+\="[^"]+")*\])\s(?P<content>.*)$"""
     rx_syslog_message = re.compile(RE_SYSLOG_MESSAGE)
@@ -117,6 +238,7 @@ class SyslogFileMonitor(FileMonitor):
     DEFAULT_FILE_FORMAT = 'rsyslog_traditional_file_format'
     KNOWN_ARGS = set((
         'syslog_format',
+        'lazy_parse',
     ))
 
     name = 'syslog_file_monitor'
@@ -138,6 +260,10 @@ class SyslogFileMonitor(FileMonitor):
             raise Exception
 
         self._parser = parser
+        if local_args.get('lazy_parse', False):
+            self._parse = parser.parse_lazy
+        else:
+            self._parse = parser.parse
 
     def parse_message(self, l):
-        return self._parser.parse(l)
+        return self._parse(l)
@@ -1,7 +1,5 @@
 import copy
-import time
 import logging
-import datetime
 
 try:
     import socketserver
@@ -15,6 +13,7 @@ except ImportError:
     import re
 
 from punnsilm.core import Monitor, Message
+from punnsilm.timestamp_parser import parse_rfc3164
 
 SP = "\s"
 
@@ -35,21 +34,6 @@ RFC_3164_MESSAGE = RFC_3164_HEADER + RFC_3164_MESSAGE
 rfc_3164_message_rx = re.compile(RFC_3164_MESSAGE)
 
 class RFC3164Parser(object):
-    _MONTHMAP = {
-        'Jan': 1,
-        'Feb': 2,
-        'Mar': 3,
-        'Apr': 4,
-        'May': 5,
-        'Jun': 6,
-        'Jul': 7,
-        'Aug': 8,
-        'Sep': 9,
-        'Oct': 10,
-        'Nov': 11,
-        'Dec': 12,
-    }
-
     @classmethod
     def parse_priority(cls, priority):
         # see http://www.ietf.org/rfc/rfc3164.txt 4.1.1 for the spec
@@ -57,15 +41,8 @@ class RFC3164Parser(object):
         severity = priority - (facility * 8)
         return facility, severity
 
-    @classmethod
-    def date_parser(cls, raw_ts):
-        # XXX: strptime() would be prettier but is too slow
-        # besides the RFC explictly states that the month names will be english
-        # abbreviations so there's no need for locale stuff anyway (which is what makes strptime() slow)
-        month_abbrev, date, ts_part = raw_ts.split()
-        hour, minute, second = ts_part.split(":")
-        year = time.localtime().tm_year
-        return datetime.datetime(year, cls._MONTHMAP[month_abbrev], int(date), int(hour), int(minute), int(second))
+    # shared memoizing parser, see punnsilm/timestamp_parser.py
+    date_parser = staticmethod(parse_rfc3164)
 
     @classmethod
     def parse(cls, line):
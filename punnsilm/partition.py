@@ -0,0 +1,402 @@
+import os
+import json
+import time
+import logging
+import threading
+import multiprocessing
+
+import setproctitle
+
+from . import core
+from . import codec
+from . import metrics
+from . import profiler
+from .queueing import QueuedNode
+
+# Runtime for the "processes" concurrency method.
+#
+# Every node is assigned to a partition with the "process" key in its
+# configuration. Each partition runs in its own process and owns its nodes,
+# so a node exists only once no matter how many inputs feed it. Messages
+# that cross partitions are encoded with punnsilm.codec and sent over a
+# multiprocessing queue to the inbox of the target partition, where a dispatcher thread hands them
+# to the right node. Partitions report the state and statistics of their
+# nodes back to the parent process, which writes them out as before.
+
+# partition that runs in the parent process
+MAIN_PARTITION = 'main'
+
+# how many message lists can wait in the inbox of a partition before the senders block
+INBOX_SIZE = 1000
+# messages to another partition are sent over once this many have been collected
+REMOTE_BATCH_SIZE = 256
+# or when they have waited for this long
+REMOTE_FLUSH_INTERVAL_SEC = 0.05
+# how often partitions send the state of their nodes to the parent
+STATE_REPORT_INTERVAL_SEC = 10
+# how long to wait for the partitions to finish when stopping
+STOP_TIMEOUT_SEC = 10
+
+STATS_ROOT = "/tmp/"
+
+# sent to the downstream partitions once a partition won't send anything anymore
+_EOF = '__eof__'
+
+def default_partition(node):
+    """inputs get a process of their own, everything else lives in the parent
+    """
+    if isinstance(node, core.Monitor):
+        return node.name
+    return MAIN_PARTITION
+
+def _unwrap(node):
+    if isinstance(node, QueuedNode):
+        return node.node
+    return node
+
+class PartitionSender(object):
+    """collects messages that go to nodes of one partition and sends them over in lists.
+    Messages are encoded right away so that later modifications made by the
+    other nodes in this process won't be seen on the other side.
+    """
+    def __init__(self, partition, inbox):
+        self.partition = partition
+        self._inbox = inbox
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pending_count = 0
+
+    def send(self, node_name, msgs):
+        data = codec.encode_batch(msgs)
+        with self._lock:
+            self._pending.append((node_name, data))
+            self._pending_count += len(msgs)
+            if self._pending_count >= REMOTE_BATCH_SIZE:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self._flush()
+
+    def _flush(self):
+        self._inbox.put(self._pending)
+        self._pending = []
+        self._pending_count = 0
+
+    def send_eof(self, from_partition):
+        self.flush()
+        self._inbox.put((_EOF, from_partition))
+
+class RemoteOutput(object):
+    """stands in for a node that lives in another partition
+    """
+    def __init__(self, name, sender):
+        self.name = name
+        self._sender = sender
+
+    def __str__(self):
+        return "<%s - %s@%s>" % (self.__class__.__name__, str(self.name), self._sender.partition)
+
+    def append(self, msg):
+        self._sender.send(self.name, [msg])
+
+    def append_batch(self, msgs):
+        self._sender.send(self.name, msgs)
+
+class PartitionedGraph(object):
+    """graph whose nodes are spread over several processes
+    """
+    def __init__(self, nodemap):
+        self.nodemap = nodemap
+        self._ctx = multiprocessing.get_context('fork')
+
+        # partition name -> list of node names
+        self.partitions = {}
+        for node_name, node in nodemap.items():
+            partition = getattr(node, 'partition', None) or default_partition(node)
+            node.partition = partition
+            self.partitions.setdefault(partition, []).append(node_name)
+        self.partitions.setdefault(MAIN_PARTITION, [])
+
+        # partition name -> set of partitions that it sends messages to
+        self._downstream = dict((p, set()) for p in self.partitions)
+        self._upstream = dict((p, set()) for p in self.partitions)
+        for node_name, node in nodemap.items():
+            for output_name in (node._configured_outputs or []):
+                output = nodemap.get(output_name, None)
+                if output is None or output.partition == node.partition:
+                    continue
+                self._downstream[node.partition].add(output.partition)
+                self._upstream[output.partition].add(node.partition)
+        self._check_cycles()
+
+        self._inboxes = dict((p, self._ctx.Queue(INBOX_SIZE)) for p in self.partitions)
+        self._reports = self._ctx.Queue()
+        self._stop_event = self._ctx.Event()
+
+        self._processes = {}
+        self._final_reports = set()
+        self._all_reported = threading.Event()
+        # node name -> statistics reported by the partitions
+        self.stats = {}
+        self.metrics_enabled = False
+        # partition name -> runtime counters of its nodes
+        self._metrics = {}
+
+        logging.info('graph partitions: %s' % (', '.join(
+            '%s=[%s]' % (p, ','.join(sorted(names))) for p, names in sorted(self.partitions.items())),))
+
+    def _check_cycles(self):
+        """partitions signal each other when they are done, which can't work if
+        they send messages to each other in a loop
+        """
+        visiting, done = set(), set()
+
+        def visit(partition, path):
+            if partition in done:
+                return
+            if partition in visiting:
+                raise Exception('partitions send messages to each other in a loop: %s' % (
+                    ' -> '.join(path + [partition]),))
+            visiting.add(partition)
+            for downstream in self._downstream[partition]:
+                visit(downstream, path + [partition])
+            visiting.discard(partition)
+            done.add(partition)
+
+        for partition in sorted(self.partitions):
+            visit(partition, [])
+
+    def enable_metrics(self):
+        """start keeping runtime counters of the nodes, see punnsilm.metrics.
+        Has to be called before start(). Partitions send their counters to
+        the parent together with the state of the nodes.
+        """
+        self.metrics_enabled = True
+
+    def get_metrics(self):
+        """returns node name -> runtime counters of all the partitions
+        """
+        reported = list(self._metrics.values())
+        return metrics.merge(reported + [metrics.collect(self._owned_nodes(MAIN_PARTITION))])
+
+    def enable_profiler(self):
+        """make the nodes profileable at runtime, see punnsilm.profiler.
+        Has to be called before start() and enable_metrics(). The partitions
+        get their own copies of it when they are forked.
+        returns the GraphProfiler
+        """
+        self.profiler = profiler.GraphProfiler(self.nodemap.values())
+        return self.profiler
+
+    def _owned_nodes(self, partition):
+        return [self.nodemap[name] for name in self.partitions[partition]]
+
+    def _build_view(self, partition):
+        """returns nodemap where the nodes from the other partitions have
+        been replaced with proxies that send messages to them
+        """
+        senders = {}
+        view = {}
+        for node_name, node in self.nodemap.items():
+            if node.partition == partition:
+                view[node_name] = node
+                continue
+            sender = senders.get(node.partition, None)
+            if sender is None:
+                sender = senders[node.partition] = PartitionSender(node.partition, self._inboxes[node.partition])
+            view[node_name] = RemoteOutput(node_name, sender)
+        return view, senders
+
+    def start(self):
+        """fork the partitions and start the nodes of the main partition in this process.
+        returns list of objects that can be join()ed to wait until the graph is done
+        """
+        runnables = []
+        # fork before starting any threads in this process
+        for partition in sorted(self.partitions):
+            if partition == MAIN_PARTITION:
+                continue
+            process = self._ctx.Process(target=self._partition_main, args=(partition,), name='punnsilm: %s' % (partition,))
+            process.daemon = True
+            process.start()
+            self._processes[partition] = process
+            runnables.append(process)
+
+        collector = threading.Thread(target=self._collect_reports)
+        collector.daemon = True
+        collector.start()
+
+        if not self._processes:
+            self._all_reported.set()
+
+        main = threading.Thread(target=self._run_partition, args=(MAIN_PARTITION,))
+        main.daemon = True
+        main.start()
+        runnables.append(main)
+
+        return runnables
+
+    def _partition_main(self, partition):
+        setproctitle.setproctitle('punnsilm: %s' % (partition,))
+        try:
+            self._run_partition(partition)
+        except:
+            logging.exception('partition %s failed' % (partition,))
+            raise
+
+    def _run_partition(self, partition):
+        view, senders = self._build_view(partition)
+        owned = self._owned_nodes(partition)
+
+        for node in owned:
+            node.connect_outputs(view)
+
+        if self.metrics_enabled:
+            metrics.instrument(owned)
+            metrics.wrap_hops([node for node in view.values() if isinstance(node, RemoteOutput)])
+            metrics.instrument_sources(owned)
+
+        dispatcher = threading.Thread(target=self._dispatch, args=(partition, view))
+        dispatcher.daemon = True
+        dispatcher.start()
+
+        monitors = []
+        for node in owned:
+            runnable = node.run()
+            if isinstance(node, core.Monitor) and runnable is not None:
+                monitors.append(runnable)
+
+        done = threading.Event()
+        flusher = threading.Thread(target=self._flush_loop, args=(partition, owned, senders, done))
+        flusher.daemon = True
+        flusher.start()
+
+        # our inputs are done once all the monitors have finished
+        for monitor in monitors:
+            while monitor.is_alive():
+                monitor.join(1)
+                if self._stop_event.is_set():
+                    # tailing monitor might never notice that it was asked to stop
+                    monitor.join(STOP_TIMEOUT_SEC)
+                    break
+
+        # and everything upstream is done once they have all said so
+        dispatcher.join()
+
+        # nodes in the partition might feed each other so keep going until all of them are idle at once
+        busy = [node for node in owned if not isinstance(node, core.Monitor)]
+        while not all([node.wait_idle(0) for node in busy]):
+            for node in busy:
+                node.wait_idle()
+
+        done.set()
+        for downstream in self._downstream[partition]:
+            sender = senders.get(downstream, None)
+            if sender is None:
+                sender = PartitionSender(downstream, self._inboxes[downstream])
+            sender.send_eof(partition)
+
+        if partition != MAIN_PARTITION:
+            self._report(partition, owned, final=True)
+        logging.info('partition %s finished' % (partition,))
+
+    def _dispatch(self, partition, view):
+        """feed the messages that arrive from the other partitions to our nodes
+        returns once all the upstream partitions are done
+        """
+        inbox = self._inboxes[partition]
+        waiting = set(self._upstream[partition])
+
+        while waiting:
+            item = inbox.get()
+            if isinstance(item, tuple):
+                # (_EOF, partition)
+                waiting.discard(item[1])
+                continue
+
+            for node_name, data in item:
+                msgs = codec.decode_batch(data)
+                node = view[node_name]
+                try:
+                    if len(msgs) == 1:
+                        node.append(msgs[0])
+                    else:
+                        node.append_batch(msgs)
+                except Exception:
+                    logging.exception('%s failed to process messages' % (str(node),))
+
+    def _flush_loop(self, partition, owned, senders, done):
+        next_report = time.time() + STATE_REPORT_INTERVAL_SEC
+        stopped = False
+        while not done.wait(REMOTE_FLUSH_INTERVAL_SEC):
+            for sender in list(senders.values()):
+                sender.flush()
+            if partition != MAIN_PARTITION and time.time() >= next_report:
+                self._report(partition, owned)
+                next_report = time.time() + STATE_REPORT_INTERVAL_SEC
+
+            # polled instead of waited for. Event.set() hangs if some process
+            # exits while it's waiting for the event
+            if not stopped and self._stop_event.is_set():
+                for node in owned:
+                    if isinstance(node, core.Monitor):
+                        node.stop()
+                stopped = True
+
+    def _report(self, partition, owned, final=False):
+        states, stats = {}, {}
+        for node in owned:
+            states[node.name] = node.get_state()
+            node_stats = node.get_stats()
+            if node_stats:
+                stats[node.name] = node_stats
+        node_metrics = None
+        if self.metrics_enabled:
+            node_metrics = metrics.collect(owned)
+        self._reports.put((partition, states, stats, node_metrics, final))
+
+    def _collect_reports(self):
+        """apply state and statistics reported by the partitions to our copies of the nodes
+        """
+        while 1:
+            partition, states, stats, node_metrics, final = self._reports.get()
+            for node_name, state in states.items():
+                _unwrap(self.nodemap[node_name]).replace_state(state)
+            self.stats.update(stats)
+            if node_metrics is not None:
+                self._metrics[partition] = node_metrics
+            self.write_stats()
+
+            if final:
+                self._final_reports.add(partition)
+                if len(self._final_reports) == len(self._processes):
+                    self._all_reported.set()
+
+    def write_stats(self):
+        stats = dict(self.stats)
+        for node in self._owned_nodes(MAIN_PARTITION):
+            node_stats = node.get_stats()
+            if node_stats:
+                stats[node.name] = node_stats
+
+        stats_file = os.path.join(STATS_ROOT, "punnsilm_partition_stats.json")
+        with open(stats_file, "w+") as fd:
+            fd.write(json.dumps(stats, sort_keys=True, indent=4, default=str))
+
+    def stop(self):
+        self._stop_event.set()
+        for node in self._owned_nodes(MAIN_PARTITION):
+            if isinstance(node, core.Monitor):
+                node.stop()
+
+        deadline = time.time() + STOP_TIMEOUT_SEC
+        for process in self._processes.values():
+            process.join(max(deadline - time.time(), 0))
+        # make sure that we have the final state of the nodes before it's written out
+        self._all_reported.wait(max(deadline - time.time(), 0))
+
+        for node in self._owned_nodes(MAIN_PARTITION):
+            if not isinstance(node, core.Monitor):
+                node.stop()
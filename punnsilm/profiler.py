@@ -0,0 +1,342 @@
+import os
+import sys
+import time
+import signal
+import socket
+import cProfile
+import logging
+import threading
+import collections
+
+from . import core
+
+# Profiling of a running graph.
+#
+# GraphProfiler wraps append() and append_batch() of the nodes and
+# parse_message() of the inputs once on startup. The wrappers do nothing but
+# check a flag until profiling is started, either for a signal or for a
+# command from the control socket. There are two modes:
+#
+#  - deterministic: every node gets a cProfile.Profile that is enabled only
+#    while the node itself is running, it's switched off for the time the
+#    node spends in its outputs. Accurate but slow, meant for short windows.
+#    Written out as pstats files.
+#  - sampling: a thread looks at the stacks of all the threads every few
+#    milliseconds and counts them for the node that was running. Cheap
+#    enough to leave on for a while. Written out as collapsed stacks that
+#    flamegraph.pl and similar tools take as input.
+#
+# Profiles of the nodes are written to PROFILE_ROOT as
+# punnsilm_profile_NODENAME.PID.pstats or .collapsed
+
+MODE_DETERMINISTIC = 'deterministic'
+MODE_SAMPLING = 'sampling'
+KNOWN_MODES = (MODE_DETERMINISTIC, MODE_SAMPLING)
+
+PROFILE_ROOT = "/tmp/"
+# profiling is stopped after this many seconds unless told otherwise
+DEFAULT_WINDOW_SEC = {
+    MODE_DETERMINISTIC: 30,
+    MODE_SAMPLING: 300,
+}
+SAMPLE_INTERVAL_SEC = 0.005
+# how long to wait for the nodes to leave the profiled calls when stopping
+STOP_GRACE_SEC = 2
+
+# signal that toggles the profiling of the whole graph in the given mode
+SIGNAL_MODES = {
+    signal.SIGUSR1: MODE_DETERMINISTIC,
+    signal.SIGUSR2: MODE_SAMPLING,
+}
+
+class _NodeProfile(object):
+    def __init__(self, name):
+        self.name = name
+        self.selected = False
+        self.profile = None
+        self.samples = collections.Counter()
+
+def _describe_frame(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+class GraphProfiler(object):
+    """profiles the nodes of the graph on demand
+    """
+    def __init__(self, nodes):
+        # node name -> _NodeProfile
+        self.nodes = {}
+        self.mode = None
+        self._lock = threading.Lock()
+        # thread id -> stack of [_NodeProfile, entry frame, profile enabled]
+        self._stacks = {}
+        # thread id -> input node that owns the thread
+        self._thread_owner = {}
+        self._sampler = None
+        self._timer = None
+        self._started = None
+
+        for node in nodes:
+            node = getattr(node, 'node', node)
+            node_profile = self.nodes[node.name] = _NodeProfile(node.name)
+            if isinstance(node, core.Monitor):
+                node.parse_message = self._wrap(node_profile, node.parse_message, owns_thread=True)
+                continue
+            if hasattr(node, 'append'):
+                node.append = self._wrap(node_profile, node.append)
+            node.append_batch = self._wrap(node_profile, node.append_batch)
+
+    def _wrap(self, node_profile, func, owns_thread=False):
+        def profiled(arg):
+            if self.mode is None:
+                return func(arg)
+            if owns_thread:
+                self._thread_owner[threading.get_ident()] = node_profile
+            return self._call(node_profile, func, arg)
+        return profiled
+
+    def _call(self, node_profile, func, arg):
+        ident = threading.get_ident()
+        stack = self._stacks.get(ident, None)
+        if stack is None:
+            stack = self._stacks.setdefault(ident, [])
+
+        prev = None
+        if stack:
+            prev = stack[-1]
+            if prev[0] is node_profile:
+                # node feeding itself, for example append_batch() calling append()
+                return func(arg)
+
+        entry = [node_profile, sys._getframe(), False]
+        if prev is not None and prev[2]:
+            prev[0].profile.disable()
+        if self.mode == MODE_DETERMINISTIC and node_profile.profile is not None:
+            node_profile.profile.enable()
+            entry[2] = True
+        stack.append(entry)
+        try:
+            return func(arg)
+        finally:
+            stack.pop()
+            if entry[2]:
+                node_profile.profile.disable()
+            if prev is not None and prev[2]:
+                if self.mode == MODE_DETERMINISTIC:
+                    prev[0].profile.enable()
+                else:
+                    prev[2] = False
+
+    def start(self, mode, node_names=None, duration=None):
+        """start profiling the given nodes, all of them if node_names is None.
+        Stops by itself after duration seconds, default depends on the mode
+        """
+        if mode not in KNOWN_MODES:
+            raise Exception('unknown profiling mode %s, known modes are %s' % (mode, KNOWN_MODES))
+        if node_names is not None:
+            unknown = set(node_names) - set(self.nodes)
+            if unknown:
+                raise Exception('unknown nodes: %s' % (', '.join(sorted(unknown)),))
+        if duration is None:
+            duration = DEFAULT_WINDOW_SEC[mode]
+
+        with self._lock:
+            if self.mode is not None:
+                raise Exception('%s profiling is already running' % (self.mode,))
+
+            for node_profile in self.nodes.values():
+                node_profile.selected = node_names is None or node_profile.name in node_names
+                node_profile.samples = collections.Counter()
+                node_profile.profile = None
+                if node_profile.selected and mode == MODE_DETERMINISTIC:
+                    node_profile.profile = cProfile.Profile()
+
+            self._started = time.time()
+            self.mode = mode
+            if mode == MODE_SAMPLING:
+                self._sampler = threading.Thread(target=self._sample, name='punnsilm: profiler')
+                self._sampler.daemon = True
+                self._sampler.start()
+            if duration:
+                self._timer = threading.Timer(duration, self.stop)
+                self._timer.daemon = True
+                self._timer.start()
+
+        logging.warn('started %s profiling of %s for %s seconds' % (
+            mode, 'all the nodes' if node_names is None else ', '.join(sorted(node_names)), duration))
+
+    def stop(self):
+        """stop profiling and write out the profiles.
+        returns list of the files written
+        """
+        with self._lock:
+            mode = self.mode
+            if mode is None:
+                return []
+            self.mode = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        if mode == MODE_SAMPLING:
+            self._sampler.join()
+            self._sampler = None
+        else:
+            # wait for the nodes to switch off their profilers
+            deadline = time.time() + STOP_GRACE_SEC
+            while self._profiles_enabled() and time.time() < deadline:
+                time.sleep(0.01)
+
+        files = self._write(mode)
+        logging.warn('%s profiling stopped after %.1f seconds, wrote %s' % (
+            mode, time.time() - self._started, ', '.join(files) or 'nothing'))
+        return files
+
+    def toggle(self, mode):
+        """start profiling the whole graph in the given mode or stop whatever is running
+        """
+        if self.mode is None:
+            self.start(mode)
+            return []
+        return self.stop()
+
+    def status(self):
+        if self.mode is None:
+            return 'idle'
+        selected = [name for name, node_profile in sorted(self.nodes.items()) if node_profile.selected]
+        return '%s profiling of %s running for %.1f seconds' % (
+            self.mode, ', '.join(selected), time.time() - self._started)
+
+    def _profiles_enabled(self):
+        for stack in list(self._stacks.values()):
+            for entry in list(stack):
+                if entry[2]:
+                    return True
+        return False
+
+    def _sample(self):
+        own_ident = threading.get_ident()
+        while self.mode == MODE_SAMPLING:
+            time.sleep(SAMPLE_INTERVAL_SEC)
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                entry_frame = None
+                try:
+                    node_profile, entry_frame = self._stacks[ident][-1][:2]
+                except (KeyError, IndexError):
+                    node_profile = self._thread_owner.get(ident, None)
+                if node_profile is None or not node_profile.selected:
+                    continue
+
+                stack = []
+                while frame is not None and frame is not entry_frame:
+                    stack.append(_describe_frame(frame))
+                    frame = frame.f_back
+                stack.reverse()
+                node_profile.samples[';'.join(stack)] += 1
+
+    def _write(self, mode):
+        files = []
+        pid = os.getpid()
+        for name, node_profile in sorted(self.nodes.items()):
+            if not node_profile.selected:
+                continue
+            filename = os.path.join(PROFILE_ROOT, 'punnsilm_profile_%s.%d' % (name, pid))
+            if mode == MODE_DETERMINISTIC:
+                profile = node_profile.profile
+                node_profile.profile = None
+                if not profile.getstats():
+                    continue
+                filename += '.pstats'
+                profile.dump_stats(filename)
+            else:
+                if not node_profile.samples:
+                    continue
+                filename += '.collapsed'
+                with open(filename, 'w') as fd:
+                    for stack, count in sorted(node_profile.samples.items()):
+                        fd.write('%s %d\n' % (stack, count))
+            files.append(filename)
+        return files
+
+    def install_signal_handlers(self):
+        """SIGUSR1 toggles deterministic and SIGUSR2 sampling profiling of the whole graph.
+        Has to be called from the main thread. The handlers survive the fork
+        of the partitions, so every process can be signalled on its own.
+        """
+        def handler(signum, frame):
+            # writing the profiles out takes a while, don't do it in the signal handler
+            worker = threading.Thread(target=self._toggle_safely, args=(SIGNAL_MODES[signum],))
+            worker.daemon = True
+            worker.start()
+
+        for signum in SIGNAL_MODES:
+            signal.signal(signum, handler)
+
+    def _toggle_safely(self, mode):
+        try:
+            self.toggle(mode)
+        except Exception:
+            logging.exception('failed to toggle %s profiling' % (mode,))
+
+    def serve(self, path):
+        """accept commands on unix socket at path. Every connection takes one line:
+
+            start MODE [NODE,NODE...] [SECONDS]
+            stop
+            status
+
+        and gets back the result
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(5)
+
+        worker = threading.Thread(target=self._serve, args=(server,), name='punnsilm: profiler control')
+        worker.daemon = True
+        worker.start()
+        logging.info('profiler listens for commands on %s' % (path,))
+        return server
+
+    def _serve(self, server):
+        while 1:
+            try:
+                conn, addr = server.accept()
+            except OSError:
+                # socket was closed
+                return
+            with conn:
+                try:
+                    request = conn.makefile('r').readline()
+                    reply = self.command(request)
+                except Exception as e:
+                    reply = 'error: %s' % (e,)
+                conn.sendall((reply + '\n').encode('utf-8'))
+
+    def command(self, line):
+        """executes control command, returns the reply
+        """
+        args = line.split()
+        if not args:
+            raise Exception('empty command')
+
+        if args[0] == 'start':
+            if len(args) < 2:
+                raise Exception('usage: start MODE [NODE,NODE...] [SECONDS]')
+            node_names, duration = None, None
+            for arg in args[2:]:
+                try:
+                    duration = float(arg)
+                except ValueError:
+                    node_names = arg.split(',')
+            self.start(args[1], node_names, duration)
+            return 'ok'
+        elif args[0] == 'stop':
+            return '\n'.join(self.stop()) or 'nothing was written'
+        elif args[0] == 'status':
+            return self.status()
+
+        raise Exception('unknown command %s' % (args[0],))
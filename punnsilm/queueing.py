@@ -0,0 +1,370 @@
+import os
+import json
+import time
+import logging
+import threading
+import collections
+
+from . import codec
+
+# Nodes that have "queue" in their configuration are wrapped in QueuedNode.
+# Messages sent to them are put into a bounded queue and a separate worker thread
+# feeds them to the real node, so that a slow output wouldn't stall the input
+# that feeds it and all the other branches of the graph.
+
+# wait until there's room in the queue
+POLICY_BLOCK = 'block'
+# throw away the messages that don't fit
+POLICY_DROP_NEWEST = 'drop_newest'
+# make room by throwing away the oldest messages in the queue
+POLICY_DROP_OLDEST = 'drop_oldest'
+# write messages that don't fit into a file and read them back later
+POLICY_SPILL = 'spill'
+
+KNOWN_POLICIES = (POLICY_BLOCK, POLICY_DROP_NEWEST, POLICY_DROP_OLDEST, POLICY_SPILL)
+
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_POLICY = POLICY_BLOCK
+# worker hands at most this many messages to the node at once
+DEFAULT_MAX_BATCH = 1000
+DEFAULT_SPILL_DIR = "/tmp/"
+
+STATS_ROOT = "/tmp/"
+STATS_WRITE_INTERVAL_SEC = 60
+
+class OverflowQueue(object):
+    """bounded FIFO of messages with configurable overflow policy.
+
+    Messages are put in and taken out in lists. Size limit is in messages,
+    not in lists. Safe to use from several threads.
+    """
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, policy=DEFAULT_POLICY, spill_file=None):
+        if policy not in KNOWN_POLICIES:
+            raise Exception('unknown queue overflow policy %s, known policies are %s' % (policy, KNOWN_POLICIES))
+        if policy == POLICY_SPILL and spill_file is None:
+            raise Exception('spill_file has to be specified for the spill policy')
+
+        self.maxsize = maxsize
+        self.policy = policy
+
+        self._entries = collections.deque()
+        # number of messages in the memory
+        self._depth = 0
+
+        self._spill_file = spill_file
+        self._spill_writer = None
+        self._spill_reader = None
+        # number of messages in the spill file that haven't been read back yet
+        self._spilled_depth = 0
+
+        # messages that have been put in but not yet reported as done
+        self._unfinished = 0
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+
+        self._closed = False
+
+        self.counters = {
+            'enqueued': 0,
+            'dropped': 0,
+            'spilled': 0,
+            'max_depth': 0,
+        }
+
+    def __len__(self):
+        return self._depth + self._spilled_depth
+
+    def put(self, msgs):
+        """add list of messages to the queue
+        returns number of messages that were dropped
+        """
+        with self._lock:
+            dropped = self._put(msgs)
+            self.counters['dropped'] += dropped
+            if self._depth > self.counters['max_depth']:
+                self.counters['max_depth'] = self._depth
+            return dropped
+
+    def _put(self, msgs):
+        n = len(msgs)
+        if self._spilled_depth:
+            # keep the order, nothing goes into memory until the spill file is read back
+            self._spill(msgs)
+            return 0
+
+        if self._depth + n > self.maxsize:
+            if self.policy == POLICY_BLOCK:
+                # batch that is bigger than the whole queue is let in once the queue is empty
+                while self._depth and self._depth + n > self.maxsize and not self._closed:
+                    self._not_full.wait()
+            elif self.policy == POLICY_DROP_NEWEST:
+                room = max(self.maxsize - self._depth, 0)
+                self._append(msgs[:room])
+                return n - room
+            elif self.policy == POLICY_DROP_OLDEST:
+                if n > self.maxsize:
+                    dropped = n - self.maxsize + self._depth
+                    msgs = msgs[-self.maxsize:]
+                    self._discard_all()
+                else:
+                    dropped = self._depth + n - self.maxsize
+                    self._discard_oldest(dropped)
+                self._append(msgs)
+                return dropped
+            elif self.policy == POLICY_SPILL:
+                self._spill(msgs)
+                return 0
+
+        self._append(msgs)
+        return 0
+
+    def _append(self, msgs):
+        if not msgs:
+            return
+        self._entries.append(msgs)
+        self._depth += len(msgs)
+        self._unfinished += len(msgs)
+        self.counters['enqueued'] += len(msgs)
+        self._not_empty.notify()
+
+    def _discard_oldest(self, count):
+        entries = self._entries
+        while count > 0:
+            entry = entries[0]
+            if len(entry) <= count:
+                entries.popleft()
+                removed = len(entry)
+            else:
+                entries[0] = entry[count:]
+                removed = count
+            count -= removed
+            self._depth -= removed
+            self._unfinished -= removed
+        self._notify_if_done()
+
+    def _discard_all(self):
+        self._discard_oldest(self._depth)
+
+    def _spill(self, msgs):
+        if self._spill_writer is None:
+            self._spill_writer = open(self._spill_file, 'wb')
+            self._spill_reader = open(self._spill_file, 'rb')
+        codec.write_batch(self._spill_writer, msgs)
+        self._spill_writer.flush()
+
+        self._spilled_depth += len(msgs)
+        self._unfinished += len(msgs)
+        self.counters['enqueued'] += len(msgs)
+        self.counters['spilled'] += len(msgs)
+        self._not_empty.notify()
+
+    def _unspill(self):
+        msgs = codec.read_batch(self._spill_reader)
+        self._spilled_depth -= len(msgs)
+        if not self._spilled_depth:
+            # everything has been read back, start from scratch next time
+            self._spill_writer.close()
+            self._spill_reader.close()
+            self._spill_writer = self._spill_reader = None
+            os.unlink(self._spill_file)
+        return msgs
+
+    def get(self, max_items=DEFAULT_MAX_BATCH, timeout=None):
+        """returns list of up to max_items messages, blocking until there is at least one.
+        Returns None if the timeout passes or the queue is closed and empty.
+        Every returned list has to be acknowledged with task_done().
+        """
+        with self._lock:
+            while not self._depth and not self._spilled_depth:
+                if self._closed:
+                    return None
+                if not self._not_empty.wait(timeout) and timeout is not None:
+                    return None
+
+            if not self._depth:
+                return self._unspill()
+
+            retl = self._entries.popleft()
+            if self._entries and len(retl) + len(self._entries[0]) <= max_items:
+                retl = list(retl)
+                while self._entries and len(retl) + len(self._entries[0]) <= max_items:
+                    retl.extend(self._entries.popleft())
+            self._depth -= len(retl)
+            self._not_full.notify_all()
+            return retl
+
+    def task_done(self, count):
+        with self._lock:
+            self._unfinished -= count
+            self._notify_if_done()
+
+    def _notify_if_done(self):
+        if not self._unfinished:
+            self._all_done.notify_all()
+
+    def join(self, timeout=None):
+        """wait until all the messages that have been put in are processed
+        returns False if the timeout passed before that
+        """
+        with self._lock:
+            while self._unfinished:
+                if not self._all_done.wait(timeout) and timeout is not None:
+                    break
+            return not self._unfinished
+
+    def close(self):
+        """wake up everybody waiting on the queue. Get returns None once
+        the queue has been emptied.
+        """
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    def get_counters(self):
+        with self._lock:
+            retd = dict(self.counters)
+            retd['depth'] = self._depth
+            retd['spilled_depth'] = self._spilled_depth
+            return retd
+
+class QueuedNode(object):
+    """stands in for a node in the graph and feeds the messages that are sent
+    to it to the real node from a separate worker thread.
+    Everything except append() and append_batch() is passed on to the real node.
+    """
+    KNOWN_ARGS = set((
+        'size',
+        'policy',
+        'max_batch',
+        'spill_dir',
+    ))
+
+    def __init__(self, node, queue_conf=None):
+        if queue_conf is None or queue_conf is True:
+            queue_conf = {}
+
+        for key in queue_conf:
+            if key not in self.KNOWN_ARGS:
+                raise Exception('unknown queue parameter %s for node %s' % (key, node.name))
+
+        self.node = node
+        self.name = node.name
+
+        policy = queue_conf.get('policy', DEFAULT_POLICY)
+        spill_dir = queue_conf.get('spill_dir', DEFAULT_SPILL_DIR)
+        self._spill_file_template = os.path.join(spill_dir, "punnsilm_spill_%s.%%d.msgs" % (self.name,))
+        self._queue_args = {
+            'maxsize': int(queue_conf.get('size', DEFAULT_QUEUE_SIZE)),
+            'policy': policy,
+        }
+        self._max_batch = int(queue_conf.get('max_batch', DEFAULT_MAX_BATCH))
+
+        self.queue = None
+        # set while we are dropping messages so that we wouldn't flood the log
+        self._dropping = False
+        self._worker = None
+        # worker threads don't survive fork() so we have to know
+        # in which process the current one was started
+        self._worker_pid = None
+        self._worker_lock = threading.Lock()
+        self._stats_written = time.time()
+
+    def __getattr__(self, name):
+        if name == 'node':
+            # not initialized yet
+            raise AttributeError(name)
+        return getattr(self.node, name)
+
+    def __str__(self):
+        return "<%s - %s>" % (self.__class__.__name__, str(self.name))
+
+    def _start_worker(self):
+        with self._worker_lock:
+            pid = os.getpid()
+            if self._worker_pid == pid:
+                # another thread got here first
+                return
+            spill_file = None
+            if self._queue_args['policy'] == POLICY_SPILL:
+                spill_file = self._spill_file_template % (pid,)
+            self.queue = OverflowQueue(spill_file=spill_file, **self._queue_args)
+            self._worker = threading.Thread(target=self._work, name='punnsilm queue: %s' % (self.name,))
+            self._worker.daemon = True
+            self._worker.start()
+            self._worker_pid = pid
+
+    def append(self, msg):
+        self.append_batch([msg])
+
+    def append_batch(self, msgs):
+        if self._worker_pid != os.getpid():
+            self._start_worker()
+
+        if self.queue.put(msgs):
+            if not self._dropping:
+                logging.warn('%s: queue is full, dropping messages' % (str(self),))
+                self._dropping = True
+        elif self._dropping:
+            logging.warn('%s: queue has room again. %d messages dropped so far' % (
+                str(self), self.queue.counters['dropped']))
+            self._dropping = False
+
+    def _work(self):
+        queue = self.queue
+        node = self.node
+        while 1:
+            msgs = queue.get(self._max_batch, timeout=STATS_WRITE_INTERVAL_SEC)
+            if msgs is not None:
+                try:
+                    if len(msgs) == 1:
+                        node.append(msgs[0])
+                    else:
+                        node.append_batch(msgs)
+                except Exception:
+                    logging.exception('%s: failed to process messages' % (str(self),))
+                finally:
+                    queue.task_done(len(msgs))
+            elif queue._closed:
+                return
+
+            if time.time() - self._stats_written > STATS_WRITE_INTERVAL_SEC:
+                self.write_stats()
+
+    def get_queue_counters(self):
+        if self.queue is None:
+            return {}
+        return self.queue.get_counters()
+
+    def get_stats(self):
+        stats = {'queue': self.get_queue_counters()}
+        node_stats = self.node.get_stats()
+        if node_stats:
+            stats['node'] = node_stats
+        return stats
+
+    def write_stats(self):
+        self._stats_written = time.time()
+        stats_file = os.path.join(STATS_ROOT, "punnsilm_queue_stats_%s.json" % (self.name,))
+        with open(stats_file, "w+") as fd:
+            fd.write(json.dumps(self.get_queue_counters(), sort_keys=True, indent=4))
+
+    def wait_idle(self, timeout=None):
+        """wait until everything that has been sent to this node has been processed
+        """
+        if self.queue is None or self._worker_pid != os.getpid():
+            return self.node.wait_idle(timeout)
+        return self.queue.join(timeout) and self.node.wait_idle(timeout)
+
+    def run(self):
+        return self.node.run()
+
+    def stop(self):
+        if self.queue is not None and self._worker_pid == os.getpid():
+            self.queue.close()
+            self._worker.join()
+            self.write_stats()
+        self.node.stop()
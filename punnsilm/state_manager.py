@@ -4,6 +4,7 @@ import os
 import json
 import logging
 import datetime
+import threading
 
 # state_* functions provide simple means for saving information
 # about node states that has to survive over executions.
@@ -12,6 +13,11 @@ import datetime
 # restarted.
 
 STATE_FILE = "/tmp/punnsilm_state.json"
+# how often the state is written out while running
+CHECKPOINT_INTERVAL_SEC = 10
+
+# periodic writes and the final one on exit might overlap
+_write_lock = threading.Lock()
 
 def ts_serializer(obj):
     """custom JSON serializer for datetime objects since JSON doesn't have
@@ -22,22 +28,60 @@ def ts_serializer(obj):
     raise TypeError(repr(obj) + " is not JSON serializable")
 
 def state_writer(nodemap):
-    """write node states out to stable storage
+    """write node states out to stable storage.
+    The new state is written into a temporary file that is renamed over the
+    old one so a crash in the middle leaves the previous state in place.
     """
-    logging.info("writing out state information")
-    # ensure that the state file exists and truncate it if so
-    with open(STATE_FILE, "w+") as fd:
-        pass
+    logging.debug("writing out state information")
 
     state_dict = {}
     for key, node in nodemap.items():
         state_dict[key] = node.get_state()
+    serialized_contents = json.dumps(state_dict, default=ts_serializer, indent=2)
+
+    with _write_lock:
+        tmp_filename = STATE_FILE + '.tmp'
+        with open(tmp_filename, 'w') as fd:
+            fd.write(serialized_contents)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_filename, STATE_FILE)
+
+    logging.debug("state written")
+
+class StateCheckpointer(object):
+    """writes the state of the nodes out every interval seconds so that after
+    a crash we would continue from close to where we were and not from the
+    state of the last clean exit
+    """
+    def __init__(self, nodemap, interval=CHECKPOINT_INTERVAL_SEC):
+        self.nodemap = nodemap
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._worker = None
+
+    def start(self):
+        self._worker = threading.Thread(target=self._run, name='punnsilm: checkpointer')
+        self._worker.daemon = True
+        self._worker.start()
 
-    with open(STATE_FILE, 'w+') as fd:
-        serialized_contents = json.dumps(state_dict, default=ts_serializer, indent=2)
-        fd.write(serialized_contents)
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                state_writer(self.nodemap)
+            except Exception:
+                # nodes might have changed their state in the middle, try again the next time
+                logging.exception('failed to write out the state')
 
-    logging.info("state writter")
+    def stop(self):
+        """stop the periodic writes and write out the final state
+        """
+        self._stop_event.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        logging.info("writing out state information")
+        state_writer(self.nodemap)
 
 def _state_convert(input_dict):
     """recursively cast some contents of the input_dict into correct types
@@ -68,7 +112,11 @@ def state_read(node_name=None):
         state_file = fd.read()
         if state_file == '':
             return state_map
-        state_map = json.loads(state_file)
+        try:
+            state_map = json.loads(state_file)
+        except ValueError as e:
+            logging.warn('ignoring broken state file %s: %s' % (STATE_FILE, str(e)))
+            return state_map
         state_map = _state_convert(state_map)
 
     if node_name is None:
@@ -0,0 +1,98 @@
+import time
+import datetime
+import functools
+
+# shared timestamp parsing for the syslog inputs.
+#
+# RFC3164 timestamps look like "Apr 11 13:35:01" and are repeated for
+# every line logged within the same second, so the parser remembers
+# what it has already seen instead of building new datetime for each line.
+
+MONTHMAP = {
+    'Jan': 1,
+    'Feb': 2,
+    'Mar': 3,
+    'Apr': 4,
+    'May': 5,
+    'Jun': 6,
+    'Jul': 7,
+    'Aug': 8,
+    'Sep': 9,
+    'Oct': 10,
+    'Nov': 11,
+    'Dec': 12,
+}
+
+DEFAULT_CACHE_SIZE = 1024
+# timestamps can be this much ahead of the local clock
+MAX_CLOCK_SKEW = datetime.timedelta(days=1)
+
+class RFC3164TimestampParser(object):
+    """turns RFC3164 timestamps into datetime objects.
+
+    The timestamp doesn't contain the year so the year that puts it closest
+    to the local clock is picked. Next year is only considered if that puts
+    it at most MAX_CLOCK_SKEW ahead, so messages from January seen in December
+    belong to the next year only when the clock of the sender is slightly
+    ahead, and old January logs read in December stay in the current year.
+    """
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE, clock=time.time):
+        self._clock = clock
+        # (raw_ts, datetime) of the last call. Kept in a single tuple so that
+        # parallel threads always see matching pair
+        self._last = (None, None)
+        # (year, month, day) of the local clock that the cached values were computed for
+        self._context = None
+        # clock value at which the context has to be checked again
+        self._next_refresh = 0
+        self._cached_parse = functools.lru_cache(maxsize=cache_size)(self._parse)
+
+    def __call__(self, raw_ts):
+        last_raw, last_ts = self._last
+        if raw_ts == last_raw:
+            return last_ts
+
+        if self._clock() >= self._next_refresh:
+            self._refresh_context()
+
+        ts = self._cached_parse(raw_ts)
+        self._last = (raw_ts, ts)
+        return ts
+
+    def _refresh_context(self):
+        now = self._clock()
+        lt = time.localtime(now)
+        context = (lt.tm_year, lt.tm_mon, lt.tm_mday)
+        # mktime() takes care of the day overflowing into the next month
+        self._next_refresh = time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+
+        if context != self._context:
+            # year of the already parsed timestamps might be different now
+            self._cached_parse.cache_clear()
+            self._last = (None, None)
+            self._context = context
+
+    def _parse(self, raw_ts):
+        # XXX: strptime() is too slow
+        month_abbrev, date, ts_part = raw_ts.split()
+        hour, minute, second = ts_part.split(":")
+        month = MONTHMAP[month_abbrev]
+
+        now = datetime.datetime.fromtimestamp(self._clock())
+        year = self._context[0]
+        candidates = []
+        for candidate_year in (year - 1, year, year + 1):
+            try:
+                ts = datetime.datetime(candidate_year, month, int(date), int(hour), int(minute), int(second))
+            except ValueError:
+                # Feb 29 of some other year
+                continue
+            if candidate_year <= year or ts - now <= MAX_CLOCK_SKEW:
+                candidates.append(ts)
+        if not candidates:
+            raise ValueError('invalid timestamp %s' % (raw_ts,))
+
+        return min(candidates, key=lambda ts: abs(ts - now))
+
+# shared by all the RFC3164 parsers
+parse_rfc3164 = RFC3164TimestampParser()
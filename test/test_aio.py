@@ -0,0 +1,178 @@
+import os
+import time
+import datetime
+import socket
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+
+from punnsilm import core
+from punnsilm.aio import AsyncGraph, AsyncNodeProxy
+from punnsilm.modules.aio_syslog_input import AsyncSyslogMonitor
+from punnsilm.modules.syslog_file_input import SyslogFileMonitor
+
+class Collector(core.Output):
+    def __init__(self, name):
+        core.Output.__init__(self, name=name)
+        self.seen = []
+        self.threads = set()
+
+    def append(self, msg):
+        self.threads.add(threading.current_thread().name)
+        self.seen.append((msg.host, msg.content))
+
+class AsyncCollector(core.Output):
+    def __init__(self, name):
+        core.Output.__init__(self, name=name)
+        self.seen = []
+
+    async def aappend_batch(self, msgs):
+        # pretend to be a slow sink, the loop should keep going meanwhile
+        await asyncio.sleep(0.001)
+        self.seen.extend((msg.host, msg.content) for msg in msgs)
+
+class GatedCollector(core.Output):
+    """doesn't take the messages in before the gate has been opened
+    """
+    def __init__(self, name):
+        core.Output.__init__(self, name=name)
+        self.seen = []
+        self.gate = None
+
+    async def aappend_batch(self, msgs):
+        await self.gate.wait()
+        self.seen.extend(msg.content for msg in msgs)
+
+def get_messages(count):
+    return [core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', 'line %d' % (i,))
+        for i in range(count)]
+
+class AsyncNodeProxyTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever)
+        self.loop_thread.start()
+        self.proxies = []
+
+    def tearDown(self):
+        for proxy in self.proxies:
+            asyncio.run_coroutine_threadsafe(proxy.acancel(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join(5)
+        self.loop.close()
+
+    def _call_in_loop(self, func, *args):
+        async def _call():
+            return func(*args)
+        return asyncio.run_coroutine_threadsafe(_call(), self.loop).result(5)
+
+    def _start(self, proxy):
+        self._call_in_loop(proxy.start)
+        self.proxies.append(proxy)
+
+    def _send(self, proxy, msgs):
+        sender = threading.Thread(target=lambda: [proxy.append(msg) for msg in msgs])
+        sender.start()
+        return sender
+
+    def test_thread_sender_does_not_wait_for_loop(self):
+        out = GatedCollector('out')
+        out.gate = self._call_in_loop(asyncio.Event)
+        self.loop.call_soon_threadsafe(out.gate.set)
+        proxy = AsyncNodeProxy(out, self.loop)
+        self._start(proxy)
+
+        # keep the loop busy, the sender shouldn't have to wait for it
+        self.loop.call_soon_threadsafe(time.sleep, 0.5)
+        start = time.time()
+        sender = self._send(proxy, get_messages(1000))
+        sender.join(5)
+        self.assertLess(time.time() - start, 0.25)
+
+        self.assertTrue(proxy.wait_idle(5))
+        self.assertEqual(out.seen, ['line %d' % (i,) for i in range(1000)])
+
+    def test_thread_sender_waits_when_full(self):
+        out = GatedCollector('out')
+        out.gate = self._call_in_loop(asyncio.Event)
+        proxy = AsyncNodeProxy(out, self.loop, maxsize=10)
+        self._start(proxy)
+
+        sender = self._send(proxy, get_messages(30))
+        sender.join(0.3)
+        self.assertTrue(sender.is_alive())
+        self.assertEqual(proxy._unfinished, 10)
+
+        self.loop.call_soon_threadsafe(out.gate.set)
+        sender.join(5)
+        self.assertFalse(sender.is_alive())
+        self.assertTrue(proxy.wait_idle(5))
+        self.assertEqual(out.seen, ['line %d' % (i,) for i in range(30)])
+
+class AsyncGraphTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_legacy_and_async_nodes(self):
+        filename = os.path.join(self.tmpdir, 'syslog')
+        with open(filename, 'w') as fd:
+            for i in range(300):
+                fd.write("Apr 11 13:35:01 filehost line %d\n" % (i,))
+
+        file_input = SyslogFileMonitor(name='file_input', filename=filename,
+            outputs=['legacy', 'async'], stop_on_EOF=True, batch_size=50)
+        file_input.continue_from_last_known_position = False
+        net_input = AsyncSyslogMonitor(name='net_input', address=('127.0.0.1', 0),
+            network_protocol='tcp', syslog_protocol='rfc3164', outputs=['legacy', 'async'])
+        legacy = Collector('legacy')
+        async_out = AsyncCollector('async')
+
+        graph = AsyncGraph({'file_input': file_input, 'net_input': net_input,
+            'legacy': legacy, 'async': async_out})
+        runnables = graph.start()
+
+        deadline = time.time() + 10
+        while net_input.bound_address is None and time.time() < deadline:
+            time.sleep(0.01)
+
+        expected = set(('filehost', 'line %d' % (i,)) for i in range(300))
+        clients = []
+        for client_nr in range(20):
+            sock = socket.create_connection(net_input.bound_address)
+            clients.append(sock)
+            host = 'client%d' % (client_nr,)
+            lines = []
+            for i in range(10):
+                lines.append("<38>Feb  1 23:13:51 %s sshd: message %d\n" % (host, i))
+                expected.add((host, 'message %d' % (i,)))
+            sock.sendall(''.join(lines).encode('utf-8'))
+        for sock in clients:
+            sock.close()
+
+        while len(async_out.seen) < len(expected) and time.time() < deadline:
+            time.sleep(0.01)
+        graph.stop()
+        for runnable in runnables:
+            runnable.join(10)
+            self.assertFalse(runnable.is_alive())
+
+        self.assertEqual(set(legacy.seen), expected)
+        self.assertEqual(len(legacy.seen), len(expected))
+        self.assertEqual(set(async_out.seen), expected)
+        self.assertEqual(len(async_out.seen), len(expected))
+
+        # order within each input is preserved
+        file_lines = [content for host, content in async_out.seen if host == 'filehost']
+        self.assertEqual(file_lines, ['line %d' % (i,) for i in range(300)])
+
+        # legacy node was called from a thread of its own
+        self.assertEqual(len(legacy.threads), 1)
+        self.assertTrue(legacy.threads.pop().startswith('punnsilm: legacy'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import io
+import datetime
+import unittest
+
+from punnsilm import core, codec
+from punnsilm.modules.syslog_file_input import SYSLOG_FILE_PARSERS, FreeBSDSyslogMessage, RFC5424Message
+
+TRADITIONAL_LINE = "Apr 11 13:35:01 jumala CRON[14695]: pam_unix(cron:session): session opened for user root by (uid=0)"
+FREEBSD_LINE = "Dec  9 10:37:41 <mail.info> mail dovecot: imap-login: Login: user=<someone>, method=PLAIN"
+PROTOCOL23_LINE = '<30>1 2014-04-16T18:25:06.000000+03:00 jumala dbus-daemon 1000 - [origin software="rsyslogd"] [system] Activating service'
+
+class MessageWithDict(core.Message):
+    # no __slots__, so instances have a __dict__
+    pass
+
+def fields(msg):
+    retd = {'class': type(msg)}
+    for name in core.message_slots(type(msg)):
+        if name != 'depth':
+            retd[name] = getattr(msg, name, None)
+    retd.update(getattr(msg, '__dict__', {}))
+    return retd
+
+def get_messages(count):
+    retl = []
+    for i in range(count):
+        msg = core.Message(datetime.datetime(2014, 4, 11, 13, 35, i % 60), 'host%d' % (i % 3,), 'line %d' % (i,))
+        if i % 2:
+            msg.group = 'group'
+            msg.update_extradata({'pid': str(i), 'user': 'root'})
+        retl.append(msg)
+    return retl
+
+class CodecTests(unittest.TestCase):
+    def assertRoundTrip(self, msgs):
+        decoded = codec.decode_batch(codec.encode_batch(msgs))
+        self.assertEqual([fields(msg) for msg in decoded], [fields(msg) for msg in msgs])
+        return decoded
+
+    def test_plain_messages(self):
+        self.assertRoundTrip(get_messages(1))
+        self.assertRoundTrip(get_messages(100))
+
+    def test_empty_batch(self):
+        self.assertEqual(codec.decode_batch(codec.encode_batch([])), [])
+
+    def test_parsed_messages(self):
+        msgs = []
+        for syslog_format, line in (
+                ('rsyslog_traditional_file_format', TRADITIONAL_LINE),
+                ('freebsd_syslog_format', FREEBSD_LINE),
+                ('rsyslog_protocol23_format', PROTOCOL23_LINE)):
+            msg = SYSLOG_FILE_PARSERS[syslog_format].parse(line)
+            self.assertIsNotNone(msg)
+            msgs.append(msg)
+        decoded = self.assertRoundTrip(msgs)
+        self.assertIsInstance(decoded[1], FreeBSDSyslogMessage)
+        self.assertIsInstance(decoded[2], RFC5424Message)
+
+    def test_aware_timestamps(self):
+        tz = datetime.timezone(datetime.timedelta(hours=3))
+        msgs = get_messages(10)
+        for msg in msgs:
+            msg.timestamp = msg.timestamp.replace(tzinfo=tz)
+        decoded = self.assertRoundTrip(msgs)
+        self.assertEqual(decoded[0].timestamp.utcoffset(), datetime.timedelta(hours=3))
+
+    def test_same_moment_in_different_timezones(self):
+        offsets = [datetime.timedelta(hours=3), datetime.timedelta(0)]
+        moment = datetime.datetime(2014, 4, 11, 10, 35, 1, tzinfo=datetime.timezone.utc)
+        msgs = get_messages(10)
+        for i, msg in enumerate(msgs):
+            msg.timestamp = moment.astimezone(datetime.timezone(offsets[i % 2]))
+        # mixed column goes through the table of distinct values
+        msgs[0].timestamp = None
+        decoded = self.assertRoundTrip(msgs)
+        self.assertEqual([msg.timestamp and msg.timestamp.utcoffset() for msg in decoded],
+            [None] + [offsets[i % 2] for i in range(1, 10)])
+
+    def test_lazy_messages(self):
+        parser = SYSLOG_FILE_PARSERS['freebsd_syslog_format']
+        msgs = [parser.parse_lazy(FREEBSD_LINE) for i in range(10)]
+        decoded = codec.decode_batch(codec.encode_batch(msgs))
+        expected = fields(parser.parse(FREEBSD_LINE))
+        self.assertEqual([fields(msg) for msg in decoded], [expected] * 10)
+
+    def test_values(self):
+        msg = core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1, 12345), 'host', 'has\x00separator')
+        msg.comment = ''
+        msg.update_extradata({
+            'none': None,
+            'bool': True,
+            'int': -5,
+            'bigint': 2**80,
+            'float': 1.5,
+            'bytes': b'\x00\xff',
+            'list': [1, 'a', (2, 3)],
+            'dict': {'nested': {'x': 1}},
+            'ts': datetime.datetime(2014, 4, 11),
+            'unicode': u'\xf5\xe4\xf6\xfc',
+            'other': set([1, 2]),
+        })
+        other = core.Message(None, None, u'\xf5\xe4\xf6\xfc')
+        other.set_extradata('different', 'keys')
+        self.assertRoundTrip([msg, other])
+
+    def test_message_with_dict(self):
+        msg = MessageWithDict(datetime.datetime(2014, 4, 11), 'host', 'content', {'appname': 'cron'})
+        decoded = self.assertRoundTrip([msg, core.Message(datetime.datetime(2014, 4, 11), 'host', 'content')])
+        self.assertEqual(decoded[0].appname, 'cron')
+
+    def test_decoded_messages_are_copies(self):
+        msgs = get_messages(2)
+        data = codec.encode_batch(msgs)
+        msgs[1].extradata['pid'] = 'changed'
+        self.assertEqual(codec.decode_batch(data)[1].extradata['pid'], '1')
+
+    def test_single_message(self):
+        msg = get_messages(2)[1]
+        self.assertEqual(fields(codec.decode(codec.encode(msg))), fields(msg))
+
+    def test_bad_data(self):
+        data = codec.encode_batch(get_messages(10))
+        self.assertRaises(codec.CodecError, codec.decode_batch, b'XXXX' + data[4:])
+        self.assertRaises(codec.CodecError, codec.decode_batch, data[:4] + b'\xff' + data[5:])
+        self.assertRaises(codec.CodecError, codec.decode_batch, data[:len(data) // 2])
+
+    def test_frames(self):
+        fd = io.BytesIO()
+        codec.write_batch(fd, get_messages(3))
+        codec.write_batch(fd, get_messages(5))
+        fd.seek(0)
+        self.assertEqual(len(codec.read_batch(fd)), 3)
+        self.assertEqual(len(codec.read_batch(fd)), 5)
+        self.assertIsNone(codec.read_batch(fd))
+
+if __name__ == '__main__':
+    unittest.main()
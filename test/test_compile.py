@@ -0,0 +1,81 @@
+import datetime
+import unittest
+
+from punnsilm import core, PunnsilmGraph
+from punnsilm.modules.rewriter import Rewriter
+from punnsilm.modules.rxgrouper_intermediate import RXGrouper
+
+GROUPS = {
+    'cron': {
+        'rx_list': [r"^CRON\[(?P<pid>\d+)\]: "],
+        'outputs': ['collector'],
+    },
+    'dropped': {
+        'rx_list': [r"^sshd"],
+        'outputs': ['dead_end'],
+    },
+    '_fallthrough': {
+        'outputs': ['collector', 'other'],
+    },
+}
+
+CONTENTS = [
+    "CRON[14695]: pam_unix(cron:session): session opened for user root by (uid=0)",
+    "sshd[3289]: Accepted password for hadara from 192.168.57.1 port 51539 ssh2",
+    "whoopsie[1474]: online",
+]
+
+class Collector(core.Output):
+    def __init__(self, name):
+        core.Output.__init__(self, name=name)
+        self.seen = []
+
+    def append(self, msg):
+        self.seen.append((msg.content, msg.group, dict(msg.extradata or {})))
+
+def build_graph():
+    nodemap = {
+        'rewriter': Rewriter(name='rewriter', outputs=['grouper'], rules=[('content', 'hadara', 'someone')]),
+        'grouper': RXGrouper(name='grouper', groups=GROUPS),
+        # leads nowhere
+        'dead_end': Rewriter(name='dead_end', outputs=['missing'], rules=[]),
+        'collector': Collector('collector'),
+        'other': Collector('other'),
+    }
+    return PunnsilmGraph(nodemap)
+
+def feed(graph):
+    for i, content in enumerate(CONTENTS):
+        msg = core.Message(datetime.datetime(2014, 4, 11, 13, 35, i), 'host', content)
+        graph.nodemap['rewriter'].append(msg)
+    msgs = [core.Message(datetime.datetime(2014, 4, 11, 13, 36, i), 'host', content)
+        for i, content in enumerate(CONTENTS)]
+    graph.nodemap['rewriter'].append_batch(msgs)
+    return dict((name, graph.nodemap[name].seen) for name in ('collector', 'other'))
+
+class CompileTests(unittest.TestCase):
+    def test_same_results(self):
+        expected = feed(build_graph())
+
+        graph = build_graph()
+        report = graph.compile()
+        self.assertEqual(feed(graph), expected)
+
+        self.assertNotIn('dead_end', graph.nodemap)
+        self.assertEqual(graph.removed, ['dead_end'])
+        self.assertIn('removed: dead_end', report)
+        self.assertEqual(graph.nodemap['grouper']._subgroups['dropped'].outputs, [])
+        # rewriter is bound straight to the grouper
+        self.assertEqual(graph.nodemap['rewriter'].broadcast, graph.nodemap['grouper'].append)
+
+    def test_chain_report(self):
+        nodemap = {
+            'first': Rewriter(name='first', outputs=['second'], rules=[]),
+            'second': Rewriter(name='second', outputs=['out'], rules=[]),
+            'out': Collector('out'),
+        }
+        report = PunnsilmGraph(nodemap).compile()
+        self.assertIn('chain: first -> second -> out', report.splitlines())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,451 @@
+import io
+import os
+import bz2
+import gzip
+import lzma
+import time
+import datetime
+import shutil
+import tempfile
+import threading
+import unittest
+
+import punnsilm
+from punnsilm import core, inotify, state_manager
+from punnsilm.core import BlockLineReader, FileMonitor, StopMonitor
+from punnsilm.modules.glob_file_input import GlobFileMonitor
+from punnsilm.modules.syslog_file_input import SyslogFileMonitor
+
+SAMPLE_DATA = (
+    "Apr 11 13:35:01 hadara-laptop2 CRON[14695]: session opened\n"
+    "Apr 11 13:36:29 hadara-laptop2 dhclient: DHCPDISCOVER on eth0\n"
+    "Apr 11 13:36:40 hadara-laptop2 whoopsie[1474]: äöõü\n"
+).encode('utf-8') + b"Apr 11 13:36:41 broken \xff\xfe line\n" + b"unterminated"
+
+class BlockLineReaderTests(unittest.TestCase):
+    def _readline_lines(self, data):
+        retl = []
+        for l in io.BytesIO(data).readlines():
+            try:
+                retl.append(l.decode('utf-8'))
+            except UnicodeDecodeError:
+                continue
+        return retl
+
+    def _block_lines(self, data, block_size):
+        reader = BlockLineReader(io.BytesIO(data), block_size)
+        lines = list(reader.readlines())
+        lines.extend(reader.flush())
+        return reader, lines
+
+    def test_same_lines_as_readline(self):
+        expected = self._readline_lines(SAMPLE_DATA)
+        for block_size in (1, 7, 64, 1024*1024):
+            reader, lines = self._block_lines(SAMPLE_DATA, block_size)
+            self.assertEqual(lines, expected)
+            self.assertEqual(reader.offset, len(SAMPLE_DATA))
+
+    def test_offset_points_to_line_start(self):
+        reader = BlockLineReader(io.BytesIO(SAMPLE_DATA), 16)
+        pos = 0
+        for l in reader.readlines():
+            self.assertEqual(reader.offset, pos)
+            self.assertTrue(SAMPLE_DATA[pos:].startswith(l.encode('utf-8')))
+            pos += len(l.encode('utf-8'))
+
+class FileMonitorTests(unittest.TestCase):
+    def test_stop_on_EOF(self):
+        with tempfile.NamedTemporaryFile(suffix='.log', delete=False) as fd:
+            fd.write(SAMPLE_DATA)
+
+        try:
+            for block_size in (0, 16, 1024):
+                monitor = FileMonitor(name='test_file_monitor', filename=fd.name,
+                    stop_on_EOF=True, read_block_size=block_size)
+                lines = []
+                with self.assertRaises(StopMonitor):
+                    for l in monitor.read():
+                        lines.append(l)
+                monitor._fd.close()
+                self.assertEqual(lines, BlockLineReaderTests._readline_lines(None, SAMPLE_DATA))
+                if block_size:
+                    self.assertEqual(monitor.get_state('file_pos'), len(SAMPLE_DATA))
+        finally:
+            os.unlink(fd.name)
+
+    def test_catch_up_from_saved_position(self):
+        lines = ["line %d äö\n" % (i,) for i in range(20000)]
+        data = ''.join(lines).encode('utf-8') + b"tail"
+        with tempfile.NamedTemporaryFile(suffix='.log', delete=False) as fd:
+            fd.write(data)
+
+        try:
+            skip = 12345
+            monitor = FileMonitor(name='test_file_monitor', filename=fd.name,
+                stop_on_EOF=True, read_block_size=4096, catch_up_threshold=1)
+            monitor.set_state('inode_nr', os.stat(fd.name).st_ino)
+            monitor.set_state('file_pos', len(''.join(lines[:skip]).encode('utf-8')))
+
+            seen = []
+            with self.assertRaises(StopMonitor):
+                for l in monitor.read():
+                    seen.append(l)
+            monitor._fd.close()
+
+            self.assertEqual(seen, lines[skip:] + ['tail'])
+            self.assertEqual(monitor.get_state('file_pos'), len(data))
+        finally:
+            os.unlink(fd.name)
+
+class CompressedFileTests(unittest.TestCase):
+    def _read_all(self, filename, **kwargs):
+        monitor = FileMonitor(name='test_file_monitor', filename=filename, stop_on_EOF=True, **kwargs)
+        lines = []
+        with self.assertRaises(StopMonitor):
+            for l in monitor.read():
+                lines.append(l)
+        monitor._fd.close()
+        return lines
+
+    def test_compressed_formats(self):
+        tmpdir = tempfile.mkdtemp()
+        expected = BlockLineReaderTests._readline_lines(None, SAMPLE_DATA)
+        try:
+            for module in (gzip, bz2, lzma):
+                filename = os.path.join(tmpdir, 'messages.%s' % (module.__name__,))
+                with module.open(filename, 'wb') as fd:
+                    fd.write(SAMPLE_DATA)
+                for block_size in (0, 16):
+                    self.assertEqual(self._read_all(filename, read_block_size=block_size), expected)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_include_rotated(self):
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(tmpdir, 'messages')
+        generations = (
+            (filename + '.3.gz', gzip.open),
+            (filename + '.2.bz2', bz2.open),
+            (filename + '.1', open),
+            (filename, open),
+        )
+        expected = []
+        try:
+            for i, (path, opener) in enumerate(generations):
+                lines = ["generation %d line %d\n" % (i, j) for j in range(3)]
+                with opener(path, 'wb') as fd:
+                    fd.write(''.join(lines).encode('utf-8'))
+                # oldest first
+                os.utime(path, (1000 + i, 1000 + i))
+                expected.extend(lines)
+
+            self.assertEqual(self._read_all(filename, include_rotated=True), expected)
+            self.assertEqual(self._read_all(filename), expected[-3:])
+        finally:
+            shutil.rmtree(tmpdir)
+
+class GlobFileMonitorTests(unittest.TestCase):
+    def test_reads_all_matching_files(self):
+        tmpdir = tempfile.mkdtemp()
+        expected = set()
+        for host in ('host1', 'host2', 'host3'):
+            os.mkdir(os.path.join(tmpdir, host))
+            with open(os.path.join(tmpdir, host, 'syslog'), 'w') as fd:
+                for i in range(3):
+                    fd.write("Apr 11 13:35:0%d %s line %d\n" % (i, host, i))
+                    expected.add((host, 'line %d' % (i,)))
+        with open(os.path.join(tmpdir, 'host1', 'other.log'), 'w') as fd:
+            fd.write("Apr 11 13:35:01 host1 not matched\n")
+
+        try:
+            monitor = GlobFileMonitor(name='test_glob_file_monitor',
+                filename=os.path.join(tmpdir, '*', 'syslog'), stop_on_EOF=True, read_block_size=16)
+            seen = set()
+            with self.assertRaises(StopMonitor):
+                for l in monitor.read():
+                    msg = monitor.parse_message(l)
+                    seen.add((msg.host, msg.content))
+
+            self.assertEqual(seen, expected)
+            files_state = monitor.get_state('files')
+            self.assertEqual(len(files_state), 3)
+            for path, state in files_state.items():
+                self.assertEqual(state['file_pos'], os.path.getsize(path))
+                self.assertEqual(state['inode_nr'], os.stat(path).st_ino)
+        finally:
+            shutil.rmtree(tmpdir)
+
+class Collector(core.Output):
+    def __init__(self, name, release=None):
+        core.Output.__init__(self, name=name)
+        self.seen = []
+        # when given, appends wait for it to be set
+        self.release = release
+
+    def append(self, msg):
+        if self.release is not None:
+            self.release.wait()
+        self.seen.append(msg.content)
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+class RotatingMonitor(FileMonitor):
+    """calls rotate() right before checking the file for the next time
+    """
+    rotate = None
+
+    def _maybe_reopen(self):
+        rotate, self.rotate = self.rotate, None
+        if rotate is not None:
+            rotate()
+        return FileMonitor._maybe_reopen(self)
+
+class IdleNotifyingMonitor(FileMonitor):
+    """sets idle event every time the monitor is about to wait for changes
+    """
+    def __init__(self, *args, **kwargs):
+        FileMonitor.__init__(self, *args, **kwargs)
+        self.idle = threading.Event()
+
+    def _on_idle(self):
+        FileMonitor._on_idle(self)
+        self.idle.set()
+
+class InotifyTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # cleanups run in reverse order, the reader threads have to be
+        # stopped before the directory goes away
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.filename = os.path.join(self.tmpdir, 'messages')
+        with open(self.filename, 'w') as fd:
+            fd.write("first line\n")
+        self.orig_poll_interval = core.FILE_POLL_INTERVAL_SEC
+
+    def tearDown(self):
+        core.FILE_POLL_INTERVAL_SEC = self.orig_poll_interval
+
+    def _tail(self, monitor):
+        """reads the monitor in a background thread, returns list that
+        the lines are appended to
+        """
+        seen = []
+
+        def reader():
+            for l in monitor.read():
+                seen.append(l)
+
+        worker = threading.Thread(target=reader)
+        worker.daemon = True
+        worker.start()
+        self.addCleanup(worker.join, 5)
+        self.addCleanup(self._append, 'bye')
+        self.addCleanup(monitor.stop)
+        return seen
+
+    def _append(self, line):
+        with open(self.filename, 'a') as fd:
+            fd.write(line + "\n")
+
+    def _append_and_wait(self, monitor, seen):
+        self.assertTrue(monitor.idle.wait(5))
+        self.assertTrue(wait_for(lambda: len(seen) == 1))
+        # let it settle into waiting for changes
+        time.sleep(0.1)
+        start = time.time()
+        self._append('second line')
+        self.assertTrue(wait_for(lambda: len(seen) == 2))
+        self.assertEqual(seen, ['first line\n', 'second line\n'])
+        return time.time() - start
+
+    def test_wakes_up_on_append(self):
+        try:
+            inotify.Inotify().close()
+        except inotify.InotifyUnavailable as e:
+            self.skipTest(str(e))
+
+        monitor = IdleNotifyingMonitor(name='inotify', filename=self.filename, use_inotify=True)
+        seen = self._tail(monitor)
+        delay = self._append_and_wait(monitor, seen)
+        self.assertTrue(monitor._use_inotify)
+        self.assertTrue(delay < core.FILE_POLL_INTERVAL_SEC / 4.0, delay)
+
+    def test_falls_back_to_polling_without_inotify(self):
+        core.FILE_POLL_INTERVAL_SEC = 0.05
+
+        def unavailable():
+            raise inotify.InotifyUnavailable('not here')
+
+        orig_inotify = inotify.Inotify
+        inotify.Inotify = unavailable
+        try:
+            monitor = IdleNotifyingMonitor(name='inotify', filename=self.filename, use_inotify=True)
+            seen = self._tail(monitor)
+            self._append_and_wait(monitor, seen)
+        finally:
+            inotify.Inotify = orig_inotify
+        self.assertFalse(monitor._use_inotify)
+        self.assertIsNone(monitor._inotify)
+
+    def test_falls_back_to_polling_when_watch_fails(self):
+        try:
+            inotify.Inotify().close()
+        except inotify.InotifyUnavailable as e:
+            self.skipTest(str(e))
+        core.FILE_POLL_INTERVAL_SEC = 0.05
+
+        def add_watch(self, path, mask):
+            raise OSError(28, 'No space left on device', path)
+
+        orig_add_watch = inotify.Inotify.add_watch
+        inotify.Inotify.add_watch = add_watch
+        try:
+            monitor = IdleNotifyingMonitor(name='inotify', filename=self.filename, use_inotify=True)
+            seen = self._tail(monitor)
+            self._append_and_wait(monitor, seen)
+        finally:
+            inotify.Inotify.add_watch = orig_add_watch
+        self.assertIsNotNone(monitor._inotify)
+        self.assertEqual(monitor._watches, {})
+
+class CheckpointTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'syslog')
+        self.orig_state_file = state_manager.STATE_FILE
+        state_manager.STATE_FILE = os.path.join(self.tmpdir, 'state.json')
+        self.orig_poll_interval = core.FILE_POLL_INTERVAL_SEC
+        core.FILE_POLL_INTERVAL_SEC = 0.01
+
+    def tearDown(self):
+        state_manager.STATE_FILE = self.orig_state_file
+        core.FILE_POLL_INTERVAL_SEC = self.orig_poll_interval
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, start, count):
+        with open(self.filename, 'a') as fd:
+            for i in range(start, start + count):
+                fd.write("Apr 11 13:35:01 host line %d\n" % (i,))
+
+    def _start(self, output, startup_cutoff_sec=0, **kwargs):
+        # the test lines are old
+        monitor = SyslogFileMonitor(name='checkpointed', filename=self.filename, use_inotify=False,
+            startup_cutoff_sec=startup_cutoff_sec, **kwargs)
+        monitor.add_output(output)
+        worker = monitor.run()
+        return monitor, worker
+
+    def test_no_state_skips_old_lines(self):
+        self._write(0, 5)
+        out = Collector('out')
+        monitor, worker = self._start(out, startup_cutoff_sec=core.STARTUP_CUTOFF_SEC)
+        with open(self.filename, 'a') as fd:
+            fd.write("%s host new line\n" % (datetime.datetime.now().strftime('%b %d %H:%M:%S'),))
+        self.assertTrue(wait_for(lambda: len(out.seen) == 1))
+        monitor.stop()
+        worker.join(5)
+        self.assertEqual(out.seen, ['new line'])
+
+    def test_no_state_option_reads_everything(self):
+        self._write(0, 5)
+        out = Collector('out')
+        monitor = SyslogFileMonitor(name='checkpointed', filename=self.filename, stop_on_EOF=True)
+        self.assertEqual(monitor.startup_cutoff_sec, core.STARTUP_CUTOFF_SEC)
+        # what --no-state does
+        monitor.continue_from_last_known_position = False
+        monitor.add_output(out)
+        monitor.run().join(5)
+        self.assertEqual(out.seen, ['line %d' % (i,) for i in range(5)])
+
+    def test_startup_cutoff_from_config(self):
+        self._write(0, 5)
+        punnsilm.load_modules(punnsilm.DEFAULT_MODULEDIR)
+        monitor = punnsilm.create_node({
+            'name': 'checkpointed',
+            'type': 'syslog_file_monitor',
+            'params': {
+                'filename': self.filename,
+                'stop_on_EOF': True,
+                'startup_cutoff_sec': 0,
+            },
+        })
+        self.assertEqual(monitor.startup_cutoff_sec, 0)
+        out = Collector('out')
+        monitor.add_output(out)
+        monitor.run().join(5)
+        self.assertEqual(out.seen, ['line %d' % (i,) for i in range(5)])
+
+    def test_restart_continues_from_exact_position(self):
+        self._write(0, 5)
+        out = Collector('out')
+        monitor, worker = self._start(out, batch_size=2)
+        self.assertTrue(wait_for(lambda: len(out.seen) == 5))
+        self.assertTrue(wait_for(lambda: monitor.get_state('file_pos') == os.path.getsize(self.filename)))
+        monitor.stop()
+        worker.join(5)
+        self.assertFalse(worker.is_alive())
+        state_manager.state_writer({'checkpointed': monitor})
+
+        self._write(5, 3)
+        out = Collector('out')
+        monitor, worker = self._start(out)
+        self.assertTrue(wait_for(lambda: len(out.seen) == 3))
+        monitor.stop()
+        worker.join(5)
+        self.assertEqual(out.seen, ['line 5', 'line 6', 'line 7'])
+        self.assertTrue(monitor._position_restored)
+
+    def test_undelivered_batch_is_not_committed(self):
+        self._write(0, 3)
+        release = threading.Event()
+        out = Collector('out', release=release)
+        monitor, worker = self._start(out, batch_size=2, batch_max_delay_ms=60000)
+        try:
+            # first batch is stuck in the output
+            time.sleep(0.1)
+            self.assertFalse(monitor.get_state('file_pos'))
+        finally:
+            release.set()
+        self.assertTrue(wait_for(lambda: monitor.get_state('file_pos') == os.path.getsize(self.filename)))
+        monitor.stop()
+        worker.join(5)
+        self.assertEqual(len(out.seen), 3)
+
+    def test_rotated_file_is_drained(self):
+        with open(self.filename, 'w') as fd:
+            fd.write("first\nsecond\npart")
+        monitor = RotatingMonitor(name='rotating', filename=self.filename, use_inotify=False)
+        lines = monitor.read()
+        self.assertEqual([next(lines), next(lines)], ['first\n', 'second\n'])
+
+        def rotate():
+            os.rename(self.filename, self.filename + '.1')
+            # written by someone who still had the old file open
+            with open(self.filename + '.1', 'a') as fd:
+                fd.write("ial\nlate\n")
+            with open(self.filename, 'w') as fd:
+                fd.write("new\n")
+        monitor.rotate = rotate
+
+        self.assertEqual([next(lines) for i in range(3)], ['partial\n', 'late\n', 'new\n'])
+        lines.close()
+        monitor._fd.close()
+
+    def test_state_file(self):
+        nodes = {'out': Collector('out')}
+        nodes['out'].set_state('answer', 42)
+        state_manager.state_writer(nodes)
+        self.assertEqual(state_manager.state_read('out'), {'answer': 42})
+        self.assertFalse(os.path.exists(state_manager.STATE_FILE + '.tmp'))
+
+        # state from an older version that died in the middle of writing it
+        with open(state_manager.STATE_FILE, 'w') as fd:
+            fd.write('{"out": {"ans')
+        self.assertEqual(state_manager.state_read('out'), {})
+
+if __name__ == '__main__':
+    unittest.main()
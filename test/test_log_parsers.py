@@ -1,7 +1,13 @@
+import copy
+import glob
+import time
+import pickle
 import datetime
 import unittest
 
-from punnsilm.modules.syslog_file_input import RsyslogTraditionalFileFormatParser, RsyslogFileFormatParser, RsyslogProtocol23FormatParser
+from punnsilm.core import message_slots
+from punnsilm.timestamp_parser import RFC3164TimestampParser
+from punnsilm.modules.syslog_file_input import RsyslogTraditionalFileFormatParser, RsyslogFileFormatParser, RsyslogProtocol23FormatParser, FreeBSDSyslogFileFormatParser
 
 class FixedOffset(datetime.tzinfo):
     """Fixed offset in minutes east from UTC."""
@@ -92,5 +98,126 @@ class ParserTests(unittest.TestCase):
         )
         self._test_parser(RsyslogProtocol23FormatParser, FILENAME, EXPECTED_RESULTS)
 
+class LazyParserTests(unittest.TestCase):
+    SAMPLES = (
+        (RsyslogTraditionalFileFormatParser, 'logsamples/rsyslog_traditional_fileformat.log'),
+        (RsyslogFileFormatParser, 'logsamples/rsyslog_fileformat.log'),
+        (RsyslogProtocol23FormatParser, 'logsamples/rsyslog_protocol23_format.log'),
+        (FreeBSDSyslogFileFormatParser, 'logsamples/freebsd_syslogd.log'),
+        (FreeBSDSyslogFileFormatParser, 'logsamples/freebsd_dovecot_imap.log'),
+    )
+
+    def _fields(self, msg):
+        retd = {}
+        for name in message_slots(type(msg)):
+            if not name.startswith('_'):
+                retd[name] = getattr(msg, name, None)
+        return retd
+
+    def test_lazy_equals_eager(self):
+        for cls, filename in self.SAMPLES:
+            with open(filename, 'r') as fd:
+                for line in fd.readlines():
+                    eager = cls.parse(line)
+                    lazy = cls.parse_lazy(line)
+                    if eager is None:
+                        self.assertEqual(lazy, None)
+                        continue
+
+                    self.assertEqual(self._fields(lazy), self._fields(eager))
+                    for copied in (copy.copy(lazy), pickle.loads(pickle.dumps(lazy))):
+                        self.assertEqual(type(copied), type(eager))
+                        self.assertEqual(self._fields(copied), self._fields(eager))
+
+class FastSplitTests(unittest.TestCase):
+    PARSERS = (RsyslogTraditionalFileFormatParser, FreeBSDSyslogFileFormatParser)
+    # lines that the fast path has to either get right or leave to the regexp
+    EDGE_CASES = (
+        "Apr  1 13:35:01 host content\n",
+        "Apr 11 13:35:01 192.168.1.1 host content\n",
+        "Apr 11 13:35:01 192.168.1.1 content\n",
+        "Apr 11 13:35:01 host\n",
+        "Apr 11 13:35:01 host \n",
+        "Apr 11 13:35:01  host content\n",
+        "Apr 11 13:35:01 h\u00f6st content\n",
+        "Apr 11 13:35:01 host\tcontent\n",
+        "Apr 11 13:35:01 host content\r\n",
+        "Apr 11 13:35:01 host two\nlines\n",
+        "Xyz 11 13:35:01 host content\n",
+        "Apr 1x 13:35:01 host content\n",
+        "Apr 11 13:35:01 <mail.info> host content\n",
+        "Apr 11 13:35:01 <mail_x.info> host content\n",
+        "Apr 11 13:35:01 <mailx> host content\n",
+        "Apr 11 13:35:01 <mail.info>host content\n",
+        "Apr 11 13:35:01",
+        "",
+    )
+
+    def _lines(self):
+        for filename in sorted(glob.glob('logsamples/*.log')):
+            with open(filename, 'r') as fd:
+                for line in fd.readlines():
+                    yield line
+        for line in self.EDGE_CASES:
+            yield line
+
+    def test_same_fields_as_regexp(self):
+        for cls in self.PARSERS:
+            accepted = 0
+            for line in self._lines():
+                fields = cls.fast_split(line)
+                if fields is None:
+                    continue
+                accepted += 1
+                match = cls.rx_syslog_message.match(line)
+                self.assertTrue(match, line)
+                self.assertEqual(fields, match.groupdict(), line)
+            self.assertTrue(accepted > 3)
+
+class FakeClock(object):
+    def __init__(self, *date):
+        self.set(*date)
+
+    def set(self, *date):
+        self.now = time.mktime(datetime.datetime(*date).timetuple())
+
+    def __call__(self):
+        return self.now
+
+class RFC3164TimestampParserTests(unittest.TestCase):
+    def test_year_from_clock(self):
+        parser = RFC3164TimestampParser(clock=FakeClock(2014, 4, 11, 14, 0, 0))
+        for i in range(2):
+            # second round is served from the cache
+            self.assertEqual(parser('Apr 11 13:35:01'), datetime.datetime(2014, 4, 11, 13, 35, 1))
+            self.assertEqual(parser('Apr  9 01:02:03'), datetime.datetime(2014, 4, 9, 1, 2, 3))
+
+    def test_year_rollover(self):
+        clock = FakeClock(2014, 12, 31, 23, 59, 59)
+        parser = RFC3164TimestampParser(clock=clock)
+        self.assertEqual(parser('Dec 31 23:59:59'), datetime.datetime(2014, 12, 31, 23, 59, 59))
+        # sender clock is slightly ahead of ours
+        self.assertEqual(parser('Jan  1 00:00:00'), datetime.datetime(2015, 1, 1, 0, 0, 0))
+        self.assertEqual(parser('Jun  1 00:00:00'), datetime.datetime(2014, 6, 1, 0, 0, 0))
+
+        clock.set(2015, 1, 1, 0, 0, 1)
+        # late lines from the previous year
+        self.assertEqual(parser('Dec 31 23:59:59'), datetime.datetime(2014, 12, 31, 23, 59, 59))
+        self.assertEqual(parser('Jan  1 00:00:00'), datetime.datetime(2015, 1, 1, 0, 0, 0))
+        # cached value from the previous year must not be reused
+        self.assertEqual(parser('Jun  1 00:00:00'), datetime.datetime(2015, 6, 1, 0, 0, 0))
+
+    def test_january_read_in_december(self):
+        clock = FakeClock(2014, 12, 15, 12, 0, 0)
+        parser = RFC3164TimestampParser(clock=clock)
+        # old log of this year, not one from the next year
+        self.assertEqual(parser('Jan  3 10:00:00'), datetime.datetime(2014, 1, 3, 10, 0, 0))
+
+        clock.set(2014, 12, 31, 12, 0, 0)
+        # within a day of the clock now, sender is slightly ahead
+        self.assertEqual(parser('Jan  1 00:00:05'), datetime.datetime(2015, 1, 1, 0, 0, 5))
+        # cached value from two weeks ago must not be reused
+        self.assertEqual(parser('Jan  3 10:00:00'), datetime.datetime(2014, 1, 3, 10, 0, 0))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,136 @@
+import copy
+import pickle
+import datetime
+import unittest
+
+from punnsilm import core, codec
+from punnsilm.modules.syslog_file_input import FreeBSDSyslogFileFormatParser, FreeBSDSyslogMessage, RsyslogTraditionalFileFormatParser
+
+TRADITIONAL_LINE = "Apr 11 13:35:01 jumala CRON[14695]: pam_unix(cron:session): session opened for user root by (uid=0)"
+FREEBSD_LINE = "Dec  9 10:37:41 <mail.info> mail dovecot: imap-login: Login: user=<someone>, method=PLAIN"
+
+FIELDS = ('timestamp', 'host', 'content', 'group', 'comment', 'extradata')
+
+def fields(msg, names=FIELDS):
+    retd = {'class': type(msg)}
+    for name in names:
+        retd[name] = getattr(msg, name)
+    return retd
+
+class MessageWithDict(core.Message):
+    # no __slots__, so instances have a __dict__
+    pass
+
+class MessageTests(unittest.TestCase):
+    def test_slots(self):
+        msg = core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', 'content', {'pid': '1'})
+        self.assertFalse(hasattr(msg, '__dict__'))
+        self.assertEqual(msg.extradata, None)
+        with self.assertRaises(AttributeError):
+            msg.pid = '1'
+
+        msg.set_extradata('user', 'root')
+        msg.update_extradata({'pid': '1'})
+        self.assertEqual(msg.extradata, {'user': 'root', 'pid': '1'})
+
+    def test_extra_fields(self):
+        msg = FreeBSDSyslogMessage(datetime.datetime(2014, 12, 9, 10, 37, 41), 'mail', 'content',
+            {'facility': 'mail', 'level': 'info', 'unknown': 'x'})
+        self.assertEqual((msg.facility, msg.level), ('mail', 'info'))
+        self.assertFalse(hasattr(msg, 'unknown'))
+
+        # subclasses without __slots__ get all the extra parameters as attributes
+        msg = MessageWithDict(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', 'content',
+            {'pid': '1', 'host': 'other'})
+        self.assertEqual(msg.pid, '1')
+        self.assertEqual(msg.host, 'host')
+
+    def test_copy_and_pickle(self):
+        msg = FreeBSDSyslogFileFormatParser.parse(FREEBSD_LINE)
+        msg.group = 'dovecot'
+        msg.update_extradata({'user': 'someone'})
+        names = FIELDS + ('facility', 'level')
+        for copied in (copy.copy(msg), pickle.loads(pickle.dumps(msg))):
+            self.assertEqual(fields(copied, names), fields(msg, names))
+
+class LazyMessageTests(unittest.TestCase):
+    def test_fields_are_decoded_on_access(self):
+        calls = []
+
+        def time_parser(raw_ts):
+            calls.append(raw_ts)
+            return datetime.datetime(2014, 4, 11, 13, 35, 1)
+
+        msg = core.LazyMessage({'timestamp': 'Apr 11 13:35:01', 'host': 'host', 'content': 'content'}, time_parser)
+        self.assertEqual(msg.extradata, None)
+        self.assertEqual(calls, [])
+
+        self.assertEqual(msg.timestamp, datetime.datetime(2014, 4, 11, 13, 35, 1))
+        self.assertEqual(msg.timestamp, datetime.datetime(2014, 4, 11, 13, 35, 1))
+        # decoded value is kept in the slot
+        self.assertEqual(calls, ['Apr 11 13:35:01'])
+        self.assertEqual((msg.host, msg.content), ('host', 'content'))
+
+        with self.assertRaises(AttributeError):
+            msg.unknown
+
+    def test_bad_timestamp(self):
+        def time_parser(raw_ts):
+            raise AttributeError(raw_ts)
+
+        msg = core.LazyMessage({'timestamp': 'xyz', 'host': 'host', 'content': 'content'}, time_parser)
+        with self.assertRaises(ValueError):
+            msg.timestamp
+
+    def test_materialize(self):
+        for parser, line, names in (
+                (RsyslogTraditionalFileFormatParser, TRADITIONAL_LINE, FIELDS),
+                (FreeBSDSyslogFileFormatParser, FREEBSD_LINE, FIELDS + ('facility', 'level'))):
+            eager = parser.parse(line)
+            lazy = parser.parse_lazy(line)
+            self.assertNotEqual(type(lazy), type(eager))
+
+            # changes made before materializing are carried over
+            for msg in (eager, lazy):
+                msg.group = 'group'
+                msg.update_extradata({'user': 'root'})
+
+            materialized = lazy.materialize()
+            self.assertEqual(type(materialized), type(eager))
+            self.assertEqual(fields(materialized, names), fields(eager, names))
+            self.assertEqual(materialized.materialize(), materialized)
+
+    def test_copy_and_pickle(self):
+        eager = FreeBSDSyslogFileFormatParser.parse(FREEBSD_LINE)
+        names = FIELDS + ('facility', 'level')
+        # one copy before anything has been decoded, one after some of the fields have
+        for touch in (False, True):
+            lazy = FreeBSDSyslogFileFormatParser.parse_lazy(FREEBSD_LINE)
+            if touch:
+                lazy.host
+                lazy.group = eager.group = 'dovecot'
+                lazy.set_extradata('user', 'someone')
+                eager.set_extradata('user', 'someone')
+
+            for copied in (copy.copy(lazy), pickle.loads(pickle.dumps(lazy, pickle.HIGHEST_PROTOCOL))):
+                self.assertEqual(type(copied), FreeBSDSyslogMessage)
+                self.assertEqual(fields(copied, names), fields(eager, names))
+
+    def test_codec(self):
+        # partition and process workers pass the messages through the codec
+        eager = FreeBSDSyslogFileFormatParser.parse(FREEBSD_LINE)
+        eager.group = 'dovecot'
+        eager.update_extradata({'user': 'someone'})
+        msgs = []
+        for i in range(3):
+            lazy = FreeBSDSyslogFileFormatParser.parse_lazy(FREEBSD_LINE)
+            lazy.group = 'dovecot'
+            lazy.update_extradata({'user': 'someone'})
+            msgs.append(lazy)
+
+        names = FIELDS + ('facility', 'level')
+        decoded = codec.decode_batch(codec.encode_batch(msgs))
+        self.assertEqual([fields(msg, names) for msg in decoded], [fields(eager, names)] * 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import shutil
+import datetime
+import tempfile
+import unittest
+import urllib.request
+
+from punnsilm import core, metrics, PunnsilmGraph
+from punnsilm.aio import AsyncGraph
+from punnsilm.queueing import QueuedNode
+from punnsilm.partition import PartitionedGraph
+from punnsilm.modules.syslog_file_input import SyslogFileMonitor
+
+class PassThrough(core.PunnsilmNode):
+    def append(self, msg):
+        self.broadcast(msg)
+
+class Slow(core.PunnsilmNode):
+    def append(self, msg):
+        time.sleep(0.002)
+        self.broadcast(msg)
+
+class Failing(core.PunnsilmNode):
+    def append(self, msg):
+        raise ValueError('no')
+
+class Collector(core.Output):
+    def __init__(self, name):
+        core.Output.__init__(self, name=name)
+        self.seen = []
+
+    def append(self, msg):
+        self.seen.append(msg.content)
+
+class AsyncCollector(core.Output):
+    def __init__(self, name):
+        core.Output.__init__(self, name=name)
+        self.seen = []
+
+    async def aappend_batch(self, msgs):
+        self.seen.extend(msg.content for msg in msgs)
+
+def get_messages(count):
+    return [core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', 'line %d' % (i,))
+        for i in range(count)]
+
+def build_graph():
+    nodemap = {
+        'first': PassThrough(name='first', outputs=['slow', 'out']),
+        'slow': Slow(name='slow', outputs=['out']),
+        'out': Collector('out'),
+    }
+    return PunnsilmGraph(nodemap)
+
+def feed(graph):
+    msgs = get_messages(20)
+    for msg in msgs[:10]:
+        graph.nodemap['first'].append(msg)
+    graph.nodemap['first'].append_batch(msgs[10:])
+
+class MetricsTests(unittest.TestCase):
+    def _check_counts(self, graph):
+        feed(graph)
+        snapshots = graph.get_metrics()
+        self.assertEqual(snapshots['first']['messages_in'], 20)
+        self.assertEqual(snapshots['first']['messages_out'], 40)
+        self.assertEqual(snapshots['slow']['messages_in'], 20)
+        self.assertEqual(snapshots['slow']['messages_out'], 20)
+        self.assertEqual(snapshots['out']['messages_in'], 40)
+        self.assertEqual(snapshots['out']['messages_out'], 0)
+        self.assertEqual(snapshots['slow']['type'], 'Slow')
+
+        # time spent by the slow node isn't counted for the node that feeds it
+        self.assertGreater(snapshots['slow']['time_total'], 0.02)
+        self.assertLess(snapshots['first']['time_total'], snapshots['slow']['time_total'] / 2)
+        self.assertEqual(sum(snapshots['slow']['histogram']), snapshots['slow']['calls'])
+        return snapshots
+
+    def test_counts(self):
+        graph = build_graph()
+        graph.enable_metrics()
+        self._check_counts(graph)
+
+    def test_compiled_graph(self):
+        graph = build_graph()
+        graph.compile()
+        graph.enable_metrics()
+        self._check_counts(graph)
+
+    def test_errors_are_counted_once(self):
+        nodemap = {
+            'first': PassThrough(name='first', outputs=['failing']),
+            'failing': Failing(name='failing'),
+        }
+        graph = PunnsilmGraph(nodemap)
+        graph.enable_metrics()
+        for msg in get_messages(3):
+            self.assertRaises(ValueError, nodemap['first'].append, msg)
+        snapshots = graph.get_metrics()
+        self.assertEqual(snapshots['failing']['errors'], 3)
+        self.assertEqual(snapshots['first']['errors'], 0)
+
+    def test_queued_node(self):
+        nodemap = {
+            'first': PassThrough(name='first', outputs=['out']),
+            'out': QueuedNode(Collector('out'), {'size': 100}),
+        }
+        graph = PunnsilmGraph(nodemap)
+        graph.enable_metrics()
+        for msg in get_messages(50):
+            nodemap['first'].append(msg)
+        graph.stop()
+
+        snapshots = graph.get_metrics()
+        self.assertEqual(snapshots['first']['messages_out'], 50)
+        self.assertEqual(snapshots['out']['messages_in'], 50)
+        self.assertEqual(snapshots['out']['queue_depth'], 0)
+        self.assertEqual(snapshots['out']['dropped'], 0)
+        self.assertEqual(snapshots['out']['type'], 'Collector')
+
+    def test_async_graph(self):
+        nodemap = {
+            'first': PassThrough(name='first', outputs=['out', 'async']),
+            'out': Collector('out'),
+            'async': AsyncCollector('async'),
+        }
+        graph = AsyncGraph(nodemap)
+        graph.enable_metrics()
+        graph.start()
+        for msg in get_messages(30):
+            graph.proxies['first'].append(msg)
+        graph.wait_idle()
+        graph.stop()
+
+        snapshots = graph.get_metrics()
+        self.assertEqual(snapshots['first']['messages_in'], 30)
+        self.assertEqual(snapshots['first']['messages_out'], 60)
+        self.assertEqual(snapshots['out']['messages_in'], 30)
+        self.assertEqual(snapshots['async']['messages_in'], 30)
+        self.assertEqual(snapshots['async']['queue_depth'], 0)
+
+    def test_merge(self):
+        graph = build_graph()
+        graph.enable_metrics()
+        feed(graph)
+        snapshots = graph.get_metrics()
+        merged = metrics.merge([snapshots, {'out': snapshots['out']}])
+        self.assertEqual(merged['out']['messages_in'], 80)
+        self.assertEqual(merged['first'], snapshots['first'])
+
+    def test_server(self):
+        graph = build_graph()
+        graph.enable_metrics()
+        feed(graph)
+
+        server = metrics.MetricsServer(graph.get_metrics, '127.0.0.1:0')
+        server.start()
+        try:
+            url = 'http://%s:%d' % server.address[:2]
+            with urllib.request.urlopen(url + '/metrics.json') as response:
+                snapshots = json.loads(response.read().decode('utf-8'))
+            with urllib.request.urlopen(url + '/metrics') as response:
+                text = response.read().decode('utf-8')
+        finally:
+            server.stop()
+
+        self.assertEqual(snapshots['out']['messages_in'], 40)
+        lines = text.splitlines()
+        self.assertIn('# TYPE punnsilm_node_messages_in_total counter', lines)
+        self.assertIn('punnsilm_node_messages_in_total{node="out"} 40', lines)
+        self.assertIn('punnsilm_node_processing_seconds_bucket{node="slow",le="+Inf"} 20', lines)
+        self.assertIn('punnsilm_node_processing_seconds_count{node="slow"} 20', lines)
+
+    def test_parse_address(self):
+        self.assertEqual(metrics.parse_address('9100'), ('127.0.0.1', 9100))
+        self.assertEqual(metrics.parse_address('0.0.0.0:9100'), ('0.0.0.0', 9100))
+        self.assertRaises(Exception, metrics.parse_address, 'localhost:http')
+
+class PartitionedMetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_partitions_are_aggregated(self):
+        filename = os.path.join(self.tmpdir, 'syslog')
+        with open(filename, 'w') as fd:
+            for i in range(300):
+                fd.write("Apr 11 13:35:01 host line %d\n" % (i,))
+
+        source = SyslogFileMonitor(name='input', filename=filename, outputs=['first'],
+            stop_on_EOF=True, batch_size=10)
+        source.continue_from_last_known_position = False
+        first = PassThrough(name='first', outputs=['out'])
+        first.partition = 'input'
+        out = Collector('out')
+
+        graph = PartitionedGraph({'input': source, 'first': first, 'out': out})
+        graph.enable_metrics()
+        for runnable in graph.start():
+            runnable.join(30)
+        graph.stop()
+
+        snapshots = graph.get_metrics()
+        self.assertEqual(snapshots['input']['messages_in'], 300)
+        self.assertEqual(snapshots['input']['messages_out'], 300)
+        self.assertEqual(snapshots['first']['messages_in'], 300)
+        self.assertEqual(snapshots['first']['messages_out'], 300)
+        self.assertEqual(snapshots['out']['messages_in'], 300)
+
+if __name__ == '__main__':
+    unittest.main()
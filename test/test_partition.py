@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from punnsilm import core
+from punnsilm.partition import PartitionedGraph
+from punnsilm.modules.syslog_file_input import SyslogFileMonitor
+
+class Tagger(core.PunnsilmNode):
+    """adds pid of the process where it runs to the messages
+    """
+    def append(self, msg):
+        msg.content = '%s pid=%d' % (msg.content, os.getpid())
+        self.broadcast(msg)
+
+class Collector(core.Output):
+    def __init__(self, name):
+        core.Output.__init__(self, name=name)
+        self.seen = []
+
+    def append(self, msg):
+        self.seen.append((msg.host, msg.content))
+
+def create_monitor(name, filename, outputs):
+    monitor = SyslogFileMonitor(name=name, filename=filename, outputs=outputs,
+        stop_on_EOF=True, batch_size=10)
+    monitor.continue_from_last_known_position = False
+    return monitor
+
+class PartitionedGraphTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_log(self, host, count):
+        filename = os.path.join(self.tmpdir, '%s.log' % (host,))
+        with open(filename, 'w') as fd:
+            for i in range(count):
+                fd.write("Apr 11 13:35:01 %s line %d\n" % (host, i))
+        return filename
+
+    def test_every_message_arrives_once(self):
+        file1 = self._write_log('host1', 500)
+        file2 = self._write_log('host2', 700)
+
+        input1 = create_monitor('input1', file1, ['tagger'])
+        input2 = create_monitor('input2', file2, ['out'])
+        tagger = Tagger(name='tagger', outputs=['out'])
+        tagger.partition = 'input1'
+        out = Collector(name='out')
+        out.partition = None
+
+        graph = PartitionedGraph({'input1': input1, 'input2': input2, 'tagger': tagger, 'out': out})
+        self.assertEqual(sorted(graph.partitions), ['input1', 'input2', 'main'])
+
+        for runnable in graph.start():
+            runnable.join(30)
+            self.assertFalse(runnable.is_alive())
+        graph.stop()
+
+        seen = out.seen
+        self.assertEqual(len(seen), 1200)
+        host1 = [content for host, content in seen if host == 'host1']
+        host2 = [content for host, content in seen if host == 'host2']
+        self.assertEqual(host2, ['line %d' % (i,) for i in range(700)])
+
+        # messages from input1 were modified in the other process
+        self.assertEqual(len(host1), 500)
+        self.assertEqual(len(set(c.split(' pid=')[1] for c in host1)), 1)
+        self.assertNotEqual(host1[0].split(' pid=')[1], str(os.getpid()))
+        self.assertEqual([c.split(' pid=')[0] for c in host1], ['line %d' % (i,) for i in range(500)])
+
+        # state of the inputs has been sent back to the parent
+        self.assertEqual(input1.get_state('file_pos'), os.path.getsize(file1))
+        self.assertEqual(input2.get_state('file_pos'), os.path.getsize(file2))
+
+    def test_partition_loop(self):
+        node1 = Tagger(name='node1', outputs=['node2'])
+        node1.partition = 'a'
+        node2 = Tagger(name='node2', outputs=['node1'])
+        node2.partition = 'b'
+        with self.assertRaises(Exception):
+            PartitionedGraph({'node1': node1, 'node2': node2})
+
+if __name__ == '__main__':
+    unittest.main()
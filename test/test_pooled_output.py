@@ -0,0 +1,269 @@
+import os
+import time
+import email
+import shutil
+import datetime
+import tempfile
+import threading
+import unittest
+
+from punnsilm import core
+from punnsilm.modules import email_output
+from punnsilm.modules.email_output import EmailOutput
+from punnsilm.modules import mariadb_output
+from punnsilm.modules.pipe_output import PipeOutput
+
+def get_messages(count, start=0):
+    return [core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', 'line %d' % (i,))
+        for i in range(start, start + count)]
+
+class RecordingOutput(core.PooledOutput):
+    """fails the first fail_count writes
+    """
+    name = 'recording_output'
+
+    def __init__(self, fail_count=0, delay=0, **kwargs):
+        core.PooledOutput.__init__(self, **kwargs)
+        self.fail_count = fail_count
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.written = []
+        self.batches = []
+        self.resources = []
+        self.released = []
+
+    def setup_worker(self):
+        with self.lock:
+            resource = len(self.resources)
+            self.resources.append(resource)
+        return resource
+
+    def teardown_worker(self, resource):
+        with self.lock:
+            self.released.append(resource)
+
+    def write_batch(self, resource, msgs):
+        time.sleep(self.delay)
+        with self.lock:
+            if self.fail_count:
+                self.fail_count -= 1
+                raise IOError('broken pipe')
+            self.batches.append(len(msgs))
+            self.written.extend(msg.content for msg in msgs)
+
+class PooledOutputTests(unittest.TestCase):
+    def test_workers(self):
+        output = RecordingOutput(name='out', workers=4, max_batch=10, delay=0.01)
+        start = time.time()
+        for i in range(10):
+            output.append_batch(get_messages(10, start=i * 10))
+        # upstream isn't held up by the slow writes
+        self.assertLess(time.time() - start, 0.05)
+
+        self.assertTrue(output.wait_idle(5))
+        self.assertEqual(sorted(output.written), sorted('line %d' % (i,) for i in range(100)))
+        self.assertTrue(all(size <= 10 for size in output.batches))
+        self.assertEqual(len(output.resources), 4)
+
+        output.stop()
+        self.assertEqual(sorted(output.released), [0, 1, 2, 3])
+        self.assertEqual(output.get_stats()['written'], 100)
+
+    def test_retries(self):
+        output = RecordingOutput(name='out', fail_count=2, retry_backoff_sec=0.01)
+        output.append_batch(get_messages(5))
+        self.assertTrue(output.wait_idle(5))
+
+        self.assertEqual(output.written, ['line %d' % (i,) for i in range(5)])
+        # failed writes got rid of their resources
+        self.assertEqual(output.resources, [0, 1, 2])
+        self.assertEqual(output.released, [0, 1])
+        stats = output.get_stats()
+        self.assertEqual(stats['retried'], 2)
+        self.assertEqual(stats['failed'], 0)
+        output.stop()
+
+    def test_give_up(self):
+        output = RecordingOutput(name='out', fail_count=3, retries=2, retry_backoff_sec=0.01)
+        output.append_batch(get_messages(5))
+        self.assertTrue(output.wait_idle(5))
+        # the next ones go through again
+        output.append_batch(get_messages(5, start=5))
+        output.stop()
+
+        stats = output.get_stats()
+        self.assertEqual(stats['failed'], 5)
+        self.assertEqual(output.written, ['line %d' % (i,) for i in range(5, 10)])
+
+    def test_give_up_is_logged_once(self):
+        output = RecordingOutput(name='out', fail_count=3, retries=2, retry_backoff_sec=0.01)
+        with self.assertLogs(level='WARNING') as logs:
+            output.append_batch(get_messages(5))
+            self.assertTrue(output.wait_idle(5))
+        output.stop()
+        self.assertEqual([record.levelname for record in logs.records], ['WARNING', 'WARNING', 'ERROR'])
+        self.assertIn('giving up on 5 messages', logs.records[-1].getMessage())
+
+    def test_stop_flushes(self):
+        output = RecordingOutput(name='out', batch_interval_sec=60, max_batch=3)
+        output.append_batch(get_messages(10))
+        output.stop()
+        self.assertEqual(output.written, ['line %d' % (i,) for i in range(10)])
+
+    def test_drop_policy(self):
+        output = RecordingOutput(name='out', queue_size=5, queue_policy='drop_newest', delay=0.05)
+        output.append_batch(get_messages(1))
+        # worker is now busy with the first message
+        time.sleep(0.02)
+        output.append_batch(get_messages(10, start=1))
+        output.stop()
+        self.assertEqual(output.written, ['line %d' % (i,) for i in range(6)])
+        self.assertEqual(output.get_stats()['queue']['dropped'], 5)
+
+    def test_batch_delay(self):
+        output = RecordingOutput(name='out', batch_delay_sec=0.2, max_batch=10)
+        output.append_batch(get_messages(1))
+        time.sleep(0.05)
+        # first message is still waiting for the ones right behind it
+        self.assertEqual(output.written, [])
+        output.append_batch(get_messages(3, start=1))
+        self.assertTrue(output.wait_idle(5))
+        self.assertEqual(output.batches, [4])
+
+        # and it's not waited for once we are asked to stop
+        output.append_batch(get_messages(2, start=4))
+        start = time.time()
+        output.stop()
+        self.assertLess(time.time() - start, 0.15)
+        self.assertEqual(output.batches, [4, 2])
+
+class FakeSMTP(object):
+    sent = []
+    # how many of the next sends fail
+    fail_count = 0
+
+    def __init__(self, server, port):
+        pass
+
+    def sendmail(self, from_address, addresses, body):
+        if FakeSMTP.fail_count:
+            FakeSMTP.fail_count -= 1
+            raise IOError('connection reset')
+        self.sent.append((time.time(), body))
+
+    def quit(self):
+        pass
+
+class EmailOutputTests(unittest.TestCase):
+    def setUp(self):
+        self.orig_smtp = email_output.smtplib.SMTP
+        email_output.smtplib.SMTP = FakeSMTP
+        FakeSMTP.sent = []
+        FakeSMTP.fail_count = 0
+
+    def tearDown(self):
+        email_output.smtplib.SMTP = self.orig_smtp
+
+    def test_failed_mail_is_not_retried(self):
+        output = EmailOutput(name='mail', from_address='punnsilm@localhost', addresses=['root@localhost'],
+            batch_delay_sec=0, send_interval=0)
+        FakeSMTP.fail_count = 1
+        with self.assertLogs(level='WARNING') as logs:
+            output.append(get_messages(1)[0])
+            self.assertTrue(output.wait_idle(5))
+        # next one goes out
+        output.append(get_messages(1, start=1)[0])
+        output.stop()
+
+        self.assertEqual([record.levelname for record in logs.records], ['ERROR'])
+        stats = output.get_stats()
+        self.assertEqual((stats['failed'], stats['retried'], stats['written']), (1, 0, 1))
+        self.assertEqual(len(FakeSMTP.sent), 1)
+
+    def test_first_mail_is_batched(self):
+        output = EmailOutput(name='mail', from_address='punnsilm@localhost', addresses=['root@localhost'])
+        # same as the sender tick of the old worker thread
+        self.assertEqual(output._batch_delay, email_output.SENDOUT_WORKER_INTERVAL_SEC)
+
+        output = EmailOutput(name='mail', from_address='punnsilm@localhost', addresses=['root@localhost'],
+            batch_delay_sec=0.2)
+        start = time.time()
+        output.append(get_messages(1)[0])
+        time.sleep(0.05)
+        self.assertEqual(FakeSMTP.sent, [])
+        output.append_batch(get_messages(2, start=1))
+        self.assertTrue(output.wait_idle(5))
+        output.stop()
+
+        self.assertEqual(len(FakeSMTP.sent), 1)
+        sent_at, body = FakeSMTP.sent[0]
+        self.assertTrue(sent_at - start >= 0.2)
+        text = email.message_from_string(body).get_payload(decode=True).decode('utf-8')
+        self.assertIn('count:3', text)
+        self.assertIn('content:line 2', text)
+
+class FakeCursor(object):
+    def execute(self, query, parameters):
+        raise IOError('server has gone away')
+
+    def executemany(self, query, parameter_list):
+        raise IOError('server has gone away')
+
+class FakeConnection(object):
+    def autocommit(self, value):
+        pass
+
+    def cursor(self):
+        return FakeCursor()
+
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+class MariadbOutputTests(unittest.TestCase):
+    def setUp(self):
+        self.orig_connect = mariadb_output.pymysql.connect
+        mariadb_output.pymysql.connect = lambda **kwargs: FakeConnection()
+
+    def tearDown(self):
+        mariadb_output.pymysql.connect = self.orig_connect
+
+    def test_failed_query_is_logged_once(self):
+        output = mariadb_output.MariadbOutput(name='db', query='INSERT INTO log VALUES (%s)',
+            arguments=('content',), connection_parameters={}, retries=2, retry_backoff_sec=0.01)
+        for msgs in (get_messages(1), get_messages(2, start=1)):
+            with self.assertLogs(level='WARNING') as logs:
+                output.append_batch(msgs)
+                self.assertTrue(output.wait_idle(5))
+            errors = [record.getMessage() for record in logs.records if record.levelname == 'ERROR']
+            self.assertEqual(len(errors), 1)
+            self.assertIn('INSERT INTO log VALUES (%s)', errors[0])
+            self.assertIn(str([[msg.content] for msg in msgs]), errors[0])
+        output.stop()
+        self.assertEqual(output.get_stats()['failed'], 3)
+
+class PipeOutputTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_command(self):
+        filename = os.path.join(self.tmpdir, 'out')
+        output = PipeOutput(name='pipe', command='tee %s' % (filename,), append_newline=True, bufsize=0)
+        output.append_batch(get_messages(3))
+        output.append(get_messages(1, start=3)[0])
+        output.stop()
+        output._pipe._pipe.close()
+        output._pipe._process.wait()
+
+        with open(filename) as fd:
+            lines = fd.read().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[3].endswith('content:line 3'))
+
+if __name__ == '__main__':
+    unittest.main()
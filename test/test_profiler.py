@@ -0,0 +1,146 @@
+import os
+import time
+import pstats
+import shutil
+import socket
+import datetime
+import tempfile
+import threading
+import unittest
+
+from punnsilm import core, profiler, PunnsilmGraph
+
+def busy_work():
+    total = 0
+    for i in range(20000):
+        total += i
+    return total
+
+class PassThrough(core.PunnsilmNode):
+    def append(self, msg):
+        self.broadcast(msg)
+
+class Busy(core.PunnsilmNode):
+    def append(self, msg):
+        busy_work()
+        self.broadcast(msg)
+
+class Collector(core.Output):
+    def __init__(self, name):
+        core.Output.__init__(self, name=name)
+        self.seen = []
+
+    def append(self, msg):
+        self.seen.append(msg.content)
+
+def build_graph():
+    nodemap = {
+        'first': PassThrough(name='first', outputs=['busy']),
+        'busy': Busy(name='busy', outputs=['out']),
+        'out': Collector('out'),
+    }
+    return PunnsilmGraph(nodemap)
+
+def feed(graph, count):
+    for i in range(count):
+        msg = core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', 'line %d' % (i,))
+        graph.nodemap['first'].append(msg)
+
+def function_names(filename):
+    return set(key[2] for key in pstats.Stats(filename).stats)
+
+class ProfilerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.orig_root = profiler.PROFILE_ROOT
+        profiler.PROFILE_ROOT = self.tmpdir
+
+    def tearDown(self):
+        profiler.PROFILE_ROOT = self.orig_root
+        shutil.rmtree(self.tmpdir)
+
+    def _filename(self, node_name, extension):
+        return os.path.join(self.tmpdir, 'punnsilm_profile_%s.%d.%s' % (node_name, os.getpid(), extension))
+
+    def test_deterministic(self):
+        graph = build_graph()
+        graph.compile()
+        graph_profiler = graph.enable_profiler()
+        feed(graph, 5)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+        graph_profiler.start(profiler.MODE_DETERMINISTIC)
+        feed(graph, 5)
+        files = graph_profiler.stop()
+        self.assertEqual(sorted(files), sorted(self._filename(name, 'pstats') for name in ('first', 'busy', 'out')))
+        self.assertEqual(len(graph.nodemap['out'].seen), 10)
+
+        # time spent in the outputs is left out of the profile of the node
+        self.assertIn('busy_work', function_names(self._filename('busy', 'pstats')))
+        self.assertNotIn('busy_work', function_names(self._filename('first', 'pstats')))
+
+    def test_sampling(self):
+        graph = build_graph()
+        graph_profiler = graph.enable_profiler()
+        graph_profiler.start(profiler.MODE_SAMPLING, ['busy'])
+
+        done = threading.Event()
+        def feeder():
+            while not done.is_set():
+                feed(graph, 10)
+        worker = threading.Thread(target=feeder)
+        worker.start()
+        time.sleep(0.3)
+        done.set()
+        worker.join()
+
+        files = graph_profiler.stop()
+        self.assertEqual(files, [self._filename('busy', 'collapsed')])
+        with open(files[0]) as fd:
+            lines = fd.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(stack.startswith('append (test_profiler.py:'), stack)
+            self.assertGreater(int(count), 0)
+        self.assertTrue(any('busy_work' in line for line in lines))
+
+    def test_commands(self):
+        graph = build_graph()
+        graph_profiler = graph.enable_profiler()
+        path = os.path.join(self.tmpdir, 'control.sock')
+        server = graph_profiler.serve(path)
+
+        def send(command):
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(path)
+            conn.sendall((command + '\n').encode('utf-8'))
+            reply = conn.makefile('r').read()
+            conn.close()
+            return reply.strip()
+
+        try:
+            self.assertEqual(send('status'), 'idle')
+            self.assertEqual(send('start deterministic busy,out 60'), 'ok')
+            self.assertTrue(send('status').startswith('deterministic profiling of busy, out'))
+            self.assertTrue(send('start sampling').startswith('error: deterministic profiling is already running'))
+            feed(graph, 3)
+            self.assertEqual(send('stop').splitlines(), [self._filename('busy', 'pstats'), self._filename('out', 'pstats')])
+            self.assertTrue(send('start deterministic missing').startswith('error: unknown nodes: missing'))
+            self.assertTrue(send('bogus').startswith('error: unknown command'))
+        finally:
+            server.close()
+
+    def test_window(self):
+        graph = build_graph()
+        graph_profiler = graph.enable_profiler()
+        graph_profiler.start(profiler.MODE_DETERMINISTIC, duration=0.1)
+        feed(graph, 3)
+        deadline = time.time() + 5
+        while graph_profiler.mode is not None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertIsNone(graph_profiler.mode)
+        self.assertTrue(os.path.exists(self._filename('busy', 'pstats')))
+
+if __name__ == '__main__':
+    unittest.main()
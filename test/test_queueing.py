@@ -0,0 +1,146 @@
+import os
+import time
+import shutil
+import datetime
+import tempfile
+import threading
+import unittest
+
+from punnsilm import core
+from punnsilm import queueing
+from punnsilm.queueing import OverflowQueue, QueuedNode
+
+def get_messages(count, start=0):
+    return [core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', 'line %d' % (i,))
+        for i in range(start, start + count)]
+
+def contents(msgs):
+    return [msg.content for msg in msgs]
+
+def drain(queue):
+    retl = []
+    while 1:
+        msgs = queue.get(timeout=0)
+        if msgs is None:
+            return retl
+        queue.task_done(len(msgs))
+        retl.extend(msgs)
+
+class SlowOutput(core.Output):
+    def __init__(self, name, delay=0):
+        core.Output.__init__(self, name=name)
+        self.delay = delay
+        self.seen = []
+        self.threads = set()
+
+    def append(self, msg):
+        time.sleep(self.delay)
+        self.threads.add(threading.current_thread().name)
+        self.seen.append(msg.content)
+
+class OverflowQueueTests(unittest.TestCase):
+    def test_drop_newest(self):
+        queue = OverflowQueue(maxsize=5, policy='drop_newest')
+        self.assertEqual(queue.put(get_messages(3)), 0)
+        self.assertEqual(queue.put(get_messages(4, 3)), 2)
+        self.assertEqual(contents(drain(queue)), ['line %d' % (i,) for i in range(5)])
+        self.assertEqual(queue.get_counters()['dropped'], 2)
+
+    def test_drop_oldest(self):
+        queue = OverflowQueue(maxsize=5, policy='drop_oldest')
+        queue.put(get_messages(3))
+        self.assertEqual(queue.put(get_messages(4, 3)), 2)
+        self.assertEqual(contents(drain(queue)), ['line %d' % (i,) for i in range(2, 7)])
+        self.assertEqual(queue.put(get_messages(7)), 2)
+        self.assertEqual(contents(drain(queue)), ['line %d' % (i,) for i in range(2, 7)])
+        self.assertTrue(queue.join(0))
+
+    def test_spill_keeps_order(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            spill_file = os.path.join(tmpdir, 'spill')
+            queue = OverflowQueue(maxsize=4, policy='spill', spill_file=spill_file)
+            for i in range(5):
+                queue.put(get_messages(3, i * 3))
+            counters = queue.get_counters()
+            self.assertEqual(counters['spilled'], 12)
+            self.assertEqual(counters['dropped'], 0)
+            self.assertEqual(contents(drain(queue)), ['line %d' % (i,) for i in range(15)])
+            self.assertFalse(os.path.exists(spill_file))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_block(self):
+        queue = OverflowQueue(maxsize=2, policy='block')
+        queue.put(get_messages(2))
+        putter = threading.Thread(target=queue.put, args=(get_messages(1, 2),))
+        putter.start()
+        putter.join(0.1)
+        self.assertTrue(putter.is_alive())
+        first = queue.get()
+        queue.task_done(len(first))
+        putter.join()
+        self.assertEqual(contents(first + drain(queue)), ['line 0', 'line 1', 'line 2'])
+
+class QueuedNodeTests(unittest.TestCase):
+    def test_worker_feeds_node(self):
+        output = SlowOutput('slow')
+        node = QueuedNode(output, {'size': 100})
+        for msg in get_messages(10):
+            node.append(msg)
+        node.append_batch(get_messages(10, 10))
+        self.assertTrue(node.wait_idle(5))
+        node.stop()
+        self.assertEqual(output.seen, ['line %d' % (i,) for i in range(20)])
+        self.assertNotIn(threading.current_thread().name, output.threads)
+
+    def test_slow_node_does_not_block_sender(self):
+        output = SlowOutput('slow', delay=0.05)
+        node = QueuedNode(output, {'size': 2, 'policy': 'drop_newest'})
+        start = time.time()
+        for msg in get_messages(20):
+            node.append(msg)
+        self.assertTrue(time.time() - start < 0.5)
+        node.stop()
+        counters = node.get_queue_counters()
+        self.assertEqual(counters['dropped'] + len(output.seen), 20)
+        self.assertTrue(counters['dropped'] > 0)
+
+    def test_concurrent_first_send(self):
+        # make the worker start slow so that all senders run into it
+        class SlowStartQueue(OverflowQueue):
+            created = []
+
+            def __init__(self, *args, **kwargs):
+                time.sleep(0.05)
+                OverflowQueue.__init__(self, *args, **kwargs)
+                self.created.append(self)
+
+        output = SlowOutput('slow')
+        node = QueuedNode(output, {'size': 100})
+        barrier = threading.Barrier(8)
+
+        def send(i):
+            barrier.wait()
+            node.append_batch(get_messages(5, i * 5))
+
+        orig_queue = queueing.OverflowQueue
+        queueing.OverflowQueue = SlowStartQueue
+        try:
+            senders = [threading.Thread(target=send, args=(i,)) for i in range(8)]
+            for sender in senders:
+                sender.start()
+            for sender in senders:
+                sender.join()
+        finally:
+            queueing.OverflowQueue = orig_queue
+
+        self.assertTrue(node.wait_idle(5))
+        node.stop()
+        self.assertEqual(len(SlowStartQueue.created), 1)
+        self.assertEqual(sorted(output.seen), sorted(['line %d' % (i,) for i in range(40)]))
+        workers = [t for t in threading.enumerate() if t.name == 'punnsilm queue: slow']
+        self.assertEqual(workers, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,479 @@
+import time
+import datetime
+import unittest
+
+from punnsilm import core
+from punnsilm.modules import rxgrouper_intermediate
+from punnsilm.modules.rxgrouper_intermediate import RXGrouper, RXGroup, LiteralPrefilter, MatchCache, combine_rx_list, literal_prefix, required_literals, re
+
+SSHD_TAG = r"^sshd\[\d+\]: "
+
+GROUPS = {
+    'ignore': {
+        'rx_list': [
+            SSHD_TAG + "Accepted password for (?P<user>[a-z]+)",
+            SSHD_TAG + r"pam_unix\(sshd:session\): session opened for",
+            ("host", "^backup[0-9]+$"),
+        ],
+        'outputs': [],
+    },
+    'cron': {
+        'rx_list': [
+            r"^CRON\[(?P<pid>\d+)\]: (?P<_cron_value>.*)",
+        ],
+        'outputs': ['collector'],
+    },
+    'sessions': {
+        'rx_list': [
+            r".*session (?P<_session_value>opened|closed)",
+        ],
+        'outputs': ['collector', 'other'],
+    },
+    '_fallthrough': {
+        'outputs': ['other'],
+    },
+}
+
+CONTENTS = [
+    "sshd[3289]: Accepted password for hadara from 192.168.57.1 port 51539 ssh2",
+    "sshd[3289]: pam_unix(sshd:session): session opened for user hadara by (uid=0)",
+    "CRON[14695]: pam_unix(cron:session): session opened for user root by (uid=0)",
+    "whoopsie[1474]: online",
+    "CRON[14696]: pam_unix(cron:session): session closed for user root",
+    "dhclient: DHCPDISCOVER on eth0 to 255.255.255.255 port 67 interval 13",
+]
+
+class Collector(core.Output):
+    """remembers what it saw and consumes keys starting with _ like statsd output does
+    """
+    def __init__(self, name):
+        core.Output.__init__(self, name=name)
+        self.seen = []
+
+    def append(self, msg):
+        extradata = dict(msg.extradata or {})
+        self.seen.append((msg.content, msg.group, extradata))
+        if msg.extradata:
+            for key in [k for k in msg.extradata if k.startswith('_')]:
+                del msg.extradata[key]
+
+def get_messages():
+    retl = []
+    for i, content in enumerate(CONTENTS):
+        host = 'backup1' if i == 3 else 'host%d' % (i,)
+        retl.append(core.Message(datetime.datetime(2014, 4, 11, 13, 35, i), host, content))
+    return retl
+
+class RXGrouperTests(unittest.TestCase):
+    def _run_grouper(self, feed, match='all', **kwargs):
+        grouper = RXGrouper(name='test_grouper', groups=GROUPS, match=match, **kwargs)
+        collectors = {name: Collector(name) for name in ('collector', 'other')}
+        grouper.connect_outputs(collectors)
+        feed(grouper, get_messages())
+        grouper.wait_idle()
+        grouper.stop()
+        self.grouper = grouper
+        return dict((name, c.seen) for name, c in collectors.items())
+
+    def _one_by_one(self, grouper, msgs):
+        for msg in msgs:
+            grouper.append(msg)
+
+    def _batched(self, grouper, msgs):
+        grouper.append_batch(msgs)
+
+    def test_batch_matches_one_by_one(self):
+        for match in ('all', 'first'):
+            expected = self._run_grouper(self._one_by_one, match=match)
+            self.assertTrue(expected['collector'])
+            self.assertEqual(self._run_grouper(self._batched, match=match), expected)
+
+    def test_workers_match_like_single_process(self):
+        for match in ('all', 'first'):
+            expected = self._run_grouper(self._batched, match=match)
+            for feed in (self._one_by_one, self._batched):
+                seen = self._run_grouper(feed, match=match, workers=3)
+                # messages from different hosts might be handled by different workers
+                for name in expected:
+                    self.assertEqual(sorted(seen[name], key=repr), sorted(expected[name], key=repr))
+
+    def test_workers_keep_order_per_key(self):
+        msgs = []
+        for i in range(2000):
+            msgs.append(core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host%d' % (i % 5,),
+                "CRON[%d]: pam_unix(cron:session): session opened" % (i,)))
+
+        rxgrouper_intermediate.MEASURE_RX_PERF = True
+        try:
+            grouper = RXGrouper(name='test_grouper', groups=GROUPS, match='first', workers=2)
+            collectors = {name: Collector(name) for name in ('collector', 'other')}
+            grouper.connect_outputs(collectors)
+            for i in range(0, len(msgs), 100):
+                grouper.append_batch(msgs[i:i + 100])
+            self.assertTrue(grouper.wait_idle(30))
+            grouper.stop()
+        finally:
+            rxgrouper_intermediate.MEASURE_RX_PERF = False
+
+        seen = collectors['collector'].seen
+        self.assertEqual(len(seen), 2000)
+        for host_nr in range(5):
+            pids = [int(extradata['pid']) for content, group, extradata in seen if int(extradata['pid']) % 5 == host_nr]
+            self.assertEqual(pids, list(range(host_nr, 2000, 5)))
+
+        # counters of the workers are summed up
+        cron_stats = grouper.get_stats()['cron'][GROUPS['cron']['rx_list'][0]]
+        self.assertEqual(cron_stats['matches'], 2000)
+        self.assertEqual(cron_stats['evaluations'], 2000)
+
+    def test_combined_matches_like_separate(self):
+        for match in ('all', 'first'):
+            expected = self._run_grouper(self._batched, match=match)
+            rxgrouper_intermediate.COMBINE_RX_LISTS = False
+            try:
+                self.assertEqual(self._run_grouper(self._batched, match=match), expected)
+            finally:
+                rxgrouper_intermediate.COMBINE_RX_LISTS = True
+
+    def test_cache_matches_like_uncached(self):
+        def twice(feed):
+            def _twice(grouper, msgs):
+                feed(grouper, msgs)
+                feed(grouper, get_messages())
+            return _twice
+
+        for match in ('all', 'first'):
+            for feed in (self._one_by_one, self._batched):
+                expected = self._run_grouper(twice(feed), match=match)
+                self.assertEqual(self._run_grouper(twice(feed), match=match, match_cache_size=100), expected)
+                stats = self.grouper.get_stats()
+                self.assertEqual(stats['_match_cache'], {'content,host': {
+                    'hits': len(CONTENTS), 'misses': len(CONTENTS), 'expired': 0, 'bypassed': 0, 'entries': len(CONTENTS)}})
+                self.assertEqual(self.grouper._subgroups['cron'].matches, 4)
+
+    def test_cache_with_extradata_fields(self):
+        groups = {
+            'cron': {'rx_list': [r"^CRON\[(?P<pid>\d+)\]: (?P<_cron_value>.*)"], 'outputs': ['collector']},
+            'odd_pid': {'rx_list': [('.pid', r'\d*[13579]$')], 'outputs': ['collector']},
+        }
+        def run(**kwargs):
+            grouper = RXGrouper(name='test_grouper', groups=groups, **kwargs)
+            collector = Collector('collector')
+            grouper.connect_outputs({'collector': collector})
+            grouper.append_batch(get_messages())
+            grouper.append_batch(get_messages())
+            return grouper, collector.seen
+
+        expected = run()[1]
+        self.assertEqual([group for content, group, extradata in expected].count('odd_pid'), 2)
+        grouper, seen = run(match_cache_size=100)
+        self.assertEqual(seen, expected)
+        self.assertEqual(grouper.get_stats()['_match_cache']['.pid,content']['hits'], len(CONTENTS))
+
+    def test_cache_in_workers(self):
+        expected = self._run_grouper(self._batched)
+        seen = self._run_grouper(self._batched, workers=2, match_cache_size=100)
+        for name in expected:
+            self.assertEqual(sorted(seen[name], key=repr), sorted(expected[name], key=repr))
+        self.assertEqual(self.grouper.get_stats()['_match_cache']['content,host']['misses'], len(CONTENTS))
+
+    def test_prefix_index_matches_like_unindexed(self):
+        for match in ('all', 'first'):
+            for feed in (self._one_by_one, self._batched):
+                expected = self._run_grouper(feed, match=match)
+                index = self.grouper._prefix_index
+                rxgrouper_intermediate.USE_PREFIX_INDEX = False
+                try:
+                    self.assertEqual(self._run_grouper(feed, match=match), expected)
+                finally:
+                    rxgrouper_intermediate.USE_PREFIX_INDEX = True
+
+        self.assertEqual((index.fieldname, index.key_length), ('content', 5))
+        self.assertEqual([group.name for group in index.lookup(CONTENTS[2])[0]], ['ignore', 'cron', 'sessions'])
+        self.assertEqual([group.name for group in index.lookup(CONTENTS[0])[0]], ['ignore', 'sessions'])
+
+    def test_prefix_index_sees_downstream_changes(self):
+        class Rewriter(core.PunnsilmNode):
+            def append(self, msg):
+                msg.content = 'second ' + msg.content
+
+        groups = {
+            'first': {'rx_list': ['^first'], 'outputs': ['rewriter']},
+            'second': {'rx_list': ['^second'], 'outputs': ['collector']},
+        }
+        grouper = RXGrouper(name='test_grouper', groups=groups)
+        collector = Collector('collector')
+        grouper.connect_outputs({'rewriter': Rewriter(name='rewriter'), 'collector': collector})
+        self.assertEqual(grouper._prefix_index.key_length, 5)
+        grouper.append(core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', 'first'))
+        self.assertEqual(collector.seen, [('second first', 'second', {})])
+
+    def test_prefilter_matches_like_unfiltered(self):
+        for match in ('all', 'first'):
+            expected = self._run_grouper(self._batched, match=match)
+            rxgrouper_intermediate.USE_LITERAL_PREFILTER = False
+            try:
+                self.assertEqual(self._run_grouper(self._batched, match=match), expected)
+            finally:
+                rxgrouper_intermediate.USE_LITERAL_PREFILTER = True
+
+class CombinedRXTests(unittest.TestCase):
+    def _entries(self, rx_list):
+        return [(fieldname, rx, re.compile(rx, re.UNICODE)) for fieldname, rx in rx_list]
+
+    def test_chunks(self):
+        chunks = combine_rx_list(self._entries([
+            ('content', 'foo'),
+            ('content', 'bar (?P<user>[a-z]+)'),
+            # same group name, starts a new chunk
+            ('content', 'baz (?P<user>[a-z]+)'),
+            ('content', 'qux'),
+            ('host', '^backup'),
+            ('host', '^db'),
+            # sets a global flag
+            ('content', '(?i)shouting'),
+            # numbered backreference
+            ('content', r'(\w+) \1'),
+            ('content', 'quux'),
+        ]))
+        self.assertEqual([(fieldname, branches and len(branches)) for fieldname, rx_c, branches, entries in chunks], [
+            ('content', 2), ('content', 2), ('host', 2), ('content', None), ('content', None), ('content', None)])
+
+    def test_first_pattern_in_order_wins(self):
+        group = RXGroup('test', [], rx_list=[
+            r"sshd\[\d+\]: Accepted (?P<method>\w+) for (?P<user>\w+)(?: from (?P<ip>[\d.]+))?",
+            r"(?P<tag>\w+)\[(?P<pid>\d+)\]: (?P<rest>.*)",
+            r"sshd.*",
+        ])
+        msg = core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', "sshd[3289]: Accepted password for hadara")
+        match_obj = group.match(msg)
+        self.assertEqual(match_obj.groupdict(), {'method': 'password', 'user': 'hadara', 'ip': None})
+
+        msg.content = "sshd[3289]: Connection closed"
+        self.assertEqual(group.match(msg).groupdict(), {'tag': 'sshd', 'pid': '3289', 'rest': 'Connection closed'})
+        msg.content = "CRON: nothing"
+        self.assertFalse(group.match(msg))
+
+    def test_positional_groups(self):
+        rx_list = [
+            r"(\w+) (?P<user>\w+) logged in",
+            r"(\w+)\[(\d+)\]: (?P<rest>.*)",
+            r"(?:cron) (\w+)?(x)?",
+        ]
+        group = RXGroup('test', [], rx_list=rx_list)
+        # all of them went into a single combined pattern
+        self.assertEqual([branches and len(branches) for fieldname, rx_c, branches, prefilter in group._rx_chunks], [3])
+
+        for content, rx in (
+                ("ssh hadara logged in", rx_list[0]),
+                ("sshd[3289]: Connection closed", rx_list[1]),
+                ("cron job", rx_list[2])):
+            msg = core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', content)
+            match_obj = group.match(msg)
+            expected = re.match(rx, content, re.UNICODE)
+            self.assertEqual(match_obj.group(), expected.group())
+            self.assertEqual(match_obj.group(0), expected.group(0))
+            self.assertEqual(match_obj.group(1), expected.group(1))
+            self.assertEqual(match_obj[1], expected[1])
+            self.assertEqual(match_obj.groups(), expected.groups())
+            self.assertEqual(match_obj.groups('-'), expected.groups('-'))
+            self.assertEqual(match_obj.groupdict(), expected.groupdict())
+            self.assertEqual(match_obj.span(), expected.span())
+            self.assertEqual([match_obj.span(i) for i in range(expected.re.groups + 1)],
+                [expected.span(i) for i in range(expected.re.groups + 1)])
+            self.assertEqual(match_obj.start(1), expected.start(1))
+            self.assertEqual(match_obj.end(1), expected.end(1))
+            self.assertEqual(match_obj.string, content)
+            self.assertEqual(match_obj.re.pattern, rx)
+
+            # groups of the other patterns in the combined one are not visible
+            with self.assertRaises(IndexError):
+                match_obj.group(expected.re.groups + 1)
+            with self.assertRaises(IndexError):
+                match_obj.group('user' if 'user' not in expected.re.groupindex else 'rest')
+            with self.assertRaises(AttributeError):
+                match_obj.lastindex
+
+        msg = core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', "sshd[3289]: Connection closed")
+        self.assertEqual(group.match(msg).group(1, 2, 'rest'), ('sshd', '3289', 'Connection closed'))
+
+    def test_performance_counters(self):
+        rx_list = ['^a', '^b', '^c', '^d']
+        rxgrouper_intermediate.MEASURE_RX_PERF = True
+        try:
+            group = RXGroup('test', [], rx_list=rx_list)
+            msg = core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', 'c')
+            group.match(msg)
+            msg.content = 'x'
+            group.match(msg)
+        finally:
+            rxgrouper_intermediate.MEASURE_RX_PERF = False
+
+        perfd = group.get_performance_counters()
+        self.assertEqual([perfd[rx]['evaluations'] for rx in rx_list], [2, 2, 2, 1])
+        self.assertEqual([perfd[rx]['matches'] for rx in rx_list], [0, 0, 1, 0])
+        self.assertTrue(all(perfd[rx]['total_time'] > 0 for rx in rx_list))
+
+class AdaptiveOrderTests(unittest.TestCase):
+    def _msg(self, content):
+        return core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', content)
+
+    def test_patterns(self):
+        group = RXGroup('test', [], rx_list=[
+            ('content', 'pinned', 1),
+            r'aaa (?P<a>\d+)',
+            r'bbb (?P<b>\d+)',
+            r'ccc (?P<c>\d+)',
+        ])
+        group.measure_perf = True
+        for i in range(20):
+            group.match(self._msg('ccc %d' % (i,)))
+        group.match(self._msg('bbb 1'))
+        self.assertTrue(group.reorder())
+        self.assertEqual([rx for fieldname, rx, rx_c in group._rx_list],
+            ['pinned', r'ccc (?P<c>\d+)', r'bbb (?P<b>\d+)', r'aaa (?P<a>\d+)'])
+        self.assertFalse(group.reorder())
+        self.assertEqual(group.match(self._msg('aaa 12')).groupdict(), {'a': '12'})
+        self.assertEqual(group.match(self._msg('ccc 3')).groupdict(), {'c': '3'})
+
+    def test_groups(self):
+        groups = {
+            'first': {'rx_list': ['^first'], 'outputs': ['collector']},
+            'second': {'rx_list': ['^second'], 'outputs': ['collector']},
+            'other': {'rx_list': ['^other'], 'outputs': ['other']},
+            'last': {'rx_list': ['^last'], 'outputs': ['collector']},
+        }
+        def run(**kwargs):
+            grouper = RXGrouper(name='test_grouper', groups=groups, match='first', adaptive_order=True, **kwargs)
+            collectors = {name: Collector(name) for name in ('collector', 'other')}
+            grouper.connect_outputs(collectors)
+            grouper.append_batch([self._msg(content) for content in ['second', 'last'] * 5])
+            return grouper, collectors
+
+        orig = rxgrouper_intermediate.ADAPTIVE_ORDER_EVERY_X_MSGS
+        rxgrouper_intermediate.ADAPTIVE_ORDER_EVERY_X_MSGS = 10
+        try:
+            grouper, collectors = run()
+            # last can't move past the group with other outputs
+            self.assertEqual([group.name for group in grouper._matchable_subgroups], ['second', 'first', 'other', 'last'])
+            self.assertEqual([group.name for group in grouper._prefix_index.lookup('first')[0]], ['first'])
+            grouper.append(self._msg('first'))
+            self.assertEqual(collectors['collector'].seen[-1], ('first', 'first', {}))
+
+            groups['first']['priority'] = 1
+            grouper, collectors = run()
+            self.assertEqual([group.name for group in grouper._matchable_subgroups], ['first', 'second', 'other', 'last'])
+
+            # every group is matched anyway
+            grouper = RXGrouper(name='test_grouper', groups=groups, match='all', adaptive_order=True)
+            grouper.connect_outputs({name: Collector(name) for name in ('collector', 'other')})
+            grouper.append_batch([self._msg('last')] * 10)
+            self.assertEqual([group.name for group in grouper._matchable_subgroups], ['first', 'second', 'other', 'last'])
+        finally:
+            rxgrouper_intermediate.ADAPTIVE_ORDER_EVERY_X_MSGS = orig
+
+class MatchCacheTests(unittest.TestCase):
+    def _msg(self, content):
+        return core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', content)
+
+    def test_lru(self):
+        cache = MatchCache(['content'], 2, 60)
+        for content in ('a', 'b'):
+            key, matched = cache.lookup(self._msg(content))
+            self.assertIsNone(matched)
+            cache.store(key, [(content, None)])
+        self.assertEqual(cache.lookup(self._msg('a'))[1], [('a', None)])
+        cache.store(cache.lookup(self._msg('c'))[0], [])
+        # b was the least recently used one
+        self.assertIsNone(cache.lookup(self._msg('b'))[1])
+        self.assertEqual(cache.lookup(self._msg('a'))[1], [('a', None)])
+        self.assertEqual(cache.lookup(self._msg('c'))[1], [])
+
+    def test_ttl(self):
+        cache = MatchCache(['content', '.user'], 10, 0.05)
+        msg = self._msg('a')
+        msg.extradata = {'user': 'root'}
+        cache.store(cache.lookup(msg)[0], [])
+        self.assertEqual(cache.lookup(msg)[1], [])
+        time.sleep(0.1)
+        self.assertIsNone(cache.lookup(msg)[1])
+        self.assertEqual(cache.get_stats()['expired'], 1)
+
+    def test_bypass(self):
+        orig = rxgrouper_intermediate.MATCH_CACHE_WINDOW, rxgrouper_intermediate.MATCH_CACHE_BYPASS_MSGS
+        rxgrouper_intermediate.MATCH_CACHE_WINDOW, rxgrouper_intermediate.MATCH_CACHE_BYPASS_MSGS = 10, 5
+        try:
+            cache = MatchCache(['content'], 100, 60)
+            for i in range(10):
+                key, matched = cache.lookup(self._msg('unique %d' % (i,)))
+                cache.store(key, [])
+            # hit rate too low
+            self.assertTrue(cache.bypass(3))
+            self.assertTrue(cache.bypass(3))
+            self.assertFalse(cache.bypass(1))
+            self.assertEqual(cache.lookup(self._msg('unique 1'))[1], [])
+        finally:
+            rxgrouper_intermediate.MATCH_CACHE_WINDOW, rxgrouper_intermediate.MATCH_CACHE_BYPASS_MSGS = orig
+
+        stats = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['bypassed']), (1, 10, 6))
+
+class PrefilterTests(unittest.TestCase):
+    def _literals(self, rx, flags=re.UNICODE):
+        return required_literals(rx, re.compile(rx, flags))
+
+    def test_required_literals(self):
+        self.assertEqual(self._literals(SSHD_TAG + "Accepted password for (?P<user>[a-z]+)"),
+            ['sshd[', ']: Accepted password for '])
+        self.assertEqual(self._literals("foo(?:bar)+(?:qux)?baz"), ['foo', 'bar', 'baz'])
+        self.assertEqual(self._literals("(?P<state>opened|closed) session"), [' session'])
+        self.assertEqual(self._literals("ab(?i:cde)fgh"), ['fgh'])
+        # too short to be of any use
+        self.assertEqual(self._literals("^a.b$"), [])
+        self.assertEqual(self._literals("(?i)shouting"), [])
+        self.assertEqual(self._literals("shouting", re.UNICODE | re.IGNORECASE), [])
+        if hasattr(re, 'ENHANCEMATCH'):
+            # fuzzy matching of the regex module
+            self.assertEqual(self._literals("(?:connection){e<=1}"), [])
+            self.assertEqual(self._literals("[[:alpha:]]+ connection"), [])
+
+    def test_literal_prefix(self):
+        def prefix(rx):
+            return literal_prefix(rx, re.compile(rx, re.UNICODE))
+        self.assertEqual(prefix(SSHD_TAG + "Accepted password for"), 'sshd[')
+        self.assertEqual(prefix(r"(?P<tag>CRON)\[\d+\]"), 'CRON[')
+        self.assertEqual(prefix("kernel: eth0"), 'kernel: eth0')
+        self.assertEqual(prefix(".*session"), '')
+        self.assertEqual(prefix("(?i)sshd"), '')
+        self.assertEqual(prefix("(?:sshd|CRON)"), '')
+
+    def test_skips_patterns(self):
+        rx_list = ['^a', 'foo (?P<x>[0-9]+)', 'bar (?P<y>[0-9]+)', 'qux', '(?P<any>.+)']
+        rxgrouper_intermediate.MEASURE_RX_PERF = True
+        try:
+            group = RXGroup('test', [], rx_list=rx_list)
+            group.use_prefilter(LiteralPrefilter())
+            group._prefilter.build()
+            msg = core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', 'bar 12')
+            self.assertEqual(group.match(msg).groupdict(), {'y': '12'})
+            msg.content = 'something else'
+            self.assertEqual(group.match(msg).groupdict(), {'any': 'something else'})
+        finally:
+            rxgrouper_intermediate.MEASURE_RX_PERF = False
+
+        perfd = group.get_performance_counters()
+        self.assertEqual([perfd[rx]['evaluations'] for rx in rx_list], [2, 0, 1, 0, 1])
+        self.assertEqual([perfd[rx]['matches'] for rx in rx_list], [0, 0, 1, 0, 1])
+
+    def test_scan(self):
+        prefilter = LiteralPrefilter()
+        ids = dict((literal, prefilter.add_literal('content', literal)) for literal in ('foo', 'foobar', 'oba', 'bar', 'qux'))
+        self.assertEqual(prefilter.add_literal('content', 'foo'), ids['foo'])
+        prefilter.build()
+        # overlapping literals and literals that are prefixes of others are all found
+        self.assertEqual(sorted(prefilter.scan('content', 'xfoobarx')), sorted(ids[literal] for literal in ('foo', 'foobar', 'oba', 'bar')))
+        self.assertEqual(sorted(prefilter.scan('content', 'quxfoo')), sorted([ids['qux'], ids['foo']]))
+        self.assertEqual(list(prefilter.scan('content', 'nothing')), [])
+
+if __name__ == '__main__':
+    unittest.main()
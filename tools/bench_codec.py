@@ -0,0 +1,83 @@
+"""compares the message batch codec against pickle
+
+Messages are parsed from the samples under test/logsamples with the parser
+of their format and repeated with a sequence number added to the content
+to fill the batches. Every third message gets some extradata and a group
+like it would after passing an rx_grouper.
+
+usage: python tools/bench_codec.py [batch_size] [number_of_batches]
+"""
+import os
+import sys
+import time
+import pickle
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from punnsilm import codec
+from punnsilm.modules.syslog_file_input import SYSLOG_FILE_PARSERS
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_BATCH_COUNT = 200
+LOGSAMPLES = os.path.join(os.path.dirname(__file__), '..', 'test', 'logsamples')
+
+SAMPLES = (
+    ('rsyslog_traditional_file_format', 'rsyslog_traditional_fileformat.log'),
+    ('rsyslog_file_format', 'rsyslog_fileformat.log'),
+    ('rsyslog_protocol23_format', 'rsyslog_protocol23_format.log'),
+    ('freebsd_syslog_format', 'freebsd_dovecot_imap.log'),
+)
+
+def create_batch(syslog_format, filename, batch_size):
+    parser = SYSLOG_FILE_PARSERS[syslog_format]
+    with open(os.path.join(LOGSAMPLES, filename), 'r') as fd:
+        lines = [l.rstrip('\n') for l in fd if l.strip()]
+
+    retl = []
+    for i in range(batch_size):
+        msg = parser.parse(lines[i % len(lines)])
+        # real log lines are rarely repeated verbatim
+        msg.content = '%s seq=%d' % (msg.content, i)
+        if i % 3 == 0:
+            msg.group = 'group%d' % (i % 7,)
+            msg.update_extradata({'pid': str(i), 'user': 'user%d' % (i % 5,)})
+        retl.append(msg)
+    return retl
+
+def measure(encode, decode, batch, count):
+    start = time.perf_counter()
+    for i in range(count):
+        data = encode(batch)
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(count):
+        decode(data)
+    decode_time = time.perf_counter() - start
+
+    return len(data), encode_time, decode_time
+
+def main():
+    batch_size = DEFAULT_BATCH_SIZE
+    count = DEFAULT_BATCH_COUNT
+    if len(sys.argv) > 1:
+        batch_size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        count = int(sys.argv[2])
+
+    implementations = (
+        ('pickle', lambda msgs: pickle.dumps(msgs, pickle.HIGHEST_PROTOCOL), pickle.loads),
+        ('codec', codec.encode_batch, codec.decode_batch),
+    )
+
+    print("%d batches of %d messages" % (count, batch_size))
+    print("%-32s %-7s %9s %14s %14s" % ('format', 'codec', 'bytes', 'encode msgs/s', 'decode msgs/s'))
+    for syslog_format, filename in SAMPLES:
+        batch = create_batch(syslog_format, filename, batch_size)
+        for name, encode, decode in implementations:
+            size, encode_time, decode_time = measure(encode, decode, batch, count)
+            total = float(batch_size * count)
+            print("%-32s %-7s %9d %14.0f %14.0f" % (syslog_format, name, size, total / encode_time, total / decode_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""measures how many messages per second pass through a chain of nodes
+with and without PunnsilmGraph.compile()
+
+usage: python tools/bench_graph.py [number_of_hops] [number_of_messages]
+"""
+import os
+import sys
+import time
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from punnsilm import core, PunnsilmGraph
+
+DEFAULT_HOPS = 8
+DEFAULT_MESSAGE_COUNT = 500000
+
+class PassThrough(core.PunnsilmNode):
+    def append(self, msg):
+        self.broadcast(msg)
+
+class Sink(core.Output):
+    def __init__(self, name):
+        core.Output.__init__(self, name=name)
+        self.count = 0
+
+    def append(self, msg):
+        self.count += 1
+
+def build_graph(hops):
+    nodemap = {}
+    for i in range(hops):
+        name = 'hop%d' % (i,)
+        nodemap[name] = PassThrough(name=name, outputs=['hop%d' % (i + 1,) if i + 1 < hops else 'sink'])
+    nodemap['sink'] = Sink('sink')
+    return PunnsilmGraph(nodemap)
+
+def measure(graph, count):
+    msg = core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', 'content')
+    append = graph.nodemap['hop0'].append
+    start = time.perf_counter()
+    for i in range(count):
+        append(msg)
+    return time.perf_counter() - start
+
+def main():
+    hops = DEFAULT_HOPS
+    count = DEFAULT_MESSAGE_COUNT
+    if len(sys.argv) > 1:
+        hops = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        count = int(sys.argv[2])
+
+    print("%d messages through %d hops" % (count, hops))
+    for compiled in (False, True):
+        graph = build_graph(hops)
+        if compiled:
+            graph.compile()
+        time_spent = measure(graph, count)
+        print("%-10s %10.0f msgs/s" % ('compiled' if compiled else 'plain', count / time_spent))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""compares memory usage and construction speed of the core.Message against
+the old __dict__ based implementation
+
+usage: python tools/bench_message.py [number_of_messages]
+"""
+import os
+import sys
+import time
+import datetime
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from punnsilm.core import Message
+
+DEFAULT_MESSAGE_COUNT = 200000
+
+class LegacyMessage(object):
+    """Message as it was before it was converted to use __slots__
+    """
+    def __init__(self, timestamp, host, content, extra_params=None):
+        self.timestamp = timestamp
+        self.host = host
+        self.content = content
+
+        self.extradata = None
+        self.comment = None
+
+        if extra_params is not None:
+            for k, v in extra_params.items():
+                if not hasattr(self, k):
+                    setattr(self, k, v)
+
+def create_messages(msg_cls, count):
+    ts = datetime.datetime(2014, 4, 11, 13, 35, 1)
+    retl = []
+    for i in range(count):
+        # this is what RsyslogParser.parse() feeds to the constructor
+        md = {
+            'timestamp': 'Apr 11 13:35:01',
+            'host': 'hadara-laptop2',
+            'content': 'CRON[14695]: pam_unix(cron:session): session opened for user root by (uid=0)',
+        }
+        msg = msg_cls(ts, md['host'], md['content'], md)
+        msg.group = 'cron'
+        retl.append(msg)
+    return retl
+
+def measure(msg_cls, count):
+    # the strings are shared between the messages so this measures the
+    # message objects themselves
+    tracemalloc.start()
+    msgs = create_messages(msg_cls, count)
+    mem_used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del msgs
+
+    start = time.perf_counter()
+    create_messages(msg_cls, count)
+    time_spent = time.perf_counter() - start
+
+    return mem_used, time_spent
+
+def main():
+    count = DEFAULT_MESSAGE_COUNT
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    print("%d messages" % (count,))
+    for msg_cls in (LegacyMessage, Message):
+        mem_used, time_spent = measure(msg_cls, count)
+        print("%-14s %6.1f bytes/msg %8.0f msgs/s" % (
+            msg_cls.__name__, mem_used / float(count), count / time_spent))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""measures how many messages per second a rx_grouper group with lots of
+patterns can match with and without combining the patterns and with the
+literal prefilter in front of the combined patterns
+
+usage: python tools/bench_rxgroup.py [number_of_patterns] [number_of_messages]
+"""
+import os
+import sys
+import time
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from punnsilm import core
+from punnsilm.modules import rxgrouper_intermediate
+from punnsilm.modules.rxgrouper_intermediate import RXGroup, LiteralPrefilter
+
+DEFAULT_PATTERN_COUNT = 150
+DEFAULT_MESSAGE_COUNT = 20000
+
+def get_rx_list(count):
+    return [r"^daemon%d\[(?P<pid%d>\d+)\]: (?:connection from|lost connection to) (?P<ip%d>[\d.]+)" % (i, i, i)
+        for i in range(count)]
+
+def get_messages(pattern_count, count):
+    retl = []
+    for i in range(count):
+        if i % 10 == 0:
+            # every tenth message matches one of the patterns
+            content = "daemon%d[%d]: connection from 10.0.0.%d" % (i % pattern_count, i, i % 256)
+        else:
+            content = "kernel: [%d.000000] eth0: link is up" % (i,)
+        retl.append(core.Message(datetime.datetime(2014, 4, 11, 13, 35, 1), 'host', content))
+    return retl
+
+def measure(group, msgs):
+    match = group.match
+    start = time.time()
+    for msg in msgs:
+        match(msg)
+    return len(msgs) / (time.time() - start)
+
+def main():
+    pattern_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PATTERN_COUNT
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_MESSAGE_COUNT
+
+    rx_list = get_rx_list(pattern_count)
+    msgs = get_messages(pattern_count, message_count)
+
+    rxgrouper_intermediate.COMBINE_RX_LISTS = False
+    separate = measure(RXGroup('separate', [], rx_list=rx_list), msgs)
+    rxgrouper_intermediate.COMBINE_RX_LISTS = True
+    combined = measure(RXGroup('combined', [], rx_list=rx_list), msgs)
+    group = RXGroup('prefiltered', [], rx_list=rx_list)
+    group.use_prefilter(LiteralPrefilter())
+    group._prefilter.build()
+    prefiltered = measure(group, msgs)
+
+    print('%d patterns, regex module: %s, Aho-Corasick: %s' % (pattern_count,
+        rxgrouper_intermediate.re.__name__, rxgrouper_intermediate.ahocorasick is not None))
+    print('separate:    %7.0f msgs/s' % (separate,))
+    print('combined:    %7.0f msgs/s (%.1fx)' % (combined, combined / separate))
+    print('prefiltered: %7.0f msgs/s (%.1fx)' % (prefiltered, prefiltered / separate))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""compares the memoizing RFC3164 timestamp parser against the old
+implementation that built new datetime for each line
+
+Timestamps are taken from the RFC3164 formatted samples under test/logsamples,
+each of them is repeated to simulate a busy log where many lines are logged
+within the same second.
+
+usage: python tools/bench_timestamp_parser.py [number_of_lines] [lines_per_second]
+"""
+import os
+import re
+import sys
+import time
+import glob
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from punnsilm.timestamp_parser import MONTHMAP, RFC3164TimestampParser
+from punnsilm.modules.syslog_input import RFC_3164_TIMESTAMP
+
+DEFAULT_LINE_COUNT = 500000
+DEFAULT_LINES_PER_SECOND = 100
+LOGSAMPLES = os.path.join(os.path.dirname(__file__), '..', 'test', 'logsamples', '*.log')
+
+def legacy_parser(raw_ts):
+    """timestamp_parser_rfc3164 as it was before the caching
+    """
+    month_abbrev, date, ts_part = raw_ts.split()
+    hour, minute, second = ts_part.split(":")
+    year = time.localtime().tm_year
+    return datetime.datetime(year, MONTHMAP[month_abbrev], int(date), int(hour), int(minute), int(second))
+
+def load_timestamps():
+    rx = re.compile(RFC_3164_TIMESTAMP)
+    retl = []
+    for filename in sorted(glob.glob(LOGSAMPLES)):
+        with open(filename, 'r') as fd:
+            for l in fd:
+                match = rx.match(l)
+                if match:
+                    retl.append(match.group('timestamp'))
+    return retl
+
+def measure(parser, timestamps):
+    start = time.perf_counter()
+    for raw_ts in timestamps:
+        parser(raw_ts)
+    return time.perf_counter() - start
+
+def main():
+    count = DEFAULT_LINE_COUNT
+    per_second = DEFAULT_LINES_PER_SECOND
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        per_second = int(sys.argv[2])
+
+    samples = load_timestamps()
+    timestamps = []
+    while len(timestamps) < count:
+        for raw_ts in samples:
+            timestamps.extend([raw_ts] * per_second)
+    timestamps = timestamps[:count]
+
+    print("%d lines, %d distinct timestamps, %d lines per timestamp" % (
+        count, len(set(samples)), per_second))
+    for name, parser in (('legacy', legacy_parser), ('memoizing', RFC3164TimestampParser())):
+        time_spent = measure(parser, timestamps)
+        print("%-10s %10.0f lines/s" % (name, count / time_spent))
+
+if __name__ == '__main__':
+    main()